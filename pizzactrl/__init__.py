@@ -1,5 +1,6 @@
-from pkg_resources import resource_filename
+import os
 
 __version__ = '0.1.0'
 
-SOUNDS_PATH = resource_filename(__name__, 'sounds/')
+# Not `pkg_resources.resource_filename()`, importing pkg_resources takes seconds on a Pi Zero
+SOUNDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sounds/')
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import logging
+
+from time import perf_counter, sleep
+from typing import Any, List, Optional, Tuple
+
+from .startup import LazyModule
+
+logger = logging.getLogger(__name__)
+
+np = LazyModule('numpy')
+picamera = LazyModule('picamera')
+
+CAMERA_SENSOR_MODE = 5        # 16:9 binned sensor mode
+VIDEO_RES = (1920, 1080)      # Video Resolution
+PHOTO_RES = (2592, 1944)      # Photo Resolution (still port only)
+VIDEO_PREROLL = 0.0           # Seconds of video kept from before RECORD_VIDEO starts (0 disables)
+VIDEO_INTRA_PERIOD = 15       # Frames between keyframes while pre-rolling; pre-roll starts at a keyframe
+PHOTO_VIDEO_PORT = False      # Take photos from the still port at PHOTO_RES. Activities opt in with `video_port=True`
+BURST_RATE = 10.0             # Photos per second in burst mode
+
+# Keystone correction for ffmpeg post-production and photos, for VIDEO_RES.
+# See https://ffmpeg.org/ffmpeg-filters.html#perspective for more information
+KEYSTONE_COORDS = ((370,42),  # x0, y0
+                   (1581,0),  # x1, y1
+                   (485,993), # x2, y2
+                   (1414,700))# x3, y3
+
+
+def _preroll_length(stream: picamera.PiCameraCircularIO, seconds: float) -> float:
+    """
+    Returns the length in seconds `stream.copy_to(seconds=seconds)` will write.
+
+    Like `PiCameraCircularIO._find_seconds()`, the copy starts at the first
+    SPS header at or after the newest frame which is at least `seconds` old,
+    so the pre-roll is at most `seconds` long. SPS headers have no timestamp,
+    the video starts with the next frame which has one.
+    """
+    frames = list(stream.frames)
+    stamped = [(i, frame.timestamp) for i, frame in enumerate(frames) if frame.timestamp is not None]
+    if not stamped:
+        return 0.0
+    last = stamped[-1][1]
+    oldest = 0
+    for i, timestamp in reversed(stamped):
+        if last - timestamp >= seconds * 1e6:
+            oldest = i
+            break
+    for i in range(oldest, len(frames)):
+        if frames[i].frame_type == picamera.PiVideoFrameType.sps_header:
+            for k, timestamp in stamped:
+                if k >= i:
+                    return (last - timestamp) / 1e6
+            break
+    return 0.0
+
+
+class CameraManager:
+    """
+    Owns the camera, which is configured once for `VIDEO_RES`.
+
+    Changing the resolution reconfigures the whole sensor pipeline and takes
+    hundreds of milliseconds, so it is only done when actually needed:
+    Photos from the video port work at the configured resolution and also
+    while recording. Photos from the still port at `PHOTO_RES` (the default)
+    switch the resolution and leave it until a video needs `VIDEO_RES` again.
+
+    Shutter latency (call to image captured) and reconfiguration times are
+    recorded in `metrics` as `camera.shutter` and `camera.reconfigure`.
+    """
+    def __init__(self,
+                 metrics=None,
+                 preroll: float = VIDEO_PREROLL,
+                 video_port_photos: bool = PHOTO_VIDEO_PORT,
+                 sensor_mode: int = CAMERA_SENSOR_MODE):
+        """
+        :param metrics: Optional `metrics.Metrics`
+        :param preroll: Seconds of video kept from before `start_recording()`.
+                        The camera then records continuously into a circular buffer.
+        :param video_port_photos: `True` to take photos from the video port by default, see `capture()`
+        :param sensor_mode: The camera's sensor mode
+        """
+        self.metrics = metrics
+        self.preroll = preroll
+        self.video_port_photos = video_port_photos
+
+        self.camera = picamera.PiCamera(sensor_mode=sensor_mode, resolution=VIDEO_RES)
+        self._resolution = VIDEO_RES
+        self._preroll_stream = None
+        self._recording = False
+
+        if self.preroll > 0:
+            self.start_preroll()
+
+    def _time(self, name: str, seconds: float):
+        if self.metrics is not None:
+            self.metrics.time(f'camera.{name}', seconds)
+
+    def _set_resolution(self, resolution: Tuple[int, int]):
+        if resolution == self._resolution:
+            return
+        start = perf_counter()
+        self.camera.resolution = resolution
+        self._resolution = resolution
+        self._time('reconfigure', perf_counter() - start)
+
+    @property
+    def prerolling(self) -> bool:
+        return self._preroll_stream is not None
+
+    def start_preroll(self):
+        """
+        Record video into a circular buffer holding at least `self.preroll` seconds.
+        """
+        if self.prerolling:
+            return
+        self._set_resolution(VIDEO_RES)
+        # Keep one more keyframe interval, the pre-roll has to start at a keyframe
+        seconds = self.preroll + VIDEO_INTRA_PERIOD / float(self.camera.framerate)
+        self._preroll_stream = picamera.PiCameraCircularIO(self.camera, seconds=int(seconds) + 1)
+        self.camera.start_recording(self._preroll_stream, format='h264',
+                                    intra_period=VIDEO_INTRA_PERIOD)
+
+    def stop_preroll(self):
+        if self.prerolling:
+            self.camera.stop_recording()
+            self._preroll_stream = None
+
+    def start_recording(self, filename: str) -> Tuple[float, Optional[str]]:
+        """
+        Start recording raw H.264 video to `filename`.
+
+        With pre-roll, the recording continues in `filename` without an
+        encoder restart, and the buffered video from before is saved to a
+        `.pre.h264` file which can be concatenated with `filename`.
+
+        Returns the `perf_counter()` time of the first frame and the path
+        of the pre-roll file or `None`.
+        """
+        if self.prerolling:
+            prefile = filename.rsplit('.', 1)[0] + '.pre.h264'
+            self.camera.split_recording(filename)
+            start = perf_counter()
+            stream = self._preroll_stream
+            start -= _preroll_length(stream, self.preroll)
+            stream.copy_to(prefile, seconds=self.preroll)
+        else:
+            prefile = None
+            self._set_resolution(VIDEO_RES)
+            self.camera.start_recording(filename)
+            start = perf_counter()
+        self._recording = True
+        return start, prefile
+
+    def wait_recording(self, timeout: float):
+        self.camera.wait_recording(timeout)
+
+    def stop_recording(self):
+        """
+        Stop recording to the file. With pre-roll, the recording goes back
+        to the circular buffer.
+        """
+        if not self._recording:
+            return
+        self._recording = False
+        if self.prerolling:
+            self._preroll_stream.clear()
+            self.camera.split_recording(self._preroll_stream)
+        else:
+            self.camera.stop_recording()
+
+    def capture(self, output: Any, video_port: Optional[bool] = None, format: Optional[str] = None) -> float:
+        """
+        Take a photo. Returns the shutter latency in seconds.
+
+        :param output: A path (`str`), file or buffer, see `PiCamera.capture()`
+        :param video_port: `True` to capture from the video port at the current
+                           resolution, `False` for the still port at `PHOTO_RES`.
+                           Default is `self.video_port_photos`.
+        :param format: The image format, default is chosen by the file extension
+        """
+        if video_port is None:
+            video_port = self.video_port_photos
+
+        start = perf_counter()
+        if video_port:
+            self.camera.capture(output, format, use_video_port=True)
+        else:
+            # The resolution can't change while the encoder is running
+            prerolling = self.prerolling
+            self.stop_preroll()
+            self._set_resolution(PHOTO_RES)
+            self.camera.capture(output, format)
+            if prerolling:
+                self.start_preroll()
+        latency = perf_counter() - start
+        self._time('shutter', latency)
+        logger.debug(f'Captured photo, shutter latency {1000 * latency:.1f}ms')
+        return latency
+
+    def _rgb_buffer(self, resolution: Tuple[int, int]) -> np.ndarray:
+        width, height = resolution
+        # The camera writes rows padded to 32 pixels, in a height padded to 16
+        padded_width = (width + 31) // 32 * 32
+        padded_height = (height + 15) // 16 * 16
+        return np.empty((padded_height, padded_width, 3), dtype=np.uint8)
+
+    def capture_array(self, video_port: Optional[bool] = None) -> np.ndarray:
+        """
+        Take a photo into memory. Returns the RGB image (height x width x 3).
+        See `capture()`.
+        """
+        if video_port is None:
+            video_port = self.video_port_photos
+        width, height = resolution = self._resolution if video_port else PHOTO_RES
+        buffer = self._rgb_buffer(resolution)
+        self.capture(buffer, video_port=video_port, format='rgb')
+        return buffer[:height, :width]
+
+    def capture_burst(self, count: int, rate: float = BURST_RATE) -> List[np.ndarray]:
+        """
+        Take `count` photos from the video port, `rate` photos per second
+        at most. Returns the RGB images (height x width x 3).
+
+        The shutter latency of the first photo is recorded.
+        """
+        width, height = self._resolution
+        buffers = [self._rgb_buffer(self._resolution) for _ in range(count)]
+
+        def _paced():
+            for i, buffer in enumerate(buffers):
+                delay = start + i / rate - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                yield buffer
+                if i == 0:
+                    self._time('shutter', perf_counter() - start)
+
+        start = perf_counter()
+        self.camera.capture_sequence(_paced(), 'rgb', use_video_port=True)
+        logger.debug(f'Captured {count} photos in {perf_counter() - start:.2f}s')
+        return [buffer[:height, :width] for buffer in buffers]
+
+    def close(self):
+        self.stop_recording()
+        self.stop_preroll()
+        self.camera.close()
@@ -0,0 +1,468 @@
+import os
+import copy
+import wave
+import heapq
+import logging
+
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import click
+
+from pizzactrl.fs_names import FileType
+from pizzactrl.startup import LazyModule
+from pizzactrl.storyboard import Activity, Language, Storyboard, Cursor, Instruction, Program
+from pizzactrl.sb_loader import load_storyboard, DEFAULT_STORYBOARD
+
+logger = logging.getLogger(__name__)
+
+sf = LazyModule('soundfile')
+
+STEP_TIME = 1.0               # Seconds per scroll step at speed 1 (a move takes `steps / speed * STEP_TIME`). Calibrate on the box
+ADVANCE_SPEED = 4             # Speed of the moves between chapters, see `Cursor.advance_chapter()`
+REWIND_SPEED = 4              # Speed of the rewind after a session
+REACTION_MIN = 1.0            # Seconds until the quickest visitor presses a button
+REACTION_TIME = 3.0           # Seconds a visitor takes to press a button after the prompt ended
+WAIT_MAX = 120.0              # Seconds a visitor takes at most, if there is no timeout
+CAPTURE_TIME = 0.2            # Seconds to take a photo
+CHANGEOVER = 30.0             # Seconds between two visitors (lid closed, next visitor opens it)
+MAX_STATES = 100000           # Playback states explored at most
+ITERATIONS = 100000           # Value iterations at most
+TOLERANCE = 1e-6              # Seconds
+
+
+class Times(NamedTuple):
+    """
+    Durations in seconds: quickest visitor, average visitor, slowest visitor
+    """
+    min: float
+    exp: float
+    max: float
+
+    def __add__(self, other: 'Times') -> 'Times':
+        return Times(self.min + other.min, self.exp + other.exp, self.max + other.max)
+
+
+class State(NamedTuple):
+    """
+    The playback state at the start of a chapter, see `Cursor`
+    """
+    index: int
+    skip_flag: bool
+    move: bool
+    h_pos: int
+    v_pos: int
+
+
+class Estimate(NamedTuple):
+    language: Language
+    min: float                # `inf` if the story never ends
+    exp: float
+    max: float                # `inf` if the story can loop
+    states: int               # Playback states reachable
+
+
+class SoundDurations:
+    """
+    Durations of sounds read from the file headers, nothing is decoded.
+
+    Story sounds are looked up in `story_dir` instead of their place on the
+    box, if given. Recordings do not exist offline, their duration is taken
+    from the activity which records them.
+    """
+    def __init__(self, story_dir: Optional[str] = None):
+        self.story_dir = story_dir
+        self.recordings = {}  # Name of the recording -> seconds
+        self.missing = set()  # Paths of sounds which could not be read
+        self._durations = {}
+
+    def path(self, sound: Any) -> str:
+        if (self.story_dir is not None) and (getattr(sound, 'filetype', None) is FileType.STORY):
+            return os.path.join(self.story_dir, sound.name + '.wav')
+        return str(sound)
+
+    def __call__(self, sound: Any) -> float:
+        if sound is None:
+            return 0.0
+        if getattr(sound, 'filetype', None) is FileType.REC:
+            return self.recordings.get(sound.name, 0.0)
+        path = self.path(sound)
+        if path not in self._durations:
+            self._durations[path] = self._read(path)
+        return self._durations[path]
+
+    def _read(self, path: str) -> float:
+        try:
+            if path.lower().endswith('.wav'):
+                with wave.open(path, 'rb') as f:
+                    return f.getnframes() / float(f.getframerate())
+            return sf.info(path).duration
+        except Exception as e:
+            logger.debug(f'Duration of {path} unknown: {e}')
+            self.missing.add(path)
+            return 0.0
+
+
+def _move_time(steps: int, speed: float, step_time: float) -> float:
+    return abs(steps) / float(speed) * step_time
+
+
+class Estimator:
+    """
+    Estimates how long a storyboard takes to play.
+
+    The chapter graph is explored from the start like `Cursor` plays it: the
+    compiled program gives the sounds and scroll steps, the option callbacks
+    of WAIT_FOR_INPUT and GOTO are called on a scratch `Cursor`. A playback
+    state is the chapter, `skip_flag`, `move` and the scroll position.
+
+    Each button of a WAIT_FOR_INPUT is a branch, the timeout is another one
+    if the activity has a timeout.
+
+    - min: The quickest visitor, who presses the button on the shortest path
+      without listening to the prompts (shortest path)
+    - expected: The average visitor listens to the prompt, takes
+      `REACTION_TIME` and picks one of the buttons at random (value iteration)
+    - max: The slowest visitor, who waits until the timeout or `WAIT_MAX`
+      (longest path, `inf` if the story can loop)
+
+    All durations include the rewind after the session.
+    """
+    def __init__(self, storyboard: Storyboard,
+                 durations: SoundDurations = None,
+                 step_time: float = STEP_TIME,
+                 reaction_min: float = REACTION_MIN,
+                 reaction_time: float = REACTION_TIME,
+                 wait_max: float = WAIT_MAX):
+        self.storyboard = storyboard
+        self.durations = durations or SoundDurations()
+        self.step_time = step_time
+        self.reaction_min = reaction_min
+        self.reaction_time = reaction_time
+        self.wait_max = wait_max
+
+        for chapter in storyboard.story:
+            self._find_recordings(chapter.activities)
+
+    def _find_recordings(self, activities):
+        for act in activities:
+            if act.activity is Activity.PARALLEL:
+                self._find_recordings(act.values['activities'])
+            elif act.activity is Activity.RECORD_SOUND:
+                name = getattr(act.values['filename'], 'name', str(act.values['filename']))
+                recordings = self.durations.recordings
+                recordings[name] = max(recordings.get(name, 0.0), act.values['duration'])
+
+    def _time(self, ins: Instruction, move: bool) -> float:
+        """
+        Duration of an activity without a choice
+        """
+        activity, args = ins.activity, ins.args
+        if activity is Activity.PLAY_SOUND:
+            return self.durations(args['sound'])
+        elif activity in (Activity.RECORD_SOUND, Activity.RECORD_VIDEO):
+            return args['duration']
+        elif activity is Activity.TAKE_PHOTO:
+            return CAPTURE_TIME + max(args['burst'] - 1, 0) / args['rate']
+        elif activity in (Activity.LIGHT_FRONT, Activity.LIGHT_BACK):
+            return args['fade']
+        elif activity in (Activity.ADVANCE_UP, Activity.ADVANCE_LEFT):
+            return _move_time(args['steps'], args['speed'], self.step_time) if move else 0.0
+        elif activity is Activity.PARALLEL:
+            # `do_it()` returns when all activities are done
+            return max((self._time(paract, move) for paract in args['activities']), default=0.0)
+        return 0.0
+
+    def _choices(self, ins: Instruction) -> List[Tuple[float, Times, Any]]:
+        """
+        Branches of a WAIT_FOR_INPUT: (probability, times, callback)
+        """
+        args = ins.args
+        prompt = self.durations(args['sound'])
+        timeout = args['timeout'] or 0
+        buttons = [args[name] for name in ('blue_cb', 'red_cb', 'yellow_cb', 'green_cb')
+                   if args[name] is not None]
+
+        choices = []
+        if buttons:
+            exp = prompt + self.reaction_time
+            slowest = prompt + self.wait_max
+            if timeout > 0:
+                exp = min(exp, timeout)
+                slowest = timeout
+            times = Times(min(self.reaction_min, exp), exp, slowest)
+            for callback in buttons:
+                choices.append((1.0 / len(buttons), times, callback))
+        if timeout > 0:
+            # The average visitor presses a button, if there is one
+            choices.append((0.0 if buttons else 1.0, Times(timeout, timeout, timeout), args['timeout_cb']))
+        elif not buttons:
+            choices.append((1.0, Times(0.0, 0.0, 0.0), None))
+        return choices
+
+    def _play_chapter(self, program: Program, state: State) -> List[Tuple[float, Times, Optional[State]]]:
+        """
+        Returns the outcomes of playing the chapter at `state` and advancing
+        to the next one: (probability, times, next state or `None` at the end)
+        """
+        story = self.storyboard.story
+        if state.index >= len(story):
+            return [(1.0, self._rewind(state.h_pos, state.v_pos), None)]
+
+        start = Cursor(self.storyboard, move=True)
+        start.language = program.language
+        cursor = start.at(state.index, state.skip_flag, state.move)
+
+        chapter = story[state.index]
+        if cursor.skip_flag and chapter.skip_flag:
+            cursor.next_chapter = state.index + 1
+            paths = [(1.0, Times(0.0, 0.0, 0.0), cursor, (state.h_pos, state.v_pos))]
+        else:
+            code = program.code[program.starts[state.index]:program.starts[state.index + 1]]
+            paths = [(1.0, Times(0.0, 0.0, 0.0), cursor, (state.h_pos, state.v_pos))]
+            for ins in code:
+                next_paths = []
+                for p, times, cursor, (h, v) in paths:
+                    if cursor.move:
+                        h, v = h + ins.h_steps, v + ins.v_steps
+                    if ins.activity is Activity.WAIT_FOR_INPUT:
+                        for q, wait, callback in self._choices(ins):
+                            branch = copy.copy(cursor)
+                            if callback is not None:
+                                callback(branch)
+                            next_paths.append((p * q, times + wait, branch, (h, v)))
+                        continue
+                    if ins.activity is Activity.GOTO:
+                        cursor = copy.copy(cursor)
+                        cursor.next_chapter = ins.args['index']
+                    t = self._time(ins, cursor.move)
+                    next_paths.append((p, times + Times(t, t, t), cursor, (h, v)))
+                paths = next_paths
+
+        outcomes = []
+        for p, times, cursor, (h, v) in paths:
+            next_chapter = cursor.next_index()
+            if next_chapter is None:
+                outcomes.append((p, times + self._rewind(h, v), None))
+                continue
+            if cursor.move:
+                h_target, v_target = program.position(next_chapter)
+                t = _move_time(max(abs(h_target - h), abs(v_target - v)), ADVANCE_SPEED, self.step_time)
+                times += Times(t, t, t)
+                h, v = h_target, v_target
+            outcomes.append((p, times, State(next_chapter, cursor.skip_flag, cursor.move, h, v)))
+        return outcomes
+
+    def _rewind(self, h_pos: int, v_pos: int) -> Times:
+        t = _move_time(max(abs(h_pos), abs(v_pos)), REWIND_SPEED, self.step_time)
+        return Times(t, t, t)
+
+    def graph(self, language: Language) -> Tuple[State, Dict[State, list]]:
+        """
+        Returns the start state and the outcomes of every reachable state, see `_play_chapter()`
+        """
+        program = self.storyboard.program(language)
+        start = State(0, False, True, 0, 0)
+        graph = {}
+        todo = [start]
+        while todo:
+            state = todo.pop()
+            if state in graph:
+                continue
+            if len(graph) >= MAX_STATES:
+                raise RuntimeError(f'More than {MAX_STATES} playback states')
+            graph[state] = self._play_chapter(program, state)
+            todo.extend(nxt for _, _, nxt in graph[state] if nxt is not None)
+        return start, graph
+
+    def estimate(self, language: Language) -> Estimate:
+        start, graph = self.graph(language)
+        return Estimate(language,
+                        _shortest(start, graph),
+                        _expected(start, graph),
+                        _longest(start, graph),
+                        len(graph))
+
+
+def _shortest(start: State, graph: Dict[State, list]) -> float:
+    """
+    Dijkstra over the `min` times. `inf` if the end can't be reached.
+    """
+    done = set()
+    queue = [(0.0, 0, start)]
+    counter = 1               # Tie breaker, states are not ordered
+    while queue:
+        t, _, state = heapq.heappop(queue)
+        if state is None:
+            return t
+        if state in done:
+            continue
+        done.add(state)
+        for _, times, nxt in graph[state]:
+            if nxt not in done:
+                heapq.heappush(queue, (t + times.min, counter, nxt))
+                counter += 1
+    return float('inf')
+
+
+def _ending(graph: Dict[State, list], average: bool = False) -> set:
+    """
+    States from which the end can be reached
+
+    :param average: Only follow the choices of the average visitor (probability > 0)
+    """
+    parents = {}
+    ending = set()
+    for state, outcomes in graph.items():
+        for p, _, nxt in outcomes:
+            if (p == 0) and average:
+                continue
+            if nxt is None:
+                ending.add(state)
+            else:
+                parents.setdefault(nxt, []).append(state)
+    todo = list(ending)
+    while todo:
+        for parent in parents.get(todo.pop(), ()):
+            if parent not in ending:
+                ending.add(parent)
+                todo.append(parent)
+    return ending
+
+
+def _longest(start: State, graph: Dict[State, list]) -> float:
+    """
+    Longest path over the `max` times. `inf` if a loop can be played before the end.
+    """
+    ending = _ending(graph)
+    if start not in ending:
+        return float('inf')
+    states = _reachable(start, graph, ending)
+
+    # Topological order of the states which lead to the end (Kahn)
+    parents = {state: 0 for state in states}
+    for state in states:
+        for _, _, nxt in graph[state]:
+            if nxt in states:
+                parents[nxt] += 1
+    order = []
+    todo = [state for state, n in parents.items() if n == 0]
+    while todo:
+        state = todo.pop()
+        order.append(state)
+        for _, _, nxt in graph[state]:
+            if nxt in states:
+                parents[nxt] -= 1
+                if parents[nxt] == 0:
+                    todo.append(nxt)
+    if len(order) < len(states):
+        return float('inf')
+
+    longest = {None: 0.0}
+    for state in reversed(order):
+        longest[state] = max(times.max + longest[nxt] for _, times, nxt in graph[state]
+                             if (nxt is None) or (nxt in states))
+    return longest[start]
+
+
+def _expected(start: State, graph: Dict[State, list]) -> float:
+    """
+    Value iteration over the `exp` times with the branch probabilities.
+    `inf` if the story does not end with probability 1.
+    """
+    ending = _ending(graph, average=True)
+    states = _reachable(start, graph, graph, average=True)
+    if not states <= ending:
+        # The average visitor can get stuck in a loop without an end
+        return float('inf')
+
+    values = {state: 0.0 for state in states}
+    values[None] = 0.0
+    for _ in range(ITERATIONS):
+        delta = 0.0
+        for state in states:
+            value = sum(p * (times.exp + values[nxt]) for p, times, nxt in graph[state] if p > 0)
+            delta = max(delta, abs(value - values[state]))
+            values[state] = value
+        if delta < TOLERANCE:
+            return values[start]
+    logger.warning(f'Expected duration did not converge after {ITERATIONS} iterations')
+    return values[start]
+
+
+def _reachable(start: State, graph: Dict[State, list], within, average: bool = False) -> set:
+    """
+    States reachable from `start` through states `within`.
+
+    :param average: Only follow the choices of the average visitor (probability > 0)
+    """
+    seen = {start}
+    todo = [start]
+    while todo:
+        for p, _, nxt in graph[todo.pop()]:
+            if (nxt is not None) and (nxt in within) and (nxt not in seen) and ((p > 0) or not average):
+                seen.add(nxt)
+                todo.append(nxt)
+    return seen
+
+
+def _languages(storyboard: Storyboard) -> List[Language]:
+    """
+    The languages with their own sounds in the storyboard
+    """
+    found = set()
+
+    def _walk(activities):
+        for act in activities:
+            if act.activity is Activity.PARALLEL:
+                _walk(act.values['activities'])
+            for language in Language:
+                if (language is not Language.NOT_SET) and (act.values.get(language.value) is not None):
+                    found.add(language)
+
+    for chapter in storyboard.story:
+        _walk(chapter.activities)
+    return [language for language in Language if language in found] or [Language.NOT_SET]
+
+
+def _format(seconds: float) -> str:
+    if seconds == float('inf'):
+        return 'unbounded'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f'{minutes}:{seconds:02d}'
+
+
+@click.command()
+@click.argument('storyboard', default=DEFAULT_STORYBOARD)
+@click.option('--sounds', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Directory of the story sounds, instead of their place on the box')
+@click.option('--lang', 'languages', multiple=True, type=click.Choice([language.name for language in Language]),
+              help='Language to estimate, can be repeated. Default: the languages of the storyboard')
+@click.option('--step-time', type=float, default=STEP_TIME, help='Seconds per scroll step at speed 1')
+@click.option('--reaction', type=float, default=REACTION_TIME, help='Seconds a visitor takes to press a button')
+@click.option('--changeover', type=float, default=CHANGEOVER, help='Seconds between two visitors')
+def main(storyboard: str, sounds: str, languages: List[str], step_time: float, reaction: float, changeover: float):
+    """
+    Estimate the session durations of STORYBOARD (a storyboard file or module,
+    default sb_berlin) and the visitors per hour, from the sound files and a
+    model of the moves, fades and visitors.
+    """
+    logging.basicConfig(level=logging.INFO)
+    story = load_storyboard(storyboard)
+    durations = SoundDurations(story_dir=sounds)
+    estimator = Estimator(story, durations, step_time=step_time, reaction_time=reaction)
+
+    languages = [Language[name] for name in languages] or _languages(story)
+    print(f'{"language":<10} {"min":>10} {"expected":>10} {"max":>10} {"visitors/h":>11} {"states":>7}')
+    for language in languages:
+        estimate = estimator.estimate(language)
+        visitors = 3600.0 / (estimate.exp + changeover) if estimate.exp < float('inf') else 0.0
+        print(f'{language.name:<10} {_format(estimate.min):>10} {_format(estimate.exp):>10} '
+              f'{_format(estimate.max):>10} {visitors:>11.1f} {estimate.states:>7}')
+    print(f'Durations include the rewind; visitors/h assumes {changeover:.0f}s between visitors.')
+    if durations.missing:
+        print(f'{len(durations.missing)} sounds not found, counted as 0s: '
+              f'{", ".join(sorted(durations.missing)[:5])}{"..." if len(durations.missing) > 5 else ""}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Codecs for the serial protocol between the Raspberry Pi and the microcontroller.
+
+Both codecs encode a command byte, a sequence number and a payload into a
+single buffer, so every command goes out in one `write()`, and decode a
+stream of received bytes into `(seq, command, payload)` tuples.
+"""
+import logging
+import struct
+
+from binascii import crc_hqx
+from typing import Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A decoded message: sequence number (`None` if the codec has none), command byte, payload
+Message = Tuple[Optional[int], int, bytes]
+
+
+class LineCodec:
+    """
+    Legacy protocol: `<command><payload><EOT>`.
+
+    Responses are split at `EOT`, so payloads containing the `EOT` byte are
+    not transferred reliably. Has no sequence numbers.
+    """
+    def __init__(self, eot: bytes = b'\n'):
+        self.eot = eot
+        self._rxbuf = bytearray()
+
+    def encode(self, seq: int, command: int, *payload: bytes) -> bytes:
+        return bytes((command,)) + b''.join(payload) + self.eot
+
+    def feed(self, data: bytes) -> Iterator[Message]:
+        self._rxbuf += data
+        while True:
+            end = self._rxbuf.find(self.eot)
+            if end < 0:
+                return
+            if end > 0:
+                yield None, self._rxbuf[0], bytes(self._rxbuf[1:end])
+            del self._rxbuf[:end + len(self.eot)]
+
+    def reset(self):
+        self._rxbuf.clear()
+
+
+class FrameCodec:
+    """
+    Framed protocol: `<SOF><LEN><SEQ><command><payload><CRC16>`.
+
+    - `SOF` is the start-of-frame marker `0x7E`
+    - `LEN` is the length of the payload (0..255)
+    - `SEQ` is the sequence number of the command, echoed in its response
+    - `CRC16` is CRC-16/CCITT-FALSE (little endian) over `LEN` to the end of the payload
+
+    Payloads may contain any byte value. After a corrupted frame the decoder
+    resynchronizes on the next `SOF`.
+
+    Encoder and decoder use preallocated buffers. The buffer returned by
+    `encode()` is reused by the next call.
+    """
+    SOF = 0x7E
+    HEADER_LEN = 4
+    CRC_LEN = 2
+    MAX_PAYLOAD = 255
+    MAX_FRAME = HEADER_LEN + MAX_PAYLOAD + CRC_LEN
+
+    _header = struct.Struct('<BBBB')
+    _crc = struct.Struct('<H')
+
+    def __init__(self, rx_capacity: int = 4 * MAX_FRAME):
+        self._txbuf = bytearray(self.MAX_FRAME)
+        self._txview = memoryview(self._txbuf)
+
+        self._rxbuf = bytearray(max(rx_capacity, 2 * self.MAX_FRAME))
+        self._rxview = memoryview(self._rxbuf)
+        self._start = 0    # First unparsed byte
+        self._end = 0      # End of received bytes
+
+        self.crc_errors = 0
+
+    @staticmethod
+    def crc(data) -> int:
+        return crc_hqx(data, 0xFFFF)
+
+    def encode(self, seq: int, command: int, *payload: bytes) -> memoryview:
+        """
+        Encode a frame. Returns a view on the internal transmit buffer.
+        """
+        buf = self._txbuf
+        pos = self.HEADER_LEN
+        for part in payload:
+            n = len(part)
+            if pos + n > self.HEADER_LEN + self.MAX_PAYLOAD:
+                raise ValueError(f'Payload exceeds {self.MAX_PAYLOAD} bytes.')
+            buf[pos:pos + n] = part
+            pos += n
+        self._header.pack_into(buf, 0, self.SOF, pos - self.HEADER_LEN, seq & 0xFF, command)
+        self._crc.pack_into(buf, pos, self.crc(self._txview[1:pos]))
+        return self._txview[:pos + self.CRC_LEN]
+
+    def feed(self, data: bytes) -> Iterator[Message]:
+        """
+        Add received bytes and yield all complete frames.
+        """
+        n = len(data)
+        if self._end + n > len(self._rxbuf):
+            self._compact()
+            if self._end + n > len(self._rxbuf):
+                # A full buffer can only hold garbage, frames are much shorter
+                logger.warning('FrameCodec receive buffer overflow, discarding buffered bytes.')
+                self._start = self._end = 0
+                data = data[-len(self._rxbuf):]
+                n = len(data)
+        self._rxbuf[self._end:self._end + n] = data
+        self._end += n
+
+        buf = self._rxbuf
+        view = self._rxview
+        while True:
+            sof = buf.find(self.SOF, self._start, self._end)
+            if sof < 0:
+                self._start = self._end
+                break
+            self._start = sof
+            if self._end - sof < self.HEADER_LEN:
+                break
+            length = buf[sof + 1]
+            frame_end = sof + self.HEADER_LEN + length + self.CRC_LEN
+            if frame_end > self._end:
+                break
+            crc_pos = frame_end - self.CRC_LEN
+            if self._crc.unpack_from(buf, crc_pos)[0] != self.crc(view[sof + 1:crc_pos]):
+                self.crc_errors += 1
+                logger.warning(f'FrameCodec dropped frame with invalid CRC (seq={buf[sof + 2]}).')
+                self._start = sof + 1
+                continue
+            self._start = frame_end
+            yield buf[sof + 2], buf[sof + 3], bytes(view[sof + self.HEADER_LEN:crc_pos])
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _compact(self):
+        n = self._end - self._start
+        self._rxbuf[:n] = self._rxview[self._start:self._end]
+        self._start = 0
+        self._end = n
+
+    def reset(self):
+        self._start = self._end = 0
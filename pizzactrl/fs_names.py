@@ -15,16 +15,31 @@ _STORY_SOUNDS = '/home/pi/sounds/'
 _REC_FILES = '/home/pi/pizzafiles/'
 
 USB_STICK = _REC_FILES + '.stick'
+POSTPROCESS_JOBS = _REC_FILES + '.jobs/'
+STORYBOARD_CACHE = _REC_FILES + '.cache/'
 
 
-def generate_session_id():
-    FileHandle.uuid = str(uuid4())
-    logger.info(f'generated uuid for session: {FileHandle.uuid}')
+def new_session() -> str:
+    """
+    Create the directory of a new session for the recordings.
+    Returns the session, the subdirectory to pass to `RecFile.in_session()`.
+    """
+    session = str(uuid4())
+    logger.info(f'generated uuid for session: {session}')
     try:
-        os.mkdir(_REC_FILES + FileHandle.uuid)
-        FileHandle.uuid += '/'
+        os.mkdir(_REC_FILES + session)
+        session += '/'
     except OSError:
-        FileHandle.uuid = ''
+        session = ''
+    return session
+
+
+def generate_session_id() -> str:
+    """
+    Start a new default session, used by `RecFile`s without a session of their own.
+    """
+    FileHandle.uuid = new_session()
+    return FileHandle.uuid
 
 
 class FileType(Enum):
@@ -47,6 +62,10 @@ class FileHandle:
         if FileHandle.uuid is None:
             generate_session_id()
 
+    def _session(self) -> str:
+        session = getattr(self, 'session', None)
+        return FileHandle.uuid if session is None else session
+
     def __str__(self):
         """
         Return the file path as a string
@@ -55,7 +74,7 @@ class FileHandle:
             FileType.STORY: lambda: (_STORY_SOUNDS + self.name + '.wav'),
             FileType.SFX: lambda: (SOUNDS_PATH + self.name
                                    + '.wav'),
-            FileType.REC: lambda: (_REC_FILES + FileHandle.uuid + self.name)
+            FileType.REC: lambda: (_REC_FILES + self._session() + self.name)
         }[self.filetype]()
 
 
@@ -70,9 +89,19 @@ class SfxFile(FileHandle):
 class RecFile(FileHandle):
     """
     Returns the path to a recordable file
+
+    The file is in the directory of `session` (see `new_session()`), or of
+    the default session if it is `None`.
     """
-    def __init__(self, name: str):
+    def __init__(self, name: str, session: str = None):
         FileHandle.__init__(self, name, FileType.REC)
+        self.session = session
+
+    def in_session(self, session: str) -> 'RecFile':
+        """
+        Returns this file in the directory of `session`
+        """
+        return RecFile(self.name, session=session)
 
 
 class StoryFile(FileHandle):
@@ -92,3 +121,7 @@ SFX_REC_AUDIO = SfxFile('countdown')
 SFX_STOP_REC = SfxFile('done')
 
 SND_SELECT_LANG = SfxFile('lang-select')
+
+# Sound effects kept in memory for the whole runtime
+SFX_PRELOAD = [SFX_ERROR_DE, SFX_ERROR_EN, SFX_ERROR_TR,
+               SFX_POST_OK, SFX_REC_AUDIO, SND_SELECT_LANG]
@@ -1,44 +1,52 @@
+from __future__ import annotations
+
 import logging
+import threading
 
-from time import sleep, time
+from time import sleep, time, perf_counter
 from enum import Enum
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-from typing import Any, List, Iterable
-from scipy.io.wavfile import write as writewav
-
-import sounddevice as sd
-# import soundfile as sf
-
-import pygame.mixer as mx
-
-from picamera import PiCamera
-from gpiozero import Button, DigitalOutputDevice, DigitalInputDevice
-
-import serial
+from typing import Any, List, Optional
 
+from .startup import LazyModule, preload, phase
 from .gpio_pins import *
+from .serial_link import SerialLink
+from .framing import FrameCodec, LineCodec
+from .metrics import Metrics
+from .soundcache import SoundCache
+from .recorder import AudioRecorder
+from .camera import CameraManager, VIDEO_PREROLL, BURST_RATE
+from .photo import PhotoWriter
+from .fs_names import FileType
 
 logger = logging.getLogger(__name__)
 
+# Imported on first use or by `preload()`, they take seconds to import on a Pi Zero
+np = LazyModule('numpy')
+sf = LazyModule('soundfile')
+mx = LazyModule('pygame.mixer')
+gpiozero = LazyModule('gpiozero')
+serial = LazyModule('serial')
+
 
 # Constants
-VIDEO_RES = (1920, 1080)      # Video Resolution
-PHOTO_RES = (2592, 1944)      # Photo Resolution
-
-# Keystone correction for ffmpeg post-production.
-# See https://ffmpeg.org/ffmpeg-filters.html#perspective for more information
-KEYSTONE_COORDS = ((370,42),  # x0, y0
-                   (1581,0),  # x1, y1
-                   (485,993), # x2, y2
-                   (1414,700))# x3, y3
-        
 AUDIO_REC_SR = 44100          # Audio Recording Samplerate
+AUDIO_REC_CHANNELS = 1        # Audio Recording channels
+AUDIO_REC_DTYPE = 'int16'     # Audio Recording sample format
 
 SERIAL_DEV = '/dev/serial0'   # Serial port to use
 SERIAL_BAUDRATE = 115200      # Serial connection baud rate
 SERIAL_CONN_TIMEOUT = 0.2     # Serial connection read timeout
+SERIAL_MAX_OUTSTANDING = 8    # Commands sent before waiting for a response (framed protocol)
 HELO_TIMEOUT = 20
 
+SOUND_END_POLL = 0.01         # Check interval once a sound should have ended
+SOUND_CACHE_BUDGET = 96 * 2**20  # Bytes of decoded sounds kept in memory
+
+# Modules imported in the background when `PizzaHAL` is created, in the order they are needed
+HAL_BACKENDS = ('numpy', 'pygame.mixer', 'soundfile', 'picamera', 'sounddevice', 'PIL.Image')
+
 
 class Lights(Enum):
     BACKLIGHT = 0
@@ -82,6 +90,62 @@ class SerialCommunicationError(Exception):
     pass
 
 
+class ConfigurationException(Exception):
+    pass
+
+
+def _sound_nbytes(sound) -> int:
+    """
+    Size of a decoded `pygame.mixer.Sound` in bytes, without copying its buffer.
+    """
+    freq, fmt, channels = mx.get_init()
+    return int(sound.get_length() * freq) * channels * (abs(fmt) // 8)
+
+
+def _to_mixer(data: np.ndarray, samplerate: int):
+    """
+    Convert audio samples (frames x channels, int16 or float) to a
+    `pygame.mixer.Sound` in the format the mixer was initialized with.
+    """
+    freq, fmt, channels = mx.get_init()
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+
+    if data.dtype.kind == 'f':
+        data = np.clip(data, -1.0, 1.0) * 32767
+    elif data.dtype != np.int16:
+        data = data / (np.iinfo(data.dtype).max / 32767)
+
+    if samplerate != freq:
+        n = int(len(data) * freq / samplerate)
+        src = np.arange(len(data))
+        dst = np.linspace(0, len(data) - 1, n)
+        data = np.stack([np.interp(dst, src, data[:, c]) for c in range(data.shape[1])], axis=1)
+
+    if data.shape[1] != channels:
+        data = np.repeat(data.mean(axis=1, keepdims=True), channels, axis=1)
+
+    target = {8: np.uint8, -8: np.int8, 16: np.uint16, -16: np.int16}.get(fmt, np.int16)
+    if target is np.uint8:
+        data = data.astype(np.int32) // 256 + 128
+    elif target is np.int8:
+        data = data.astype(np.int32) // 256
+    elif target is np.uint16:
+        data = data.astype(np.int32) + 32768
+    return mx.Sound(buffer=np.ascontiguousarray(data, dtype=target).tobytes())
+
+
+def _load_sound(path: str):
+    """
+    Decode a sound file. WAV and OGG are decoded by the mixer, other formats
+    (e.g. FLAC recordings) by soundfile.
+    """
+    if path.lower().endswith(('.wav', '.ogg')):
+        return mx.Sound(path)
+    data, samplerate = sf.read(path, dtype='int16', always_2d=True)
+    return _to_mixer(data, samplerate)
+
+
 class PizzaHAL:
     """
     This class holds a represenation of the pizza box hardware and provides
@@ -95,19 +159,88 @@ class PizzaHAL:
 
     """
 
-    def __init__(self, serialdev: str = SERIAL_DEV, baudrate: int = SERIAL_BAUDRATE, timeout: float = SERIAL_CONN_TIMEOUT):
+    def __init__(self, serialdev: str = SERIAL_DEV, baudrate: int = SERIAL_BAUDRATE, timeout: float = SERIAL_CONN_TIMEOUT,
+                 framed: bool = False, max_outstanding: Optional[int] = None,
+                 sound_budget: int = SOUND_CACHE_BUDGET, preroll: float = VIDEO_PREROLL):
+        """
+        :param framed: `True` to use the length-prefixed, CRC-checked protocol
+                       (`framing.FrameCodec`). The microcontroller firmware must
+                       support it. Default is the `EOT`-terminated line protocol.
+        :param max_outstanding: Number of queued commands sent to the microcontroller
+                                before waiting for a response. Default is
+                                `SERIAL_MAX_OUTSTANDING` with `framed`, else 1: the
+                                line protocol firmware handles one command at a time.
+        :param sound_budget: Maximum size of decoded sounds in `self.soundcache` in bytes
+        :param preroll: Seconds of video kept from before `record_video()` is called.
+                        The camera then records continuously into a circular buffer.
+        """
+        # Sound, camera and image libraries load while the serial port and pins are set up
+        preload(HAL_BACKENDS)
+
         self.serialcon = serial.Serial(serialdev, baudrate=baudrate, timeout=timeout)
+        self.timeout = timeout
+        if max_outstanding is None:
+            max_outstanding = SERIAL_MAX_OUTSTANDING if framed else 1
 
-        # Lid switch with pull-up. is_pressed = True when lid is open
-        self.lid_switch = Button(LID_SWITCH)
-        self.pin_helo1 = DigitalOutputDevice(HELO1)
-        self.pin_helo2 = DigitalInputDevice(HELO2)
+        # Command latencies, serial traffic and aborts. See `Metrics.dump()`
+        self.metrics = Metrics()
 
-        self.camera = None
-        self.soundcache = {}
+        # Lid switch with pull-up. is_pressed = True when lid is open
+        self.lid_switch = gpiozero.Button(LID_SWITCH)
+        self.pin_helo1 = gpiozero.DigitalOutputDevice(HELO1)
+        self.pin_helo2 = gpiozero.DigitalInputDevice(HELO2)
+
+        # Responses are read by a background event loop; lid and HELO2 changes
+        # cancel in-flight commands as soon as the pin changes.
+        self.link = SerialLink(self.serialcon,
+                               precheck=self._check_pins,
+                               codec=FrameCodec() if framed else LineCodec(SerialCommands.EOT.value),
+                               window=max_outstanding,
+                               metrics=self.metrics)
+        self._queued = []         # Futures of commands sent with `queue_cmd()`
+        self.lid_switch.when_released = self._on_lid_closed
+        self.lid_switch.when_pressed = self._on_lid_opened
+        self.pin_helo2.when_deactivated = self._on_helo2_low
+
+        # Set while the lid is closed, to wait for lid events without polling
+        self.lid_closed = threading.Event()
+        if not self.lid_open:
+            self.lid_closed.set()
+
+        self.camera = None        # `camera.CameraManager`, see `init_camera()`
+        self.preroll = preroll
+        self.photos = PhotoWriter(metrics=self.metrics)
+        self.soundcache = SoundCache(loader=_load_sound,
+                                     sizeof=_sound_nbytes,
+                                     budget=sound_budget,
+                                     metrics=self.metrics)
 
         self.connected = False
 
+    def _check_pins(self, ignore_lid: bool) -> bool:
+        """
+        Called by `self.link` for every command. Returns `False` if the
+        command should return `None` because the lid is closed.
+        """
+        if not self.pin_helo2.value:
+            raise CommunicationError('Pin HELO2 LOW. Microcontroller in error state or lost connection.')
+        if (not ignore_lid) and (not self.lid_open):
+            logger.info('Lid closed while processing command. Returning None.')
+            return False
+        return True
+
+    def _on_lid_closed(self):
+        logger.debug('Lid closed, cancelling pending commands.')
+        self.lid_closed.set()
+        self.link.cancel()
+
+    def _on_lid_opened(self):
+        self.lid_closed.clear()
+
+    def _on_helo2_low(self):
+        self.link.cancel(CommunicationError('Pin HELO2 LOW. Microcontroller in error state or lost connection.'),
+                         lid_only=False)
+
     @property
     def lid_open(self) -> bool:
         """
@@ -150,19 +283,20 @@ class PizzaHAL:
         if not self.pin_helo2.value:
             raise CommunicationError('Microcontroller did not respond to HELO pin.')
 
-        self.serialcon.write(SerialCommands.HELLO.value + SerialCommands.EOT.value)
-        resp = self.serialcon.read_until()
+        self.link.stop()
+        self.link.start()
+
+        resp = self._handshake(SerialCommands.HELLO)
         
-        if resp == (SerialCommands.HELLO.value + SerialCommands.EOT.value):
-            self.serialcon.write(SerialCommands.ALREADY_CONNECTED.value + SerialCommands.EOT.value)
-            resp = self.serialcon.read_until()
-            if resp == (SerialCommands.ALREADY_CONNECTED.value + SerialCommands.EOT.value):
+        if resp == SerialCommands.HELLO.value:
+            resp = self._handshake(SerialCommands.ALREADY_CONNECTED)
+            if resp == SerialCommands.ALREADY_CONNECTED.value:
                 logger.info('Serial Connection established')
             elif resp == b'':
                 raise SerialCommunicationError('Timeout on initializing connection.')
             else:
                 raise SerialCommunicationError(f'Serial Connection received invalid response to ALREADY CONNECTED: {resp}')
-        elif resp == (SerialCommands.ALREADY_CONNECTED.value + SerialCommands.EOT.value):
+        elif resp == SerialCommands.ALREADY_CONNECTED.value:
             logger.warn('Serial Connection received ALREADY CONNECTED as response to HELLO. Assuming connection ok.')
         elif resp == b'':
             raise SerialCommunicationError('Timeout on initializing connection.')
@@ -171,40 +305,133 @@ class PizzaHAL:
         
         self.connected = True
     
+    def _handshake(self, command: SerialCommands) -> bytes:
+        """
+        Send a handshake command. Returns the response or `b''` on timeout.
+        """
+        fut = self.link.submit(command.value, ignore_lid=True)
+        try:
+            return fut.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            fut.cancel()
+            return b''
+
     def init_sounds(self, sounds: List=None):
         """
-        Load prerecorded Sounds into memory
+        Load prerecorded Sounds into memory. They are pinned in the cache.
 
         :param hal:
         :param sounds: A list of sound files
         """
-        if self.soundcache is None:
-            self.soundcache = {}
-
         if not mx.get_init():
             mx.init()
 
         if sounds is not None:
-            for sound in sounds:
-                self.soundcache[str(sound)] = mx.Sound(str(sound))
+            self.soundcache.pin(sounds)
 
     def init_camera(self):
         if self.camera is None:
-            self.camera = PiCamera(sensor_mode=5)
+            self.camera = CameraManager(metrics=self.metrics, preroll=self.preroll)
+
+    def init_backends(self, sounds: List=None) -> Future:
+        """
+        Initialize the mixer with `sounds` (see `init_sounds()`) and the
+        camera in a background thread, e.g. while `init_connection()` waits
+        for the microcontroller.
+
+        Returns a future, `result()` raises the exception if initialization failed.
+        """
+        def _init():
+            with phase('init_sounds'):
+                self.init_sounds(sounds)
+            with phase('init_camera'):
+                self.init_camera()
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hal-init')
+        fut = executor.submit(_init)
+        executor.shutdown(wait=False)
+        return fut
+
+    def play_sound(self, sound: Any):
+        """
+        Start playing a sound. Returns the `pygame.mixer.Channel` it plays on.
 
-    def play_sound(self, sound: str):
-        s = self.soundcache.get(sound, mx.Sound(sound))
-        s.play()
+        :param sound: A path or `fs_names.FileHandle`. Sound effects are pinned
+                      in the cache, recordings are dropped with the session.
+        """
+        filetype = getattr(sound, 'filetype', None)
+        s = self.soundcache.get(str(sound),
+                                pin=filetype is FileType.SFX,
+                                session=filetype is FileType.REC)
+        return s.play()
+
+    def wait_sound(self, channel) -> bool:
+        """
+        Block until the sound on `channel` ended or the lid was closed.
+
+        Sleeps on the lid event for the length of the sound, then checks the
+        channel every `SOUND_END_POLL` seconds until the mixer is done.
+
+        Returns `False` if the lid was closed.
+        """
+        if channel is None:
+            return not self.lid_closed.is_set()
+
+        sound = channel.get_sound()
+        end = perf_counter() + (sound.get_length() if sound is not None else 0)
+        while channel.get_busy():
+            if self.lid_closed.wait(max(end - perf_counter(), SOUND_END_POLL)):
+                return False
+        return not self.lid_closed.is_set()
 
     def stop_sound(self):
         if mx.get_busy():
             mx.stop()
 
+    def send_cmd_async(self, command: SerialCommands, *options, ignore_lid: bool=False) -> Future:
+        """
+        Send a command and optional options without waiting for the response.
+        Options need to be encoded as bytes before passing.
+
+        Returns a `concurrent.futures.Future` which resolves to the response
+        from the microcontroller, or `None` if the lid was closed and `ignore_lid` is `False`.
+
+        See `send_cmd()` for the exceptions the future may raise.
+        """
+        if not self.connected:
+            raise SerialCommunicationError("Serial Communication not initialized. Call `init_connection()` before `send_cmd()`.")
+
+        start = perf_counter()
+        fut = self.link.submit(command.value, *options, ignore_lid=ignore_lid)
+        fut.add_done_callback(lambda f: self._record_cmd(command, perf_counter() - start, f))
+        return fut
+
+    def _record_cmd(self, command: SerialCommands, latency: float, fut: Future):
+        """
+        Update `self.metrics` with the outcome of a command.
+        """
+        name = f'serial.{command.name}'
+        if fut.cancelled():
+            self.metrics.count(name + '.cancelled')
+        elif isinstance(fut.exception(), CommunicationError):
+            self.metrics.count(name + '.helo_aborts')
+        elif fut.exception() is not None:
+            self.metrics.count(name + '.errors')
+        elif fut.result() is None:
+            self.metrics.count(name + '.lid_aborts')
+        else:
+            self.metrics.time(name, latency)
+            # Number of empty reads a polling loop with `self.timeout` would have made
+            retries = int(latency // self.timeout)
+            if retries:
+                self.metrics.count(name + '.timeout_retries', retries)
+
     def send_cmd(self, command: SerialCommands, *options, ignore_lid: bool=False):
         """
         Send a command and optional options. Options need to be encoded as bytes before passing.
 
-        This function is blocking.
+        This function is blocking. The calling thread sleeps until the response arrives,
+        the lid is closed or HELO2 goes low; see `send_cmd_async()` for a non-blocking variant.
 
         Returns the response from the microcontroller or `None` if the lid was closed and `ignore_lid` is `False`.
         
@@ -213,24 +440,10 @@ class PizzaHAL:
         
         Raises a CommunicationError if the HELO2 pin goes low while waiting for response.
         """
-        if not self.connected:
-            raise SerialCommunicationError("Serial Communication not initialized. Call `init_connection()` before `send_cmd()`.")
+        resp = self.send_cmd_async(command, *options, ignore_lid=ignore_lid).result()
 
-        self.serialcon.write(command.value)
-        for o in options:
-            self.serialcon.write(o)
-        
-        self.serialcon.write(SerialCommands.EOT.value)   
-        resp = b''
-        while resp == b'':
-            # If serial communication timeout occurs, response is empty.
-            # Read again to allow for longer waiting times
-            if not self.pin_helo2.value:
-                raise CommunicationError('Pin HELO2 LOW. Microcontroller in error state or lost connection.')
-            if (not ignore_lid) and (not self.lid_open):
-                logger.info('Lid closed while processing command. Returning None.')
-                return None
-            resp = self.serialcon.read_until()
+        if resp is None:
+            return None
 
         logger.debug(f'hal.send_cmd() received {resp}')
 
@@ -239,27 +452,66 @@ class PizzaHAL:
         
         return resp
 
+    def queue_cmd(self, command: SerialCommands, *options, ignore_lid: bool=False) -> Future:
+        """
+        Send a command without waiting for the response. Queued commands are pipelined:
+        up to `max_outstanding` commands are on the wire at once (one with the line protocol).
+
+        Returns the future of the command. Call `flush_queue()` to wait for all queued commands.
+        """
+        fut = self.send_cmd_async(command, *options, ignore_lid=ignore_lid)
+        self._queued.append(fut)
+        return fut
+
+    def flush_queue(self, command: SerialCommands = SerialCommands.DO_IT, ignore_lid: bool=False):
+        """
+        Queue `command`, then wait for the responses to all queued commands.
+
+        Returns the response to `command`, or `None` if the lid was closed
+        while processing one of the queued commands.
+
+        Raises the same exceptions as `send_cmd()`.
+        """
+        self.queue_cmd(command, ignore_lid=ignore_lid)
+        queued, self._queued = self._queued, []
+
+        responses = [fut.result() for fut in queued]
+        logger.debug(f'hal.flush_queue() received {responses}')
+
+        if any(resp is None for resp in responses):
+            return None
+
+        for resp in responses:
+            if not resp.startswith(SerialCommands.RECEIVED.value):
+                raise SerialCommunicationError(f'Serial Communication received unexpected response: {resp}')
+
+        return responses[-1]
+
     def flush_serial(self):
         """
         Clear the serial connection from unhandled responses.
         """
-        self.serialcon.read_all()
+        self.link.flush()
 
 
 def set_movement(hal: PizzaHAL, 
          scroll: Scrolls,
          steps: int,
          speed: int,
+         queue: bool = True,
          **kwargs):
     """
     Move the motor controlling the vertical scroll a given distance.
 
+    :param queue: `True` to queue the command until the next `do_it()` (default).
+                  Returns the future of the command.
     """
     scroll = int(scroll.value)
-    hal.send_cmd(SerialCommands.SET_MOVEMENT,
-                 scroll.to_bytes(1, 'little', signed=False),
-                 steps.to_bytes(2, 'little', signed=True),
-                 speed.to_bytes(1, 'little', signed=False))
+    send = hal.queue_cmd if queue else hal.send_cmd
+    return send(SerialCommands.SET_MOVEMENT,
+                scroll.to_bytes(1, 'little', signed=False),
+                steps.to_bytes(2, 'little', signed=True),
+                speed.to_bytes(1, 'little', signed=False))
 
 
 def rewind(hal: PizzaHAL, **kwargs):
@@ -321,7 +573,7 @@ def wait_for_input(hal: PizzaHAL,
 
     if sound is not None:
         logger.debug(f'Waiting for user, playing sound {sound}.')
-        hal.play_sound(str(sound))
+        hal.play_sound(sound)
 
     resp = hal.send_cmd(SerialCommands.USER_INTERACT, bitmask.to_bytes(1, 'little', signed=False), timeout.to_bytes(4, 'little', signed=False))
 
@@ -335,8 +587,8 @@ def wait_for_input(hal: PizzaHAL,
         hal.send_cmd(SerialCommands.ABORT, ignore_lid=True)
         return
 
-    if len(resp) != 3:
-        raise SerialCommunicationError(f'USER_INTERACTION expects 3 bytes, received {resp}')
+    if len(resp) != 2:
+        raise SerialCommunicationError(f'USER_INTERACTION expects 2 bytes, received {resp}')
     
     resp = resp[1]
     if resp == 1:
@@ -358,6 +610,7 @@ def set_light(hal: PizzaHAL,
           b: float, 
           w: float, 
           fade: float = 0.0,
+          queue: bool = True,
           **kwargs):
     """
     Turn on the light to illuminate the upper scroll
@@ -365,22 +618,25 @@ def set_light(hal: PizzaHAL,
     :param hal: The hardware abstraction object
     :param fade: float
                 Default 0, time in seconds to fade in or out
+    :param queue: `True` to queue the command until the next `do_it()` (default).
+                  Returns the future of the command.
     """
     # convert color to 32bit number
     color = (int(w * 255) << 24) | (int(b * 255) << 16) | (int(g * 255) << 8) | (int(r * 255))
 
-    hal.send_cmd(SerialCommands.SET_LIGHT,
-                 int(light.value).to_bytes(1, 'little'), 
-                 int(color).to_bytes(4, 'little'), 
-                 int(fade * 1000).to_bytes(4, 'little'),
-                 ignore_lid=kwargs.get('ignore_lid', False))
+    send = hal.queue_cmd if queue else hal.send_cmd
+    return send(SerialCommands.SET_LIGHT,
+                int(light.value).to_bytes(1, 'little'), 
+                int(color).to_bytes(4, 'little'), 
+                int(fade * 1000).to_bytes(4, 'little'),
+                ignore_lid=kwargs.get('ignore_lid', False))
 
 
 def do_it(hal: PizzaHAL, ignore_lid: bool=False, **kwargs):
     """
-    Execute set commands
+    Execute set commands. Waits for all queued commands to be received.
     """
-    if hal.send_cmd(SerialCommands.DO_IT, ignore_lid=ignore_lid) is None:
+    if hal.flush_queue(SerialCommands.DO_IT, ignore_lid=ignore_lid) is None:
         logger.info('Lid closed during do_it(). Sending ABORT.')
         hal.flush_serial()
         hal.send_cmd(SerialCommands.ABORT, ignore_lid=True)
@@ -393,12 +649,8 @@ def play_sound(hal: PizzaHAL, sound: Any, **kwargs):
     :param hal: The hardware abstraction object
     :param sound: The sound to be played
     """
-    # Extract data and sampling rate from file
     try:
-        hal.play_sound(str(sound))
-        while mx.get_busy() and hal.lid_open:
-            pass
-        if not hal.lid_open:
+        if not hal.wait_sound(hal.play_sound(sound)):
             hal.stop_sound()
 
     except KeyboardInterrupt:
@@ -406,28 +658,70 @@ def play_sound(hal: PizzaHAL, sound: Any, **kwargs):
         logger.debug('skipped playback')
 
 
+# soundfile subtypes of the recordings by file extension and sample format.
+# FLAC stores integers of at most 24 bit, float samples are converted to 24 bit.
+_REC_SUBTYPES = {
+    'wav': {'int16': 'PCM_16',
+            'int32': 'PCM_24',
+            'float32': 'FLOAT',
+            'float64': 'DOUBLE'},
+    'flac': {'int16': 'PCM_16',
+             'int32': 'PCM_24',
+             'float32': 'PCM_24',
+             'float64': 'PCM_24'},
+}
+
+
+def rec_subtype(filename: Any, dtype: str) -> str:
+    """
+    Returns the `soundfile` subtype to record `dtype` samples to `filename`.
+
+    Raises a ConfigurationException if the file format or sample format is not supported.
+    """
+    name = str(getattr(filename, 'name', filename))
+    ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    subtypes = _REC_SUBTYPES.get(ext)
+    if subtypes is None:
+        raise ConfigurationException(f'Cannot record to {name}: '
+                                     f'Use one of {", ".join("." + e for e in _REC_SUBTYPES)}')
+    if dtype not in subtypes:
+        raise ConfigurationException(f'Cannot record {dtype!r} samples to {name}: '
+                                     f'Use one of {", ".join(subtypes)}')
+    return subtypes[dtype]
+
+
 def record_sound(hal: PizzaHAL, filename: Any, 
                  duration: float,
-                 cache: bool = False, **kwargs):
+                 cache: bool = False,
+                 samplerate: int = AUDIO_REC_SR,
+                 channels: int = AUDIO_REC_CHANNELS,
+                 dtype: str = AUDIO_REC_DTYPE,
+                 **kwargs):
     """
     Record sound using the microphone
 
     :param hal: The hardware abstraction object
-    :param filename: The path of the file to record to
+    :param filename: The path of the file to record to. The extension selects
+                     the format, e.g. `.wav` or `.flac` (encoded while recording)
     :param duration: The time to record in seconds
     :param cache: `True` to save recording to cache. Default is `False`
+    :param samplerate: Sample rate in Hz
+    :param channels: Number of channels
+    :param dtype: Sample format: `int16`, `int32`, `float32` or `float64`, see `rec_subtype()`
     """
-    myrecording = sd.rec(int(duration * AUDIO_REC_SR),
-                         samplerate=AUDIO_REC_SR,
-                         channels=2,
-                         latency=0.2,   # reduce risk of buffer underruns (?)
-                         )
-    
-    resp = hal.send_cmd(SerialCommands.RECORD, int(duration*1000).to_bytes(4, 'little', signed=False))
-
-    sd.stop()
-    
-    writewav(str(filename), AUDIO_REC_SR, myrecording)
+    subtype = rec_subtype(filename, dtype)
+    # Streams to disk until the command returns, also if the lid is closed early.
+    # The rest of the file is written in the background.
+    recorder = AudioRecorder(filename,
+                             samplerate=samplerate,
+                             channels=channels,
+                             dtype=dtype,
+                             subtype=subtype,
+                             keep=cache).start()
+    try:
+        resp = hal.send_cmd(SerialCommands.RECORD, int(duration*1000).to_bytes(4, 'little', signed=False))
+    finally:
+        recorder.stop(wait=False)
 
     if resp is None:
         logger.info('Lid closed during record(). Sending ABORT.')
@@ -436,48 +730,94 @@ def record_sound(hal: PizzaHAL, filename: Any,
         return
 
     if cache:
-        hal.soundcache[str(filename)] = mx.Sound(str(filename))
+        # Hand the samples to the mixer directly instead of decoding the file again
+        hal.soundcache.put(str(filename), _to_mixer(recorder.data, samplerate), session=True)
 
 
-def record_video(hal: PizzaHAL, filename: Any, duration: float, sound: Any=None, **kwargs):
+def record_video(hal: PizzaHAL, filename: Any, duration: float, sound: Any=None,
+                 audio: bool=True, **kwargs) -> dict:
     """
-    Record video using the camera
+    Record video using the camera, and audio using the microphone
+
+    The streams are muxed later by post-processing. All start times are
+    taken from `perf_counter()`, the returned offsets are relative to the
+    start of the video.
 
     :param hal: The hardware abstraction object
     :param filename: The path of the file to record to
     :param duration: The time to record in seconds
+    :param sound: Sound to play during the recording, added as a separate audio track
+    :param audio: `False` to record the video only
+    :return: The recorded tracks, see `postprocess.video_job()`
+
+    With pre-roll enabled (see `PizzaHAL.preroll`), the video from before the
+    call is saved to a separate `.pre.h264` file.
     """
-    hal.camera.resolution = VIDEO_RES
-    hal.camera.start_recording(str(filename))
-    start_time = time()
-    logger.debug(f'Started recording at {start_time}')
-    
-    if sound is not None:
-        hal.play_sound(str(sound))
+    filename = str(filename)
+    capture = {'video': filename}
 
-    t = 0
-    while hal.lid_open and (t < duration):
-        hal.camera.wait_recording(0.1)
-        t += 0.1
-    
-    if mx.get_busy():
-        hal.stop_sound()
+    recorder = None
+    try:
+        if audio:
+            capture['audio'] = filename.rsplit('.', 1)[0] + '.mic.flac'
+            recorder = AudioRecorder(capture['audio'],
+                                     samplerate=AUDIO_REC_SR,
+                                     channels=AUDIO_REC_CHANNELS,
+                                     dtype=AUDIO_REC_DTYPE,
+                                     subtype=rec_subtype(capture['audio'], AUDIO_REC_DTYPE)).start()
+
+        video_start, prefile = hal.camera.start_recording(filename)
+        if prefile is not None:
+            capture['preroll'] = prefile
+        logger.debug(f'Started recording at {video_start}')
+        
+        if sound is not None:
+            capture['sound'] = str(sound)
+            capture['sound_offset'] = perf_counter() - video_start
+            hal.play_sound(sound)
+
+        t = 0
+        while hal.lid_open and (t < duration):
+            hal.camera.wait_recording(0.1)
+            t += 0.1
+        
+        if mx.get_busy():
+            hal.stop_sound()
+
+        hal.camera.stop_recording()
+    finally:
+        if recorder is not None:
+            recorder.stop()
+    end_time = perf_counter()
+    logger.debug(f'Ended recording at {end_time}; took {end_time - video_start}s')
 
-    hal.camera.stop_recording()
-    end_time = time()
-    logger.debug(f'Ended recording at {end_time}; took {end_time - start_time}s')
+    capture['duration'] = end_time - video_start
+    if (recorder is not None) and (recorder.start_time is not None):
+        capture['audio_offset'] = recorder.start_time - video_start
+    else:
+        capture.pop('audio', None)
+    return capture
 
 
-def take_photo(hal: PizzaHAL, filename: Any, **kwargs):
+def take_photo(hal: PizzaHAL, filename: Any, video_port: bool=None, keystone: bool=True,
+               burst: int=1, rate: float=BURST_RATE, **kwargs):
     """
-    Take a foto with the camera
+    Take a foto with the camera. The photo is captured to memory, keystone
+    correction, encoding and writing happen in the background.
 
     :param hal: The hardware abstraction object
     :param filename: The path of the filename for the foto
+    :param video_port: See `CameraManager.capture()`
+    :param keystone: `False` to save the photo as captured. Only video port photos are corrected
+    :param burst: Number of photos to take from the video port. Only the sharpest is saved.
+    :param rate: Photos per second in a burst
     """
     if not hal.lid_open:
         return
     
-    hal.camera.resolution = PHOTO_RES
-    hal.camera.capture(str(filename))
-
+    if burst > 1:
+        images = hal.camera.capture_burst(burst, rate=rate)
+        hal.photos.submit_sharpest(images, filename, keystone=keystone)
+    else:
+        image = hal.camera.capture_array(video_port=video_port)
+        hal.photos.submit(image, filename, keystone=keystone)
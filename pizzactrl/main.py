@@ -1,13 +1,17 @@
-from email.policy import default
 import sys
+import signal
 
 import click
 import logging
 
-from pizzactrl.statemachine import Statemachine, State
-from pizzactrl.sb_berlin import STORYBOARD
-from pizzactrl.hal_serial import PizzaHAL
-from pizzactrl.storyboard import Language
+from pizzactrl import startup
+
+with startup.phase('import pizzactrl.main'):
+    from pizzactrl.statemachine import Statemachine, State
+    from pizzactrl.hal_serial import PizzaHAL, VIDEO_PREROLL
+    from pizzactrl.storyboard import Language
+    from pizzactrl.sb_loader import load_storyboard, DEFAULT_STORYBOARD
+    from pizzactrl.postprocess import PROFILES
 
 logger = logging.getLogger('pizzactrl.main')
 
@@ -17,21 +21,44 @@ logger = logging.getLogger('pizzactrl.main')
 @click.option('--debug', is_flag=True, default=False)
 @click.option('--loop', is_flag=True, default=False)
 @click.option('--lang', default=3, help='Number of languages. Range 0..3')
-def main(test: bool=False, debug: bool=False, loop: bool=False, lang: int=3):
+@click.option('--framed', is_flag=True, default=False, help='Use the framed serial protocol (needs firmware support)')
+@click.option('--stats', is_flag=True, default=False, help='Log latency and traffic metrics on exit')
+@click.option('--profile', type=click.Choice(list(PROFILES)), default=None, help='Video post-processing profile')
+@click.option('--storyboard', default=DEFAULT_STORYBOARD, help='Storyboard file (.json) or module')
+@click.option('--preroll', type=float, default=VIDEO_PREROLL, help='Seconds of video to keep from before a recording starts')
+@click.option('--profile-startup', is_flag=True, default=False,
+              help='Start up until ready (after POST), print the import and init times and exit')
+def main(test: bool=False, debug: bool=False, loop: bool=False, lang: int=3, framed: bool=False, stats: bool=False,
+         profile: str=None, storyboard: str=DEFAULT_STORYBOARD, preroll: float=VIDEO_PREROLL,
+         profile_startup: bool=False):
     if debug or test:
         logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
     else:
         logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
-    hal = PizzaHAL()
-    sm = Statemachine(hal, STORYBOARD, loop=loop, test=test, lang_select=lang, default_lang=Language.DE)
+    with startup.phase('load storyboard'):
+        story = load_storyboard(storyboard)
+
+    with startup.phase('PizzaHAL()'):
+        hal = PizzaHAL(framed=framed, preroll=preroll)
+    # `kill -USR1 <pid>` logs the metrics collected so far
+    signal.signal(signal.SIGUSR1, lambda signum, frame: logger.info(hal.metrics.dump()))
+
+    sm = Statemachine(hal, story, loop=loop, test=test, lang_select=lang, default_lang=Language.DE,
+                      profile=profile)
     
     exitcode = 0
     try:
-        sm.run()
+        if profile_startup:
+            sm.run(until=State.POST)
+            print(startup.report())
+        else:
+            sm.run()
     finally:
         if sm.state is State.ERROR:
             exitcode = 2
+        if stats:
+            logger.info(hal.metrics.dump())
         del sm
         sys.exit(exitcode)
 
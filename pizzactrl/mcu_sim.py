@@ -0,0 +1,392 @@
+"""
+A virtual microcontroller implementing the serial protocol of `hal_serial`
+on a pseudo-terminal, so `PizzaHAL` can run without the pizza box hardware.
+"""
+import os
+import sys
+import tty
+import select
+import logging
+import threading
+
+from queue import Queue, Empty
+from time import sleep, perf_counter
+from typing import Dict, Iterable, Optional, Tuple
+
+import click
+
+from .gpio_pins import *
+from .framing import FrameCodec
+
+logger = logging.getLogger(__name__)
+
+# Command bytes, see `hal_serial.SerialCommands`
+HELLO = 0x00
+ALREADY_CONNECTED = 0x01
+ERROR = 0x02
+RECEIVED = 0x03
+ABORT = 0x63
+SET_MOVEMENT = ord('M')
+SET_LIGHT = ord('L')
+DO_IT = ord('D')
+USER_INTERACT = ord('U')
+RECORD = ord('C')
+REWIND = ord('R')
+RESET = ord('X')
+DEBUG_SCROLL = ord('S')
+DEBUG_SENSORS = ord('Z')
+
+EOT = 0x0A
+
+# Payload length of each command in the line protocol
+PAYLOAD_LEN = {
+    SET_MOVEMENT: 4,    # scroll, steps (int16), speed
+    SET_LIGHT: 9,       # light, color (uint32), fade in ms (uint32)
+    USER_INTERACT: 5,   # button bitmask, timeout in ms (uint32)
+    RECORD: 4,          # duration in ms (uint32)
+}
+
+# Buttons as reported in the response to USER_INTERACT
+BLUE = 1
+RED = 2
+YELLOW = 4
+GREEN = 8
+
+
+class VirtualMCU:
+    """
+    Simulates the microcontroller on a pseudo-terminal. Pass `port` to
+    `PizzaHAL(serialdev=...)`.
+
+    Commands are processed in order, like on the real board. USER_INTERACT,
+    RECORD and DO_IT take time and can be interrupted by ABORT; the
+    interrupted command is not answered.
+
+    - `latency` sets the response delay per command byte (seconds)
+    - `buttons` scripts the user: one `(delay, button)` entry is used per
+      USER_INTERACT. `button=None` lets it time out.
+    - `realtime=True` makes DO_IT take as long as its moves and fades;
+      `step_time` is the time of one scroll step at speed 1
+    """
+    def __init__(self,
+                 framed: bool = False,
+                 latency: Dict[int, float] = None,
+                 default_latency: float = 0.0,
+                 buttons: Iterable[Tuple[float, Optional[int]]] = (),
+                 realtime: bool = False,
+                 step_time: float = 0.02):
+        self.framed = framed
+        self.latency = latency or {}
+        self.default_latency = default_latency
+        self.realtime = realtime
+        self.step_time = step_time
+
+        self._buttons = Queue()
+        for delay, button in buttons:
+            self.press(button, delay)
+
+        self.connected = False
+        self.position = [0, 0]       # Horizontal, vertical scroll
+        self.lights = [0, 0]         # Backlight, frontlight color
+        self._moves = []
+        self._fades = []
+
+        self.received = []           # Log of all (command, payload) received
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._codec = FrameCodec() if framed else None
+        self._rxbuf = bytearray()
+
+        self._commands = Queue()
+        self._abort = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self.pins = None
+
+    def start(self):
+        for target, name in ((self._read_loop, 'mcu-sim-reader'),
+                             (self._process_loop, 'mcu-sim')):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._abort.set()
+        self._commands.put(None)
+        for t in self._threads:
+            t.join(1)
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def press(self, button: Optional[int], delay: float = 0.0):
+        """
+        Script a button press for the next USER_INTERACT which does not have
+        a scripted press yet.
+        """
+        self._buttons.put((delay, button))
+
+    def attach_pins(self, factory):
+        """
+        Drive fake HELO2 and lid pins on a `gpiozero.pins.mock.MockFactory`.
+        HELO2 follows HELO1 like on the real board. The lid starts open.
+
+        Call this after creating the `PizzaHAL`: its lid switch button pulls
+        the pin up, which closes the lid again.
+        """
+        self.pins = factory
+        self.open_lid()
+
+    def open_lid(self):
+        # The lid switch is a button with pull-up; pressed (low) means open
+        self.pins.pin(LID_SWITCH).drive_low()
+
+    def close_lid(self):
+        self.pins.pin(LID_SWITCH).drive_high()
+
+    def _update_pins(self):
+        if self.pins is None:
+            return
+        helo1 = bool(self.pins.pin(HELO1).state)
+        helo2 = self.pins.pin(HELO2)
+        if helo1 and not helo2.state:
+            helo2.drive_high()
+        elif (not helo1) and helo2.state:
+            self.connected = False
+            helo2.drive_low()
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            self._update_pins()
+            try:
+                ready, _, _ = select.select([self._master], [], [], 0.01)
+                if not ready:
+                    continue
+                data = os.read(self._master, 512)
+            except OSError:
+                return
+            for seq, command, payload in self._decode(data):
+                self.received.append((command, payload))
+                if command == ABORT:
+                    self._abort.set()
+                self._commands.put((seq, command, payload))
+
+    def _decode(self, data: bytes):
+        if self._codec is not None:
+            yield from self._codec.feed(data)
+            return
+
+        self._rxbuf += data
+        while self._rxbuf:
+            command = self._rxbuf[0]
+            n = PAYLOAD_LEN.get(command, 0)
+            if len(self._rxbuf) < n + 2:
+                return
+            payload = bytes(self._rxbuf[1:n + 1])
+            if self._rxbuf[n + 1] != EOT:
+                logger.warning(f'VirtualMCU expected EOT after command {command}')
+            del self._rxbuf[:n + 2]
+            yield None, command, payload
+
+    def _send(self, seq: Optional[int], command: int, payload: bytes = b''):
+        if self._codec is not None:
+            data = bytes(self._codec.encode(seq or 0, command, payload))
+        else:
+            data = bytes((command,)) + payload + bytes((EOT,))
+        try:
+            os.write(self._master, data)
+        except OSError:
+            pass
+
+    def _wait(self, seconds: float) -> bool:
+        """
+        Wait `seconds` (forever if `None`). Returns `False` if aborted.
+        """
+        return not self._abort.wait(seconds)
+
+    def _process_loop(self):
+        handlers = {
+            HELLO: self._hello,
+            ALREADY_CONNECTED: self._already_connected,
+            SET_MOVEMENT: self._set_movement,
+            SET_LIGHT: self._set_light,
+            DO_IT: self._do_it,
+            USER_INTERACT: self._user_interact,
+            RECORD: self._record,
+            REWIND: self._rewind,
+            RESET: self._reset,
+            ABORT: self._received,
+            DEBUG_SCROLL: self._received,
+            DEBUG_SENSORS: self._received,
+        }
+        while True:
+            item = self._commands.get()
+            if item is None:
+                return
+            seq, command, payload = item
+
+            delay = self.latency.get(command, self.default_latency)
+            if delay:
+                sleep(delay)
+
+            if command == ABORT:
+                self._abort.clear()
+            handler = handlers.get(command)
+            if handler is None:
+                logger.warning(f'VirtualMCU received unknown command {command}')
+                self._send(seq, ERROR)
+                continue
+            resp = handler(payload)
+            if resp is not None:
+                self._send(seq, *resp)
+
+    def _received(self, payload: bytes):
+        return (RECEIVED,)
+
+    def _hello(self, payload: bytes):
+        return (ALREADY_CONNECTED if self.connected else HELLO,)
+
+    def _already_connected(self, payload: bytes):
+        self.connected = True
+        return (ALREADY_CONNECTED,)
+
+    def _set_movement(self, payload: bytes):
+        scroll = payload[0]
+        steps = int.from_bytes(payload[1:3], 'little', signed=True)
+        speed = payload[3]
+        self._moves.append((scroll, steps, speed))
+        return (RECEIVED,)
+
+    def _set_light(self, payload: bytes):
+        light = payload[0]
+        color = int.from_bytes(payload[1:5], 'little')
+        fade = int.from_bytes(payload[5:9], 'little') / 1000
+        self._fades.append((light, color, fade))
+        return (RECEIVED,)
+
+    def _do_it(self, payload: bytes):
+        duration = 0.0
+        for scroll, steps, speed in self._moves:
+            self.position[scroll] += steps
+            duration = max(duration, abs(steps) * self.step_time / max(speed, 1))
+        for light, color, fade in self._fades:
+            self.lights[light] = color
+            duration = max(duration, fade)
+        self._moves.clear()
+        self._fades.clear()
+        if not self._wait(duration if self.realtime else 0):
+            return None
+        return (RECEIVED,)
+
+    def _user_interact(self, payload: bytes):
+        bitmask = payload[0]
+        timeout = int.from_bytes(payload[1:5], 'little') / 1000 or None
+        try:
+            delay, button = self._buttons.get_nowait()
+        except Empty:
+            delay, button = None, None
+
+        if (button is not None) and (button & bitmask) and ((timeout is None) or (delay < timeout)):
+            if not self._wait(delay):
+                return None
+            return RECEIVED, bytes((button,))
+
+        if not self._wait(timeout):
+            return None
+        return RECEIVED, b'\x00'
+
+    def _record(self, payload: bytes):
+        if not self._wait(int.from_bytes(payload, 'little') / 1000):
+            return None
+        return (RECEIVED,)
+
+    def _rewind(self, payload: bytes):
+        self.position = [0, 0]
+        return (RECEIVED,)
+
+    def _reset(self, payload: bytes):
+        self.connected = False
+        return (RECEIVED,)
+
+
+def use_mock_pins():
+    """
+    Replace the GPIO pins of gpiozero by mock pins. Returns the pin factory.
+    """
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory
+
+    Device.pin_factory = MockFactory()
+    return Device.pin_factory
+
+
+def _percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+@click.command()
+@click.option('--count', default=200, help='Number of round trips per measurement')
+@click.option('--latency', default=0.0, help='Simulated MCU response latency in seconds')
+@click.option('--framed', is_flag=True, default=False, help='Use the framed serial protocol')
+@click.option('--debug', is_flag=True, default=False)
+def main(count: int = 200, latency: float = 0.0, framed: bool = False, debug: bool = False):
+    """
+    Run PizzaHAL against the virtual microcontroller and measure round trip
+    latency and throughput of the serial protocol.
+    """
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO, stream=sys.stdout)
+
+    from . import hal_serial as hs
+
+    pins = use_mock_pins()
+    with VirtualMCU(framed=framed, default_latency=latency) as mcu:
+        hal = hs.PizzaHAL(serialdev=mcu.port, framed=framed)
+        mcu.attach_pins(pins)
+        hal.init_connection()
+
+        def _measure(name, func):
+            times = []
+            start = perf_counter()
+            for _ in range(count):
+                t = perf_counter()
+                func()
+                times.append(perf_counter() - t)
+            total = perf_counter() - start
+            click.echo(f'{name:<24} mean {1000 * total / count:7.3f}ms  '
+                       f'p50 {1000 * _percentile(times, 50):7.3f}ms  '
+                       f'p99 {1000 * _percentile(times, 99):7.3f}ms  '
+                       f'{count / total:8.1f}/s')
+
+        _measure('send_cmd(DEBUG_SCROLL)', lambda: hal.send_cmd(hs.SerialCommands.DEBUG_SCROLL))
+        _measure('light + do_it', lambda: (hs.set_light(hal, hs.Lights.FRONTLIGHT, 1, 1, 1, 1, 0.01),
+                                           hs.do_it(hal)))
+        _measure('parallel (4) + do_it', lambda: (hs.set_light(hal, hs.Lights.FRONTLIGHT, 1, 1, 1, 1, 0.01),
+                                                  hs.set_light(hal, hs.Lights.BACKLIGHT, 0, 0, 0, 0, 0.01),
+                                                  hs.set_movement(hal, hs.Scrolls.HORIZONTAL, 10, 3),
+                                                  hs.set_movement(hal, hs.Scrolls.VERTICAL, -10, 3),
+                                                  hs.do_it(hal)))
+        hal.link.stop()
+        click.echo(hal.metrics.dump())
+
+    # Commands which were aborted or failed are not timed, so the numbers above would be meaningless
+    failed = [command.name for command in (hs.SerialCommands.DEBUG_SCROLL, hs.SerialCommands.SET_LIGHT,
+                                           hs.SerialCommands.SET_MOVEMENT, hs.SerialCommands.DO_IT)
+              if not hal.metrics.histogram(f'serial.{command.name}').count]
+    if failed:
+        raise click.ClickException(f'No successful round trips for {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import logging
+import threading
+
+from collections import defaultdict
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of durations with log-linear buckets.
+
+    Values are recorded in microseconds. Below `2**sub_bits` µs every value
+    has its own bucket, above that each power of two is split into
+    `2**(sub_bits - 1)` buckets, so the relative error is below
+    `2**(1 - sub_bits)` (1.6% with the default). Recording is O(1).
+    """
+    def __init__(self, sub_bits: int = 7, max_seconds: float = 3600.0):
+        self.sub_bits = sub_bits
+        self._half = 1 << (sub_bits - 1)
+        max_us = int(max_seconds * 1e6)
+        self.counts = [0] * (self._index(max_us) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, us: int) -> int:
+        shift = us.bit_length() - self.sub_bits
+        if shift <= 0:
+            return us
+        return (shift + 1) * self._half + (us >> shift) - self._half
+
+    def _value(self, index: int) -> int:
+        """
+        Lower bound in µs of the bucket at `index`.
+        """
+        if index < 2 * self._half:
+            return index
+        shift = index // self._half - 1
+        return (index - shift * self._half) << shift
+
+    def record(self, seconds: float):
+        us = int(seconds * 1e6)
+        index = min(self._index(max(us, 0)), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if (self.min is None) or (seconds < self.min):
+            self.min = seconds
+        if (self.max is None) or (seconds > self.max):
+            self.max = seconds
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns the value in seconds below which `p` percent of the recorded values are.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(p / 100 * self.count)))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self._value(index) / 1e6, self.max)
+        return self.max
+
+    def __str__(self) -> str:
+        return (f'n={self.count} mean={1000 * self.mean:.2f}ms '
+                f'p50={1000 * self.percentile(50):.2f}ms '
+                f'p90={1000 * self.percentile(90):.2f}ms '
+                f'p99={1000 * self.percentile(99):.2f}ms '
+                f'max={1000 * (self.max or 0):.2f}ms')
+
+
+class Metrics:
+    """
+    Counters and latency histograms, addressed by dotted names like
+    `serial.SET_LIGHT` or `activity.PLAY_SOUND`.
+
+    Cheap enough to stay enabled in production. Use `dump()` to get a report.
+
+    Updates come from the event loop, the caller threads and the worker
+    threads, so they are made under a lock. The lock is reentrant: a signal
+    handler calling `dump()` runs on the main thread, which may be holding it.
+    """
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.RLock()
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _histogram(self, name: str) -> LatencyHistogram:
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = LatencyHistogram()
+        return hist
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        with self._lock:
+            return self._histogram(name)
+
+    def time(self, name: str, seconds: float):
+        """
+        Record a duration in the histogram `name`.
+        """
+        with self._lock:
+            self._histogram(name).record(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def dump(self) -> str:
+        """
+        Returns all counters and histograms as a human readable report.
+        """
+        lines = ['Metrics:']
+        with self._lock:
+            for name in sorted(self.histograms):
+                lines.append(f'  {name:<32} {self.histograms[name]}')
+            for name in sorted(self.counters):
+                lines.append(f'  {name:<32} {self.counters[name]}')
+        return '\n'.join(lines)
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import os
+import logging
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from time import perf_counter
+from typing import Any, List, Tuple
+
+from .camera import KEYSTONE_COORDS, VIDEO_RES
+from .startup import LazyModule
+
+logger = logging.getLogger(__name__)
+
+np = LazyModule('numpy')
+Image = LazyModule('PIL.Image')
+
+PHOTO_QUALITY = 90            # JPEG quality of photos
+
+
+def _homography(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """
+    Returns the 3x3 matrix mapping the 4 points `src` to `dst`.
+    """
+    a = []
+    b = []
+    for (x, y), (u, v) in zip(src, dst):
+        a.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        a.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        b += [u, v]
+    h = np.linalg.solve(np.array(a, dtype=np.float64), np.array(b, dtype=np.float64))
+    return np.append(h, 1.0).reshape(3, 3)
+
+
+@lru_cache(maxsize=4)
+def keystone_lut(width: int, height: int, coords: Tuple = KEYSTONE_COORDS) -> np.ndarray:
+    """
+    Returns the source pixel index of every pixel of a corrected image, like
+    ffmpeg's `rotate=PI,perspective` in post-processing: The image is
+    rotated by 180°, then `coords` (top left, top right, bottom left,
+    bottom right, given for `VIDEO_RES`) are stretched to the corners.
+
+    Nearest neighbour, indices into the flattened `height x width` image.
+    """
+    scale = np.array([width / VIDEO_RES[0], height / VIDEO_RES[1]])
+    src = np.array(coords, dtype=np.float64) * scale
+    corners = np.array([(0, 0), (width, 0), (0, height), (width, height)], dtype=np.float64)
+    h = _homography(corners, src)
+
+    u, v = np.meshgrid(np.arange(width, dtype=np.float64) + 0.5,
+                       np.arange(height, dtype=np.float64) + 0.5)
+    w = h[2, 0] * u + h[2, 1] * v + h[2, 2]
+    x = (h[0, 0] * u + h[0, 1] * v + h[0, 2]) / w
+    y = (h[1, 0] * u + h[1, 1] * v + h[1, 2]) / w
+
+    # Position in the rotated image -> position in the captured image
+    x = np.clip(width - x, 0, width - 1).astype(np.int32)
+    y = np.clip(height - y, 0, height - 1).astype(np.int32)
+    return y * width + x
+
+
+def correct_keystone(image: np.ndarray) -> np.ndarray:
+    """
+    Returns `image` (height x width x channels) rotated and keystone corrected.
+
+    `KEYSTONE_COORDS` are measured on the field of view of the video port.
+    Images of another aspect ratio (the still port at `PHOTO_RES`) have a
+    different field of view and are returned as captured.
+    """
+    height, width = image.shape[:2]
+    if width * VIDEO_RES[1] != height * VIDEO_RES[0]:
+        logger.debug(f'No keystone correction for {width}x{height} photos')
+        return image
+    lut = keystone_lut(width, height)
+    return image.reshape(height * width, -1)[lut].reshape(image.shape)
+
+
+def sharpness(image: np.ndarray, step: int = 2) -> float:
+    """
+    Returns the variance of the Laplacian of the luminance of `image`.
+    Higher is sharper; motion blur and defocus lower it.
+
+    :param step: Only use every `step`th pixel in each direction, for speed
+    """
+    rgb = image[::step, ::step].astype(np.float32)
+    luma = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    laplacian = (luma[:-2, 1:-1] + luma[2:, 1:-1] + luma[1:-1, :-2] + luma[1:-1, 2:]
+                 - 4 * luma[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def sharpest(images: List[np.ndarray]) -> int:
+    """
+    Returns the index of the sharpest of `images`.
+    """
+    scores = [sharpness(image) for image in images]
+    logger.debug(f'Photo sharpness: {", ".join(f"{score:.1f}" for score in scores)}')
+    return int(np.argmax(scores))
+
+
+class PhotoWriter:
+    """
+    Corrects, encodes and writes photos in a background thread, so taking a
+    photo does not wait for the encoder or the disk.
+
+    Photos are written to a temporary file first and renamed when complete.
+    Queued photos are still written when the program exits.
+    """
+    def __init__(self, metrics=None, quality: int = PHOTO_QUALITY):
+        """
+        :param metrics: Optional `metrics.Metrics`
+        :param quality: JPEG quality
+        """
+        self.metrics = metrics
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='photo')
+
+    def submit(self, image: np.ndarray, filename: Any, keystone: bool = True) -> Future:
+        """
+        Queue `image` (RGB, height x width x 3) to be written to `filename`.
+        The format is chosen by the file extension.
+        """
+        return self._executor.submit(self._write, image, str(filename), keystone)
+
+    def submit_sharpest(self, images: List[np.ndarray], filename: Any, keystone: bool = True) -> Future:
+        """
+        Queue the sharpest of `images` to be written to `filename`, see `submit()`.
+        """
+        return self._executor.submit(lambda: self._write(images[sharpest(images)], str(filename), keystone))
+
+    def _write(self, image: np.ndarray, filename: str, keystone: bool):
+        start = perf_counter()
+        try:
+            if keystone:
+                image = correct_keystone(image)
+            base, ext = os.path.splitext(filename)
+            tmp = base + '.part' + ext
+            Image.fromarray(image).save(tmp, quality=self.quality)
+            os.replace(tmp, filename)
+        except Exception as e:
+            logger.error(f'Writing photo {filename} failed: {e}')
+            raise
+        if self.metrics is not None:
+            self.metrics.time('photo.write', perf_counter() - start)
+        logger.debug(f'Wrote {filename} in {perf_counter() - start:.2f}s')
+
+    def wait(self):
+        """
+        Wait until all queued photos are written.
+        """
+        self._executor.submit(lambda: None).result()
@@ -0,0 +1,471 @@
+import os
+import json
+import logging
+import resource
+import tempfile
+import threading
+import subprocess
+
+from time import time, time_ns, perf_counter
+from typing import List, Optional
+
+import click
+
+from .camera import KEYSTONE_COORDS
+
+logger = logging.getLogger(__name__)
+
+POSTPROCESS_NICE = 19         # Scheduling priority of post-processing (lowest)
+POSTPROCESS_RETRIES = 2       # Attempts before a job is moved to `failed/`
+PARTIAL_SUFFIX = '.part'      # Inserted before the extension of outputs being written
+
+AUDIO_CODEC = 'aac'           # Audio codec of the microphone and sound tracks
+AUDIO_BITRATE = '128k'
+
+# Post-processing profiles. `codec` options are passed to ffmpeg as they are,
+# `fallback` names the profile used if the encoder fails (e.g. no hardware support).
+PROFILES = {
+    'default': {'framerate': '30',          # Original .h264 video has 29.97fps (according to vlc), but 30fps works better
+                'codec': 'h264_v4l2m2m',    # Uses hardware support, makes conversion faster
+                'codec_options': ['-b:v', '4M'],  # Reduces artefacts
+                'interpolation': 'cubic',
+                'fallback': 'software-fallback'},
+    'fast-preview': {'framerate': '30',
+                     'codec': 'h264_v4l2m2m',
+                     'codec_options': ['-b:v', '2M'],
+                     'interpolation': 'linear',
+                     'fallback': 'software-fallback'},
+    'archival': {'framerate': '30',
+                 'codec': 'libx264',
+                 'codec_options': ['-preset', 'slow', '-crf', '18'],
+                 'interpolation': 'cubic',
+                 'fallback': None},
+    'software-fallback': {'framerate': '30',
+                          'codec': 'libx264',
+                          'codec_options': ['-preset', 'veryfast', '-crf', '23'],
+                          'interpolation': 'cubic',
+                          'fallback': None},
+}
+DEFAULT_PROFILE = 'default'
+
+
+def profile_params(profile: str) -> dict:
+    """
+    Returns the conversion parameters of a profile.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown post-processing profile {profile}, use one of {", ".join(PROFILES)}')
+    return dict(PROFILES[profile],
+                profile=profile,
+                keystone=[list(c) for c in KEYSTONE_COORDS],
+                audio_codec=AUDIO_CODEC,
+                audio_bitrate=AUDIO_BITRATE)
+
+
+def video_job(video: str,
+              audio: Optional[str] = None,
+              audio_offset: float = 0.0,
+              sound: Optional[str] = None,
+              sound_offset: float = 0.0,
+              duration: Optional[float] = None,
+              preroll: Optional[str] = None,
+              profile: str = DEFAULT_PROFILE) -> dict:
+    """
+    Returns a job converting the raw .h264 `video` to .mov, muxed with the
+    microphone recording and the sound played during the recording
+    (as separate audio tracks) in the same ffmpeg pass.
+
+    :param video: The raw video file
+    :param audio: The microphone recording, or `None`
+    :param audio_offset: Start of `audio` relative to the start of the video in seconds
+    :param sound: The sound played during the recording, or `None`
+    :param sound_offset: Start of `sound` relative to the start of the video in seconds
+    :param duration: Length of the recording in seconds, longer audio is cut
+    :param preroll: Raw video recorded before `video`, or `None`.
+                    Offsets and duration include the pre-roll.
+    :param profile: The post-processing profile, see `PROFILES`
+    """
+    return {'kind': 'video',
+            'input': video,
+            'output': video.split('.')[0] + '.mov',
+            'tracks': {'preroll': preroll,
+                       'audio': audio,
+                       'audio_offset': audio_offset,
+                       'sound': sound,
+                       'sound_offset': sound_offset,
+                       'duration': duration},
+            'params': profile_params(profile)}
+
+
+def job_inputs(job: dict) -> List[str]:
+    """
+    Returns the existing input files of a job, the video first.
+    """
+    tracks = job.get('tracks', {})
+    return [path for path in (job['input'], tracks.get('preroll'), tracks.get('audio'), tracks.get('sound'))
+            if (path is not None) and os.path.exists(path)]
+
+
+def partial_path(output: str) -> str:
+    """
+    Returns the path an output is written to before it is complete.
+    """
+    base, ext = os.path.splitext(output)
+    return base + PARTIAL_SUFFIX + ext
+
+
+def _offset_args(offset: float) -> List[str]:
+    """
+    Returns the input options to start an input `offset` seconds after the video.
+    A negative offset cuts the beginning instead, so the video still starts at 0.
+    """
+    if offset < 0:
+        return ['-ss', f'{-offset:.3f}']
+    return ['-itsoffset', f'{offset:.3f}']
+
+
+def video_command(job: dict, output: str) -> List[str]:
+    """
+    Returns the ffmpeg command for a video job, writing to `output`.
+    """
+    params = job['params']
+    tracks = job.get('tracks', {})
+    coords = params['keystone']
+    # ffmpeg -hide_banner -i <input.h264> -lavfi "rotate=PI[rotated];[rotated]perspective=x0=370:y0=42:x1=1581:y1=0:x2=485:y2=993:x3=1414:y3=700:interpolation=cubic" <output.mp4>
+    filter_string = ('[0:v]rotate=PI[rotated];[rotated]perspective='
+                     f'x0={coords[0][0]}:y0={coords[0][1]}:'
+                     f'x1={coords[1][0]}:y1={coords[1][1]}:'
+                     f'x2={coords[2][0]}:y2={coords[2][1]}:'
+                     f'x3={coords[3][0]}:y3={coords[3][1]}:'
+                     f'interpolation={params["interpolation"]}[v]')
+    inputs = job_inputs(job)
+    video = job['input']
+    if tracks.get('preroll') in inputs:
+        # Raw H.264 streams can be joined byte by byte
+        video = f'concat:{tracks["preroll"]}|{video}'
+
+    cmd = ['ffmpeg',
+           '-hide_banner', '-y',
+           '-framerate', params['framerate'],
+           '-i', video]
+    maps = ['-map', '[v]']
+
+    n_audio = 0
+    for name in ('audio', 'sound'):
+        if tracks.get(name) in inputs:
+            cmd += _offset_args(tracks[f'{name}_offset']) + ['-i', tracks[name]]
+            maps += ['-map', f'{n_audio + 1}:a',
+                     f'-metadata:s:a:{n_audio}', f'title={name}']
+            n_audio += 1
+
+    cmd += ['-lavfi', filter_string] + maps
+    cmd += ['-codec:v', params['codec']] + params['codec_options']
+    if n_audio:
+        cmd += ['-codec:a', params['audio_codec'],
+                '-b:a', params['audio_bitrate']]
+    if tracks.get('duration'):
+        cmd += ['-t', f'{tracks["duration"]:.3f}']
+    return cmd + [output]
+
+
+def job_key(job: dict) -> Optional[dict]:
+    """
+    Returns what the output of `job` depends on: the size and modification
+    time of the inputs, the track offsets and the conversion parameters.
+    `None` if the video does not exist.
+    """
+    inputs = job_inputs(job)
+    if (not inputs) or (inputs[0] != job['input']):
+        return None
+    stats = [os.stat(path) for path in inputs]
+    return {'inputs': [[path, st.st_size, st.st_mtime_ns] for path, st in zip(inputs, stats)],
+            'tracks': job.get('tracks'),
+            'params': job.get('params')}
+
+
+class Manifest:
+    """
+    Record of completed jobs, keyed by output path.
+
+    An output is up to date if its job key is unchanged and the output file
+    still has the size it had when it was completed. Outputs are written to
+    a partial file first and renamed when done, so a crash never leaves a
+    truncated output behind that looks complete.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_current(self, job: dict, key: Optional[dict] = None) -> bool:
+        entry = self.entries.get(job['output'])
+        if entry is None:
+            return False
+        if entry['key'] != (key or job_key(job)):
+            return False
+        try:
+            return os.path.getsize(job['output']) == entry['size']
+        except OSError:
+            return False
+
+    def add(self, job: dict, key: dict):
+        self.entries[job['output']] = {'key': key,
+                                       'size': os.path.getsize(job['output'])}
+        self._save()
+
+    def _save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+
+
+class JobQueue:
+    """
+    Durable FIFO of post-processing jobs. Every job is a JSON file in `path`
+    and is only removed when it is done, so jobs survive a crash or reboot.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.failed_path = os.path.join(path, 'failed')
+        os.makedirs(self.failed_path, exist_ok=True)
+        self.manifest = Manifest(os.path.join(path, 'manifest.json'))
+
+    def put(self, job: dict) -> str:
+        """
+        Add a job. Returns its file name.
+        """
+        name = f'{time_ns()}.json'
+        tmp = os.path.join(self.path, name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, name))
+        return name
+
+    def pending(self) -> List[str]:
+        """
+        Returns the file names of all pending jobs, oldest first.
+        """
+        return sorted(n for n in os.listdir(self.path)
+                      if n.endswith('.json') and n[:-len('.json')].isdigit())
+
+    def __len__(self) -> int:
+        return len(self.pending())
+
+    def load(self, name: str) -> dict:
+        with open(os.path.join(self.path, name)) as f:
+            return json.load(f)
+
+    def save(self, name: str, job: dict):
+        tmp = os.path.join(self.path, name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def done(self, name: str):
+        os.remove(os.path.join(self.path, name))
+
+    def fail(self, name: str):
+        os.replace(os.path.join(self.path, name), os.path.join(self.failed_path, name))
+
+
+class PostProcessor:
+    """
+    Runs the jobs of a `JobQueue` in a background thread at the lowest CPU
+    priority, so a new session can play while the previous one is converted.
+
+    Jobs left over from an earlier run are processed after `start()`.
+
+    Without a `queue`, only `run_job()` can be used. It converts a video
+    right away and does not skip videos which are already converted.
+    """
+    def __init__(self, queue: Optional[JobQueue], nice: int = POSTPROCESS_NICE, retries: int = POSTPROCESS_RETRIES):
+        self.queue = queue
+        self.nice = nice
+        self.retries = retries
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._stop = False
+        self._thread = None
+        self._process = None
+        self._failed_codecs = set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='postprocess', daemon=True)
+            self._thread.start()
+        return self
+
+    def enqueue(self, job: dict) -> bool:
+        """
+        Queue a job, unless its output is already up to date.
+        Returns `True` if the job was queued.
+        """
+        if self.queue.manifest.is_current(job):
+            logger.debug(f'{job["output"]} is up to date.')
+            return False
+        with self._lock:
+            name = self.queue.put(job)
+            self._idle.clear()
+            self._wakeup.set()
+        logger.debug(f'Queued post-processing job {name}: {job}')
+        return True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until all queued jobs are done. Returns `False` on timeout.
+        """
+        if self._thread is None:
+            return not len(self.queue)
+        return self._idle.wait(timeout)
+
+    def stop(self, drain: bool = False):
+        """
+        Stop the worker thread. A running job is finished first.
+
+        :param drain: `True` to process all queued jobs before stopping
+        """
+        if drain:
+            self.wait()
+        self._stop = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop:
+            with self._lock:
+                pending = self.queue.pending()
+                if not pending:
+                    self._idle.set()
+            if not pending:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            self._process_job(pending[0])
+
+    def _process_job(self, name: str):
+        job = self.queue.load(name)
+        start_time = time()
+        try:
+            ok = self.run_job(job)
+        except Exception as e:
+            logger.error(f'Post-processing job {name} failed: {e}')
+            ok = False
+
+        if ok:
+            logger.debug(f'Post-processing job {name} took {time() - start_time}s')
+            self.queue.done(name)
+            return
+
+        job['attempts'] = job.get('attempts', 0) + 1
+        if job['attempts'] >= self.retries:
+            logger.error(f'Giving up on post-processing job {name}: {job}')
+            self.queue.fail(name)
+        else:
+            self.queue.save(name, job)
+
+    def run_job(self, job: dict) -> bool:
+        """
+        Execute a job. Returns `True` on success.
+        """
+        if job['kind'] != 'video':
+            raise ValueError(f'Unknown post-processing job: {job}')
+
+        key = job_key(job)
+        if key is None:
+            logger.debug(f'Video file {job["input"]} does not exist.')
+            return True
+        manifest = self.queue.manifest if self.queue is not None else None
+        if (manifest is not None) and manifest.is_current(job, key):
+            logger.debug(f'{job["output"]} is up to date.')
+            return True
+
+        # A partial file is left over from an interrupted conversion
+        partial = partial_path(job['output'])
+        if os.path.exists(partial):
+            logger.debug(f'Discarding partial output {partial}')
+            os.remove(partial)
+
+        params = job['params']
+        while params['codec'] in self._failed_codecs and params['fallback']:
+            params = profile_params(params['fallback'])
+
+        logger.debug(f'Converting {job["input"]} to {job["output"]} with profile {params["profile"]} ...')
+        while not self._run_command(video_command(dict(job, params=params), partial)):
+            if not params['fallback']:
+                return False
+            # Most likely the hardware encoder is not available, don't try it again
+            self._failed_codecs.add(params['codec'])
+            logger.warning(f'Encoder {params["codec"]} failed, falling back to profile {params["fallback"]}')
+            params = profile_params(params['fallback'])
+        os.replace(partial, job['output'])
+        if manifest is not None:
+            manifest.add(job, key)
+        return True
+
+    def _run_command(self, cmd: List[str]) -> bool:
+        # `preexec_fn` is not safe with the other threads of this process, so use nice(1)
+        self._process = subprocess.Popen(['nice', '-n', str(self.nice)] + cmd,
+                                         stdin=subprocess.DEVNULL)
+        returncode = self._process.wait()
+        self._process = None
+        if returncode != 0:
+            logger.warning(f'{cmd[0]} exited with {returncode}')
+        return returncode == 0
+
+
+@click.command()
+@click.argument('clip', type=click.Path(exists=True, dir_okay=False))
+@click.option('--profile', '-p', 'profiles', multiple=True, type=click.Choice(list(PROFILES)),
+              help='Profile to benchmark, can be repeated. Default: all profiles')
+@click.option('--outdir', type=click.Path(file_okay=False), default=None,
+              help='Keep the outputs in this directory')
+def benchmark(clip: str, profiles: List[str], outdir: str):
+    """
+    Convert the raw .h264 CLIP with each post-processing profile and report
+    wall time, CPU time of ffmpeg and output size.
+
+    Profiles are run without fallback, so a missing hardware encoder shows as FAILED.
+    """
+    logging.basicConfig(level=logging.INFO)
+    outdir = outdir or tempfile.mkdtemp(prefix='pizza-bench-')
+    os.makedirs(outdir, exist_ok=True)
+
+    print(f'{"profile":<20} {"wall [s]":>9} {"cpu [s]":>9} {"size [MB]":>10}')
+    for profile in profiles or PROFILES:
+        job = video_job(clip, profile=profile)
+        output = os.path.join(outdir, f'{profile}.mov')
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = perf_counter()
+        try:
+            ok = subprocess.run(video_command(job, output),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL).returncode == 0
+        except OSError as e:
+            logger.error(e)
+            ok = False
+        wall = perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        if ok:
+            size = os.path.getsize(output) / 2**20
+            print(f'{profile:<20} {wall:>9.2f} {cpu:>9.2f} {size:>10.2f}')
+        else:
+            print(f'{profile:<20} {"FAILED":>9}')
+    print(f'Outputs in {outdir}')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import logging
+import threading
+
+from queue import Queue, Full
+from time import perf_counter
+from typing import Any
+
+from .startup import LazyModule
+
+logger = logging.getLogger(__name__)
+
+np = LazyModule('numpy')
+sd = LazyModule('sounddevice')
+sf = LazyModule('soundfile')
+
+
+class AudioRecorder:
+    """
+    Records from the microphone straight into a sound file.
+
+    The input stream callback copies each block into a bounded queue, a
+    writer thread appends the blocks to the file. Memory use does not depend
+    on the length of the recording, and the file only contains the frames
+    captured between `start()` and `stop()`.
+
+    If the writer falls behind by more than `buffer_seconds`, blocks are
+    dropped and counted in `dropped`.
+
+    With `keep=True` the captured blocks are also kept in memory and
+    available as `data` right after `stop()`, while the file may still be
+    written in the background.
+
+    `start_time` is the `perf_counter()` time the first recorded sample was
+    captured, to line the recording up with other streams.
+    """
+    def __init__(self,
+                 filename: Any,
+                 samplerate: int,
+                 channels: int = 2,
+                 dtype: str = 'float64',
+                 subtype: str = 'DOUBLE',
+                 blocksize: int = 2048,
+                 latency: float = 0.2,
+                 buffer_seconds: float = 10.0,
+                 keep: bool = False):
+        """
+        :param filename: The path of the file to record to
+        :param samplerate: Sample rate in Hz
+        :param channels: Number of channels to record
+        :param dtype: Sample format of the input stream
+        :param subtype: `soundfile` subtype of the file
+        :param blocksize: Frames per input stream callback
+        :param latency: Input latency in seconds (higher reduces the risk of overruns)
+        :param buffer_seconds: Audio the queue can hold before blocks are dropped
+        :param keep: `True` to keep the recording in memory, see `data`
+        """
+        self.filename = str(filename)
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = dtype
+        self.subtype = subtype
+        self.keep = keep
+
+        self.frames = 0          # Frames written to the file
+        self.dropped = 0         # Blocks dropped because the writer fell behind
+        self.overflows = 0       # Input overflows reported by the audio driver
+        self.start_time = None   # perf_counter() time of the first sample
+
+        self._queue = Queue(maxsize=max(1, int(buffer_seconds * samplerate / blocksize)))
+        self._stream = sd.InputStream(samplerate=samplerate,
+                                      channels=channels,
+                                      dtype=dtype,
+                                      blocksize=blocksize,
+                                      latency=latency,
+                                      callback=self._callback)
+        self._blocks = []
+        self._file = None
+        self._writer = None
+
+    def _callback(self, indata, frames, time, status):
+        if self.start_time is None:
+            # How long ago the first sample of this block was captured
+            lag = time.currentTime - time.inputBufferAdcTime
+            if not 0 < lag < 1:
+                # Not reported by all drivers
+                lag = frames / self.samplerate
+            self.start_time = perf_counter() - lag
+        if status.input_overflow:
+            self.overflows += 1
+        block = indata.copy()
+        if self.keep:
+            self._blocks.append(block)
+        try:
+            self._queue.put_nowait(block)
+        except Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        failed = False
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+            if failed:
+                # Keep draining the queue, so `stop()` does not block
+                continue
+            try:
+                self._file.write(block)
+                self.frames += len(block)
+            except Exception as e:
+                logger.error(f'Writing recording {self.filename} failed: {e}')
+                failed = True
+        self._file.close()
+        self._report()
+
+    @property
+    def data(self) -> np.ndarray:
+        """
+        The recorded samples (frames x channels). Needs `keep=True`.
+        """
+        if not self._blocks:
+            return np.zeros((0, self.channels), dtype=self.dtype)
+        if len(self._blocks) > 1:
+            self._blocks = [np.concatenate(self._blocks)]
+        return self._blocks[0]
+
+    def start(self):
+        self._file = sf.SoundFile(self.filename, mode='w',
+                                  samplerate=self.samplerate,
+                                  channels=self.channels,
+                                  subtype=self.subtype)
+        try:
+            # Blocks captured before the writer runs wait in the queue
+            self._stream.start()
+        except Exception:
+            # No microphone or the device is busy
+            self._stream.close()
+            self._file.close()
+            raise
+        # Not a daemon, so a file still being written is completed on exit
+        self._writer = threading.Thread(target=self._write_loop, name='recorder')
+        self._writer.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        """
+        Stop recording. The file is closed once all captured blocks are written.
+
+        :param wait: `False` to return without waiting for the file to be written
+        """
+        self._stream.stop()
+        self._stream.close()
+        self._queue.put(None)
+        if wait:
+            self.wait()
+
+    def wait(self):
+        """
+        Wait until the file is written and closed.
+        """
+        self._writer.join()
+
+    def _report(self):
+        logger.debug(f'Recorded {self.frames / self.samplerate:.2f}s to {self.filename}')
+        if self.dropped or self.overflows:
+            logger.warning(f'Recording {self.filename}: {self.dropped} blocks dropped, '
+                           f'{self.overflows} input overflows.')
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
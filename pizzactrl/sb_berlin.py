@@ -2,11 +2,11 @@ from pizzactrl import fs_names
 from pizzactrl.storyboard import *
 
 REC_NAME = fs_names.RecFile('name.wav')
-REC_WARMUP = fs_names.RecFile('warmup.wav')
+REC_WARMUP = fs_names.RecFile('warmup.flac')
 PROFILE_PIC = fs_names.RecFile('profile.jpg')
-REC_CITY = fs_names.RecFile('cityname.wav')
+REC_CITY = fs_names.RecFile('cityname.flac')
 REC_CITY_DESC = fs_names.RecFile('city-desc.wav')
-REC_CITY_SOUND = fs_names.RecFile('city-sound.wav')
+REC_CITY_SOUND = fs_names.RecFile('city-sound.flac')
 REC_CITY_VIDEO = fs_names.RecFile('city.h264')
 
 
@@ -0,0 +1,360 @@
+"""
+Storyboard files
+
+A storyboard file is JSON:
+
+    {"format": 1,
+     "postprocess_profile": null,
+     "chapters": [
+        {"skip_flag": false,
+         "activities": [
+            {"do": "PLAY_SOUND", "DE": {"story": "DE01"}, "EN": {"story": "EN01"}},
+            {"do": "ADVANCE_LEFT", "steps": 26, "speed": 3},
+            {"do": "WAIT_FOR_INPUT", "DE": {"story": "DE02"}, "timeout": 30,
+             "on_red": {"option": "GOTO", "chapter": 4},
+             "on_timeout": {"option": "CONTINUE"}},
+            {"do": "PARALLEL", "activities": [{"do": "LIGHT_FRONT", "w": 1.0}]}
+         ]}
+     ]}
+
+Activities take the keys of their `Activity` (default values may be left
+out), options the keys of their `Option`. Files are `{"story": name}`,
+`{"sfx": name}` or `{"rec": name}` (see `fs_names`), recordings are written
+to `{"rec": name}` only. `Scrolls` and `Lights` are given by name. PARALLEL
+runs lights and moves only, they all take effect on one DO_IT.
+
+Loaded storyboards are cached by the SHA-256 of the file, so only a new or
+edited file is parsed and validated.
+"""
+import os
+import json
+import pickle
+import hashlib
+import logging
+import importlib
+
+from enum import Enum
+from time import perf_counter
+from typing import Any, Optional
+
+import click
+
+from pizzactrl import fs_names
+from pizzactrl.fs_names import FileHandle, FileType, StoryFile, SfxFile, RecFile
+from pizzactrl.storyboard import Activity, Option, Language, Select, Do, Chapter, Storyboard, \
+                                 ConfigurationException, PARALLEL_ACTIVITIES
+from pizzactrl.hal_serial import rec_subtype
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1            # Version of the file format
+CACHE_VERSION = 2             # Increase when cached storyboards become invalid, e.g. new `Activity` defaults
+DEFAULT_STORYBOARD = 'sb_berlin'
+
+FILE_TYPES = {'story': StoryFile,
+              'sfx': SfxFile,
+              'rec': RecFile}
+FILE_TAGS = {FileType.STORY: 'story',
+             FileType.SFX: 'sfx',
+             FileType.REC: 'rec'}
+
+# Keys of activities which name a file. Recordings are written to `filename`.
+FILE_KEYS = {'sound', 'filename'} | {language.value for language in Language}
+RECORDING_KEYS = {'filename'}
+
+INT_KEYS = {'steps', 'speed', 'burst', 'index', 'chapter', 'samplerate', 'channels'}
+POSITIVE_KEYS = {'speed', 'burst', 'rate', 'samplerate', 'channels'}
+NON_NEGATIVE_KEYS = {'duration', 'fade', 'timeout'}
+COLOR_KEYS = {'r', 'g', 'b', 'w'}             # 0 to 1
+OPTIONAL_BOOL_KEYS = {'video_port'}           # true, false or null
+
+
+def _dump_value(value: Any) -> Any:
+    if isinstance(value, FileHandle):
+        return {FILE_TAGS[value.filetype]: value.name}
+    elif isinstance(value, Select):
+        if value.option is None:
+            return None
+        return dict({'option': value.option.name},
+                    **{key: _dump_value(val) for key, val in value.values.items()})
+    elif isinstance(value, Do):
+        return _dump_activity(value)
+    elif isinstance(value, Enum):
+        return value.name
+    elif isinstance(value, (list, tuple)):
+        return [_dump_value(val) for val in value]
+    return value
+
+
+def _dump_activity(act: Do) -> dict:
+    """
+    Returns the activity as a dict, without the values which are the default.
+    """
+    data = {'do': act.activity.name}
+    for key, value in act.values.items():
+        value = _dump_value(value)
+        if value != _dump_value(act.activity.value[key]):
+            data[key] = value
+    return data
+
+
+def dumps(storyboard: Storyboard) -> str:
+    """
+    Returns `storyboard` in the storyboard file format
+    """
+    chapters = []
+    for chapter in storyboard.story:
+        data = {'activities': [_dump_activity(act) for act in chapter.activities]}
+        if chapter.skip_flag:
+            data['skip_flag'] = True
+        chapters.append(data)
+    return json.dumps({'format': FORMAT_VERSION,
+                       'postprocess_profile': storyboard.postprocess_profile,
+                       'chapters': chapters}, indent=1)
+
+
+def _expect(condition: bool, where: str, message: str):
+    if not condition:
+        raise ConfigurationException(f'{where}: {message}')
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _Parser:
+    """
+    Builds a `Storyboard` from the parsed JSON and validates it.
+    Errors name the place in the file, e.g. `chapters[3].activities[1].steps`.
+    """
+    def __init__(self, data: Any):
+        self.data = data
+        self.n_chapters = 0
+        self._files = {}       # Equal file references share one `FileHandle`
+
+    def storyboard(self) -> Storyboard:
+        data = self.data
+        _expect(isinstance(data, dict), 'storyboard', 'expected an object')
+        _expect(data.get('format') == FORMAT_VERSION, 'format', f'expected {FORMAT_VERSION}')
+        unknown = set(data) - {'format', 'postprocess_profile', 'chapters'}
+        _expect(not unknown, 'storyboard', f'unknown keys {sorted(unknown)}')
+        profile = data.get('postprocess_profile')
+        _expect((profile is None) or isinstance(profile, str), 'postprocess_profile', 'expected a string')
+        chapters = data.get('chapters')
+        _expect(isinstance(chapters, list) and chapters, 'chapters', 'expected a list of chapters')
+
+        self.n_chapters = len(chapters)
+        return Storyboard(*(self.chapter(chapter, f'chapters[{i}]') for i, chapter in enumerate(chapters)),
+                          postprocess_profile=profile)
+
+    def chapter(self, data: Any, where: str) -> Chapter:
+        _expect(isinstance(data, dict), where, 'expected an object')
+        unknown = set(data) - {'activities', 'skip_flag'}
+        _expect(not unknown, where, f'unknown keys {sorted(unknown)}')
+        skip_flag = data.get('skip_flag', False)
+        _expect(isinstance(skip_flag, bool), f'{where}.skip_flag', 'expected true or false')
+        activities = data.get('activities')
+        _expect(isinstance(activities, list), f'{where}.activities', 'expected a list of activities')
+        return Chapter(*(self.activity(act, f'{where}.activities[{i}]') for i, act in enumerate(activities)),
+                       skip_flag=skip_flag)
+
+    def activity(self, data: Any, where: str, parallel: bool = False) -> Do:
+        _expect(isinstance(data, dict), where, 'expected an object')
+        name = data.get('do')
+        _expect(name in Activity.__members__, f'{where}.do', f'unknown activity {name!r}')
+        activity = Activity[name]
+        if parallel:
+            _expect(activity in PARALLEL_ACTIVITIES, f'{where}.do',
+                    f'PARALLEL can only run {[act.name for act in PARALLEL_ACTIVITIES]}')
+        values = {}
+        for key, value in data.items():
+            if key == 'do':
+                continue
+            _expect(key in activity.value, where, f'{name} has no key {key!r}')
+            values[key] = self.value(activity, key, value, f'{where}.{key}')
+        if 'filename' in activity.value:
+            _expect('filename' in values, where, f'{name} needs a filename')
+        if activity is Activity.RECORD_SOUND:
+            try:
+                rec_subtype(values['filename'], values.get('dtype', activity.value['dtype']))
+            except ConfigurationException as e:
+                raise ConfigurationException(f'{where}: {e}')
+        return Do(activity, **values)
+
+    def value(self, activity: Activity, key: str, value: Any, where: str) -> Any:
+        default = activity.value[key]
+        if key in FILE_KEYS:
+            return self.file(value, where, recording=key in RECORDING_KEYS)
+        elif key == 'activities':
+            _expect(isinstance(value, list), where, 'expected a list of activities')
+            return [self.activity(act, f'{where}[{i}]', parallel=True) for i, act in enumerate(value)]
+        elif activity is Activity.GOTO:
+            return self.chapter_number(value, where)
+        elif key in INT_KEYS:
+            _expect(isinstance(value, int) and not isinstance(value, bool), where, 'expected an integer')
+            _expect((key not in POSITIVE_KEYS) or (value > 0), where, 'expected a positive integer')
+        elif key in OPTIONAL_BOOL_KEYS:
+            _expect((value is None) or isinstance(value, bool), where, 'expected true, false or null')
+        elif key in COLOR_KEYS:
+            _expect(_is_number(value) and (0 <= value <= 1), where, 'expected a number from 0 to 1')
+        elif key in POSITIVE_KEYS:
+            _expect(_is_number(value) and (value > 0), where, 'expected a positive number')
+        elif key in NON_NEGATIVE_KEYS:
+            _expect(_is_number(value) and (value >= 0), where, 'expected a number of at least 0')
+        elif isinstance(default, Select):
+            return self.option(value, where)
+        elif isinstance(default, Enum):
+            _expect(value in type(default).__members__, where,
+                    f'expected one of {list(type(default).__members__)}')
+            return type(default)[value]
+        elif isinstance(default, bool):
+            _expect(isinstance(value, bool), where, 'expected true or false')
+        elif _is_number(default):
+            _expect(_is_number(value), where, 'expected a number')
+        elif isinstance(default, str):
+            _expect(isinstance(value, str), where, 'expected a string')
+        return value
+
+    def option(self, data: Any, where: str) -> Select:
+        if data is None:
+            return Select(None)
+        _expect(isinstance(data, dict), where, 'expected an object or null')
+        name = data.get('option')
+        _expect(name in Option.__members__, f'{where}.option', f'unknown option {name!r}')
+        option = Option[name]
+        values = {}
+        for key, value in data.items():
+            if key == 'option':
+                continue
+            _expect(key in option.value, where, f'{name} has no key {key!r}')
+            if key == 'chapter':
+                self.chapter_number(value, f'{where}.{key}')
+            else:
+                _expect((value is None) or isinstance(value, bool), f'{where}.{key}', 'expected true, false or null')
+            values[key] = value
+        return Select(option, **values)
+
+    def chapter_number(self, value: Any, where: str) -> int:
+        _expect(isinstance(value, int) and not isinstance(value, bool) and (0 <= value < self.n_chapters),
+                where, f'expected a chapter number below {self.n_chapters}')
+        return value
+
+    def file(self, data: Any, where: str, recording: bool = False) -> Any:
+        """
+        Files are given by type and name, paths are not accepted.
+        Recordings can only be written to `{"rec": name}`.
+        """
+        tags = ['rec'] if recording else list(FILE_TYPES)
+        if (data is None) and not recording:
+            return None
+        _expect(isinstance(data, dict) and (len(data) == 1), where,
+                f'expected {"" if recording else "null or "}one of {[{tag: "name"} for tag in tags]}')
+        (tag, name), = data.items()
+        _expect(tag in tags, where, f'expected one of {tags}, not {tag!r}')
+        _expect(isinstance(name, str) and name and (os.path.basename(name) == name) and (name not in ('.', '..')),
+                where, 'expected a file name without directory')
+        if (tag, name) not in self._files:
+            self._files[(tag, name)] = FILE_TYPES[tag](name)
+        return self._files[(tag, name)]
+
+
+def loads(text: str) -> Storyboard:
+    """
+    Returns the storyboard from the storyboard file contents `text`.
+    Raises `ConfigurationException` if it is invalid.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise ConfigurationException(f'Storyboard is not valid JSON: {e}')
+    return _Parser(data).storyboard()
+
+
+def _cache_path(digest: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, f'{digest}.sb{CACHE_VERSION}.pickle')
+
+
+def load(filename: str, cache_dir: Optional[str] = fs_names.STORYBOARD_CACHE) -> Storyboard:
+    """
+    Load a storyboard file.
+
+    :param cache_dir: Directory of the parsed storyboards, `None` to always parse the file
+    """
+    with open(filename, 'rb') as f:
+        content = f.read()
+
+    digest = hashlib.sha256(content).hexdigest()
+    cached = None if cache_dir is None else _cache_path(digest, cache_dir)
+    if cached is not None:
+        try:
+            with open(cached, 'rb') as f:
+                storyboard = pickle.load(f)
+            logger.debug(f'Loaded {filename} from {cached}')
+            return storyboard
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f'Ignoring storyboard cache {cached}: {e}')
+
+    try:
+        storyboard = loads(content.decode('utf-8'))
+    except ConfigurationException as e:
+        raise ConfigurationException(f'{filename}: {e}')
+
+    if (cached is not None) and os.path.isdir(os.path.dirname(os.path.normpath(cache_dir))):
+        # The parent (the recordings directory) only exists on the box
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = cached + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(storyboard, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cached)
+        except OSError as e:
+            logger.warning(f'Could not cache storyboard: {e}')
+    return storyboard
+
+
+def load_storyboard(name: str, cache_dir: Optional[str] = fs_names.STORYBOARD_CACHE) -> Storyboard:
+    """
+    Returns the storyboard `name`: A storyboard file (`.json`), or a module
+    defining `STORYBOARD`, e.g. `sb_berlin` or `pizzactrl.sb_berlin`.
+    """
+    if name.endswith('.json') or os.path.isfile(name):
+        return load(name, cache_dir=cache_dir)
+    if '.' not in name:
+        name = f'pizzactrl.{name}'
+    try:
+        return importlib.import_module(name).STORYBOARD
+    except (ImportError, AttributeError) as e:
+        raise ConfigurationException(f'No storyboard {name}: {e}')
+
+
+@click.command()
+@click.argument('storyboard', default=DEFAULT_STORYBOARD)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+              help='Write the storyboard to this file')
+@click.option('--no-cache', is_flag=True, default=False, help='Do not use the storyboard cache')
+def main(storyboard: str, output: str, no_cache: bool):
+    """
+    Load and check STORYBOARD (a storyboard file or module, default sb_berlin),
+    print the load time, and convert it to a storyboard file with --output.
+    """
+    logging.basicConfig(level=logging.INFO)
+    cache_dir = None if no_cache else fs_names.STORYBOARD_CACHE
+    start = perf_counter()
+    try:
+        story = load_storyboard(storyboard, cache_dir=cache_dir)
+    except ConfigurationException as e:
+        raise click.ClickException(str(e))
+    elapsed = perf_counter() - start
+    n_activities = sum(len(chapter.activities) for chapter in story.story)
+    print(f'{storyboard}: {len(story.story)} chapters, {n_activities} activities, '
+          f'loaded in {1000 * elapsed:.1f}ms')
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(dumps(story))
+        print(f'Written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,9 @@ from pizzactrl import fs_names
 from pizzactrl.storyboard import *
 
 REC_NAME = fs_names.RecFile('name.wav')
-REC_CITY = fs_names.RecFile('cityname.wav')
-REC_CITY_DESC = fs_names.RecFile('city-desc.wav')
-REC_CITY_SOUND = fs_names.RecFile('city-sound.wav')
+REC_CITY = fs_names.RecFile('cityname.flac')
+REC_CITY_DESC = fs_names.RecFile('city-desc.flac')
+REC_CITY_SOUND = fs_names.RecFile('city-sound.flac')
 REC_CITY_VIDEO = fs_names.RecFile('city.h264')
 
 Do_FADE_BLACK = Do(Activity.PARALLEL,
@@ -17,17 +17,17 @@ Do_FADE_BLACK = Do(Activity.PARALLEL,
 
 Chapter_GOTO_MAIN_MENU =Chapter(
                             Do(Activity.GOTO,
-                                chapter=2),
+                                index=2),
                         skip_flag=True)
 
 Chapter_GOTO_CITY_MENU =Chapter(
                             Do(Activity.GOTO,
-                                chapter=4),
+                                index=4),
                         skip_flag=True)
 
 Chapter_GOTO_ACTIVITY_MENU =Chapter(
                             Do(Activity.GOTO,
-                                chapter=13),
+                                index=13),
                         skip_flag=True)
 
 STORYBOARD = Storyboard(
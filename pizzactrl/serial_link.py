@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import threading
+
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from .framing import LineCodec
+
+logger = logging.getLogger(__name__)
+
+
+class SerialLink:
+    """
+    Event-driven transport for the serial connection to the microcontroller.
+
+    An asyncio event loop runs in a background thread and owns the serial
+    port. Incoming bytes are handled by a reader callback on the port's file
+    descriptor, so no thread blocks in `read_until()` waiting for responses.
+
+    Commands can be submitted from any thread and return futures. Pending
+    commands can be cancelled from any thread (e.g. from GPIO callbacks) and
+    are resolved immediately.
+
+    Responses are matched to commands by sequence number if the codec
+    provides one, otherwise in order. A response is returned as
+    `<command><payload>` bytes.
+
+    Up to `window` commands can be outstanding at once. Commands are written
+    in the order they were submitted.
+    """
+    def __init__(self, serialcon, precheck: Callable[[bool], bool] = None, codec=None, window: int = 1,
+                 metrics=None):
+        """
+        :param serialcon: An open `serial.Serial` instance
+        :param precheck: Called on the event loop with `ignore_lid` before a
+                         command is sent. Return `False` to resolve the command
+                         with `None` instead of sending it, or raise to fail it.
+        :param codec: A codec from `pizzactrl.framing`. Default is `LineCodec()`
+        :param window: Maximum number of commands waiting for a response
+        :param metrics: Optional `metrics.Metrics` to count transferred bytes
+        """
+        self.serialcon = serialcon
+        self.precheck = precheck
+        self.codec = codec if codec is not None else LineCodec()
+        self.window = max(1, window)
+        self.metrics = metrics
+
+        self.loop = None
+        self._thread = None
+        self._reading = False
+
+        self._seq = 0
+        self._pending = deque()    # (future, ignore_lid, seq), oldest first
+        self._send_lock = None     # Keeps submission order while waiting for the window
+
+    @property
+    def running(self) -> bool:
+        return self._reading
+
+    def _ensure_loop(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='serial-link',
+                                        daemon=True)
+        self._thread.start()
+
+    def _call(self, func: Callable, *args) -> Any:
+        """
+        Run `func` on the event loop and wait for the result.
+        """
+        fut = Future()
+
+        def _run():
+            try:
+                fut.set_result(func(*args))
+            except Exception as e:
+                fut.set_exception(e)
+
+        self.loop.call_soon_threadsafe(_run)
+        return fut.result()
+
+    def start(self):
+        """
+        Start listening for responses on the serial port.
+        """
+        self._ensure_loop()
+        self._call(self._start)
+
+    def _start(self):
+        if self._reading:
+            return
+        self.codec.reset()
+        self.loop.add_reader(self.serialcon.fileno(), self._on_readable)
+        self._reading = True
+
+    def stop(self, exc: Exception = None):
+        """
+        Stop listening on the serial port. Pending commands fail with `exc`
+        or resolve with `None`.
+        """
+        if self.loop is None:
+            return
+        self._call(self._stop, exc)
+
+    def _stop(self, exc: Exception = None):
+        if self._reading:
+            self.loop.remove_reader(self.serialcon.fileno())
+            self._reading = False
+        self._cancel(exc, lid_only=False)
+
+    def _on_readable(self):
+        """
+        Reader callback. Collect bytes and dispatch complete responses.
+        """
+        try:
+            data = self.serialcon.read(self.serialcon.in_waiting or 1)
+        except Exception as e:
+            logger.error(f'Reading from serial port failed: {e}')
+            self._stop(e)
+            return
+
+        if self.metrics is not None:
+            self.metrics.count('serial.bytes_in', len(data))
+
+        for seq, command, payload in self.codec.feed(data):
+            self._dispatch(seq, bytes((command,)) + payload)
+
+    def _dispatch(self, seq: int, resp: bytes):
+        """
+        Resolve the pending command with sequence number `seq`, or the oldest
+        pending command if `seq` is `None`.
+        """
+        for entry in self._pending:
+            if (seq is None) or (entry[2] == seq):
+                self._pending.remove(entry)
+                if not entry[0].done():
+                    entry[0].set_result(resp)
+                return
+        logger.debug(f'SerialLink discarded unsolicited response {resp} (seq={seq})')
+
+    def _next_seq(self) -> int:
+        self._seq = (self._seq + 1) & 0xFF
+        return self._seq
+
+    async def request(self, command: bytes, *payload: bytes, ignore_lid: bool = False):
+        """
+        Send a command and wait for the response (coroutine, must run on `self.loop`).
+
+        Returns the response or `None` if the command was cancelled by a lid event.
+        """
+        if not self._reading:
+            raise RuntimeError('SerialLink is not running. Call `start()` first.')
+
+        if self._send_lock is None:
+            self._send_lock = asyncio.Lock()
+
+        async with self._send_lock:
+            while len(self._pending) >= self.window:
+                await asyncio.wait([p[0] for p in self._pending], return_when=asyncio.FIRST_COMPLETED)
+
+            fut = self.loop.create_future()
+            seq = self._next_seq()
+            self._pending.append((fut, ignore_lid, seq))
+            frame = self.codec.encode(seq, command[0], *payload)
+            self.serialcon.write(frame)
+            if self.metrics is not None:
+                self.metrics.count('serial.bytes_out', len(frame))
+
+        if self.precheck is not None:
+            try:
+                proceed = self.precheck(ignore_lid)
+            except Exception:
+                self._discard(fut)
+                raise
+            if not proceed:
+                self._resolve(fut, None)
+
+        try:
+            return await fut
+        finally:
+            # Cancelled (e.g. by a timeout), the response is not needed anymore
+            self._discard(fut)
+
+    def submit(self, command: bytes, *payload: bytes, ignore_lid: bool = False) -> Future:
+        """
+        Send a command from any thread. Returns a `concurrent.futures.Future`
+        for the response.
+        """
+        if self.loop is None:
+            raise RuntimeError('SerialLink is not running. Call `start()` first.')
+        return asyncio.run_coroutine_threadsafe(self.request(command, *payload, ignore_lid=ignore_lid),
+                                                self.loop)
+
+    def cancel(self, exc: Exception = None, lid_only: bool = True):
+        """
+        Cancel in-flight commands from any thread.
+
+        :param exc: Exception to fail the commands with. If `None`, commands
+                    resolve with `None`.
+        :param lid_only: `True` to only cancel commands sent without `ignore_lid`
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._cancel, exc, lid_only)
+
+    def _cancel(self, exc: Exception = None, lid_only: bool = True):
+        keep = deque()
+        while self._pending:
+            entry = self._pending.popleft()
+            fut, ignore_lid, _ = entry
+            if lid_only and ignore_lid:
+                keep.append(entry)
+            elif fut.done():
+                continue
+            elif exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(None)
+        self._pending = keep
+
+    def _resolve(self, fut: asyncio.Future, result: Any = None):
+        if not fut.done():
+            fut.set_result(result)
+        self._discard(fut)
+
+    def _discard(self, fut: asyncio.Future):
+        """
+        Remove `fut` from the pending commands. It will not receive a response.
+        """
+        self._pending = deque(p for p in self._pending if p[0] is not fut)
+
+    def flush(self):
+        """
+        Discard received but unhandled bytes.
+        """
+        if self.loop is None:
+            self.serialcon.read_all()
+            return
+        self._call(self._flush)
+
+    def _flush(self):
+        self.codec.reset()
+        self.serialcon.reset_input_buffer()
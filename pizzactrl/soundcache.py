@@ -0,0 +1,193 @@
+import logging
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ('sound', 'nbytes', 'pinned', 'session')
+
+    def __init__(self, sound: Any, nbytes: int, pinned: bool, session: bool):
+        self.sound = sound
+        self.nbytes = nbytes
+        self.pinned = pinned
+        self.session = session
+
+
+class SoundCache:
+    """
+    Cache of decoded sounds, keyed by file path.
+
+    - Sounds are looked up before decoding, so a hit never touches the disk
+    - Unpinned sounds are evicted least recently used first when the
+      decoded size exceeds `budget` bytes
+    - Pinned sounds (sound effects, error messages) are never evicted
+    - Session sounds (recordings of a visitor) are dropped by `new_session()`
+    - `prefetch()` decodes sounds in background threads. A sound requested
+      while it is being decoded is not decoded twice.
+
+    Hits, misses, evictions and decode times are recorded in `metrics`.
+    """
+    def __init__(self,
+                 loader: Callable[[str], Any],
+                 sizeof: Callable[[Any], int],
+                 budget: int,
+                 metrics=None,
+                 prefetch_workers: int = 2,
+                 prefetch_fill: float = 0.75):
+        """
+        :param loader: Decodes the file at a path into a sound
+        :param sizeof: Returns the size of a decoded sound in bytes
+        :param budget: Maximum size of all cached sounds in bytes
+        :param metrics: Optional `metrics.Metrics`
+        :param prefetch_workers: Number of threads decoding prefetched sounds
+        :param prefetch_fill: Stop prefetching when this fraction of `budget` is used,
+                              so prefetched sounds do not evict each other
+        """
+        self.loader = loader
+        self.sizeof = sizeof
+        self.budget = budget
+        self.metrics = metrics
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_fill = prefetch_fill
+
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._loading = {}         # path: Future of a decode in progress
+        self._lock = threading.RLock()
+        self._executor = None
+        self._generation = 0       # Incremented to cancel queued prefetches
+
+    def _count(self, name: str):
+        if self.metrics is not None:
+            self.metrics.count(f'soundcache.{name}')
+
+    def __contains__(self, path: str) -> bool:
+        return str(path) in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return f'SoundCache({len(self)} sounds, {self.nbytes}/{self.budget} bytes)'
+
+    def get(self, path: str, pin: bool = False, session: bool = False) -> Any:
+        """
+        Return the sound for `path`, decoding and caching it on a miss.
+        """
+        path = str(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                entry.pinned |= pin
+                self._count('hits')
+                return entry.sound
+            loading = self._loading.get(path)
+            if loading is None:
+                loading = self._loading[path] = Future()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            # Being decoded by another thread, wait for it
+            self._count('waits')
+            loading.result()
+            return self.get(path, pin=pin, session=session)
+
+        self._count('misses')
+        start = perf_counter()
+        try:
+            sound = self.loader(path)
+            if self.metrics is not None:
+                self.metrics.time('soundcache.decode', perf_counter() - start)
+            self.put(path, sound, pin=pin, session=session)
+        except Exception as e:
+            loading.set_exception(e)
+            raise
+        else:
+            loading.set_result(sound)
+        finally:
+            with self._lock:
+                del self._loading[path]
+        return sound
+
+    def prefetch(self, paths: Iterable[str]):
+        """
+        Decode `paths` in the background, in the given order. Returns immediately.
+
+        Replaces prefetches queued by an earlier call which have not started yet.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.prefetch_workers,
+                                                thread_name_prefix='soundcache')
+        self._generation += 1
+        for path in paths:
+            self._executor.submit(self._prefetch, str(path), self._generation)
+
+    def _prefetch(self, path: str, generation: int):
+        if (generation != self._generation) or (path in self._entries):
+            return
+        if self.nbytes >= self.budget * self.prefetch_fill:
+            return
+        try:
+            self.get(path)
+            self._count('prefetched')
+        except Exception as e:
+            logger.debug(f'SoundCache: prefetching {path} failed: {e}')
+
+    def put(self, path: str, sound: Any, pin: bool = False, session: bool = False):
+        """
+        Add a decoded sound. Replaces an existing sound for the same path.
+        """
+        path = str(path)
+        nbytes = self.sizeof(sound)
+        with self._lock:
+            self._remove(path)
+            if (not pin) and (nbytes > self.budget):
+                logger.debug(f'SoundCache: {path} ({nbytes} bytes) exceeds budget, not caching.')
+                return
+            self._entries[path] = _Entry(sound, nbytes, pin, session)
+            self.nbytes += nbytes
+            self._evict()
+
+    def pin(self, paths: Iterable[str]):
+        """
+        Load `paths` and keep them in the cache permanently.
+        """
+        for path in paths:
+            self.get(path, pin=True)
+
+    def _remove(self, path: str):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def _evict(self):
+        if self.nbytes <= self.budget:
+            return
+        for path in [p for p, e in self._entries.items() if not e.pinned]:
+            self._remove(path)
+            self._count('evictions')
+            logger.debug(f'SoundCache: evicted {path}')
+            if self.nbytes <= self.budget:
+                return
+
+    def new_session(self):
+        """
+        Drop all sounds added with `session=True`.
+        """
+        with self._lock:
+            for path in [p for p, e in self._entries.items() if e.session]:
+                self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
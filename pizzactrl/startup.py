@@ -0,0 +1,153 @@
+import os
+import logging
+import threading
+import importlib
+
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+_PHASES = []                  # (name, start, duration, thread) of the timed startup phases
+_LOCK = threading.Lock()
+_READY = None                 # `perf_counter()` time of `ready()`
+
+
+def _process_age() -> float:
+    """
+    Seconds since the process was started (Linux), 0 if unknown.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces, the fields after it don't
+            starttime = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - starttime / os.sysconf('SC_CLK_TCK'), 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+# `perf_counter()` time of the process start
+PROCESS_START = perf_counter() - _process_age()
+
+
+def record(name: str, start: float, duration: float):
+    """
+    Record a startup phase, `start` is a `perf_counter()` time.
+    Phases are not recorded after `ready()`.
+    """
+    with _LOCK:
+        if _READY is not None:
+            return
+        _PHASES.append((name, start, duration, threading.current_thread().name))
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time the code in the `with` block as a startup phase.
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, perf_counter() - start)
+
+
+def ready():
+    """
+    Mark the end of the startup. Only the first call counts.
+    """
+    global _READY
+    with _LOCK:
+        if _READY is not None:
+            return
+        _READY = perf_counter()
+    logger.info(f'Ready {_READY - PROCESS_START:.2f}s after process start')
+
+
+def phases() -> List[Tuple[str, float, float, str]]:
+    """
+    Returns the recorded phases as (name, start, duration, thread), sorted by start.
+    Start times are relative to the process start.
+    """
+    with _LOCK:
+        return sorted(((name, start - PROCESS_START, duration, thread)
+                       for name, start, duration, thread in _PHASES), key=lambda p: p[1])
+
+
+def report() -> str:
+    """
+    Returns the recorded phases as a table, times in milliseconds.
+    """
+    lines = [f'{"phase":<36} {"start":>8} {"time":>8}  thread']
+    for name, start, duration, thread in phases():
+        lines.append(f'{name:<36} {1000 * start:>8.1f} {1000 * duration:>8.1f}  {thread}')
+    end = perf_counter() if _READY is None else _READY
+    lines.append(f'{"ready":<36} {1000 * (end - PROCESS_START):>8.1f}')
+    return '\n'.join(lines)
+
+
+class LazyModule:
+    """
+    A module which is imported when one of its attributes is used.
+
+        np = LazyModule('numpy')
+
+    Heavy hardware backends (pygame, picamera, sounddevice...) take seconds
+    to import on a Pi Zero. Lazy modules are only imported by the code which
+    uses them, or ahead of time in the background with `preload()`.
+    """
+    def __init__(self, name: str):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = load(self.__dict__['_name'])
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self) -> str:
+        return f'<lazy module {self.__dict__["_name"]!r}>'
+
+
+def load(name: str):
+    """
+    Import the module `name` and record the time it took, if it wasn't imported yet.
+    """
+    start = perf_counter()
+    module = importlib.import_module(name)
+    duration = perf_counter() - start
+    # Imports of already imported modules take microseconds
+    if duration > 0.001:
+        record(f'import {name}', start, duration)
+    return module
+
+
+def preload(names: Iterable[str]) -> threading.Thread:
+    """
+    Import the modules `names` one after the other in a background thread.
+    Code using one of them meanwhile waits for its import to finish.
+    """
+    names = list(names)
+
+    def _preload():
+        for name in names:
+            try:
+                load(name)
+            except Exception as e:
+                # Raised again where the module is used
+                logger.warning(f'Preloading {name} failed: {e}')
+
+    thread = threading.Thread(target=_preload, name='preload', daemon=True)
+    thread.start()
+    return thread
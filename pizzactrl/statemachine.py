@@ -1,16 +1,13 @@
 import logging
 import os.path
-from pathlib import Path
-import subprocess
 
 from typing import Union
 from enum import Enum, auto
 
-from time import time
-
-from pizzactrl import fs_names
+from pizzactrl import fs_names, startup
 from .storyboard import Language, Storyboard
-from .hal_serial import KEYSTONE_COORDS, SerialCommunicationError, \
+from .postprocess import JobQueue, PostProcessor, video_job, DEFAULT_PROFILE
+from .hal_serial import SerialCommunicationError, \
                         CommunicationError, PizzaHAL, \
                         wait_for_input, play_sound, turn_off, reset
 
@@ -46,18 +43,27 @@ class Statemachine:
                  lang_select: Union[bool,int] = True,
                  loop: bool=True,
                  test: bool=False,
-                 move: bool=True):
+                 move: bool=True,
+                 profile: str=None):
+        """
+        :param story: The storyboard is not modified, playback uses a `Cursor`
+        :param profile: Post-processing profile, overrides the storyboard's `postprocess_profile`
+        """
         self.hal = hal
 
         self.lang_select = lang_select
         self.LANG = default_lang
         self.lang = None
 
-        self.story = story
-        self.story.MOVE = move
+        self.story = story.cursor(hal, move=move)
 
         self.test = test
         self.loop = loop
+
+        self.postprocessor = None
+        self.profile = profile
+
+        self.backends = None      # Future of `PizzaHAL.init_backends()`
         
         self.state = State.POWER_ON      
 
@@ -70,7 +76,10 @@ class Statemachine:
         except ValueError:
             pass
 
-    def run(self):
+    def run(self, until: State = None):
+        """
+        :param until: Stop after this state, e.g. `State.POST` to stop when ready
+        """
         logger.debug(f'Starting Statemachine...')
 
         choice = {
@@ -87,25 +96,34 @@ class Statemachine:
             
         while (self.state is not State.SHUTDOWN) and (self.state is not State.ERROR):
             logger.debug(f'Run(state={self.state})')
+            state = self.state
             try:
-                choice[self.state]()
+                choice[state]()
             except (CommunicationError, SerialCommunicationError) as e:
                 self.state = State.ERROR
                 logger.error('Communication with microcontroller failed.', e)
             except Exception as e:
                 self.state = State.ERROR
                 logger.error(e)
+            if (state is until) and (self.state is not State.ERROR):
+                break
 
         if self.state is State.ERROR:
             logger.debug('An error occurred. Trying to notify user...')
-            if self.lang is Language.DE:
-                play_sound(self.hal, fs_names.SFX_ERROR_DE)
-            elif self.lang is Language.EN:
-                play_sound(self.hal, fs_names.SFX_ERROR_EN)
-            elif self.lang is Language.TR:
-                play_sound(self.hal, fs_names.SFX_ERROR_TR)
-            else:
-                play_sound(self.hal, fs_names.SFX_ERROR)
+            try:
+                if self.backends is not None:
+                    # POST may have failed before the mixer was initialized in the background
+                    self.backends.result()
+                if self.lang is Language.DE:
+                    play_sound(self.hal, fs_names.SFX_ERROR_DE)
+                elif self.lang is Language.EN:
+                    play_sound(self.hal, fs_names.SFX_ERROR_EN)
+                elif self.lang is Language.TR:
+                    play_sound(self.hal, fs_names.SFX_ERROR_TR)
+                else:
+                    play_sound(self.hal, fs_names.SFX_ERROR)
+            except Exception as e:
+                logger.error(f'Could not play the error sound: {e}')
 
         self._shutdown()
 
@@ -113,8 +131,15 @@ class Statemachine:
         """
         Initialize hal callbacks, load sounds
         """
-        self.hal.init_sounds()
-        self.hal.init_camera()
+        # Sounds and camera are loaded while POST waits for the microcontroller
+        self.backends = self.hal.init_backends(fs_names.SFX_PRELOAD)
+
+        # Also picks up jobs left over from before a crash or power loss
+        with startup.phase('PostProcessor.start'):
+            try:
+                self.postprocessor = PostProcessor(JobQueue(fs_names.POSTPROCESS_JOBS)).start()
+            except OSError as e:
+                logger.error(f'Post-processing unavailable: {e}')
 
         self._next_state()
 
@@ -125,10 +150,14 @@ class Statemachine:
         if (not self.test) and (not os.path.exists(fs_names.USB_STICK)):
             raise FileSystemException('USB Stick not present!')
 
-        self.hal.init_connection()
+        with startup.phase('init_connection'):
+            self.hal.init_connection()
+        with startup.phase('wait for init_backends'):
+            self.backends.result()
         
         # play a sound if everything is alright
         play_sound(self.hal, fs_names.SFX_POST_OK)
+        startup.ready()
 
         if self.test:
             self.state = State.LANGUAGE_SELECT
@@ -179,6 +208,8 @@ class Statemachine:
             self.lang = self.LANG
 
         self.story.language = self.lang
+        # Decode the sounds of the selected language before they are played
+        self.hal.soundcache.prefetch(self.story.storyboard.sounds(self.lang))
 
         logger.debug(f'User selected language={self.lang}')
         self._next_state()
@@ -187,8 +218,8 @@ class Statemachine:
         """
         Select language, then run the storyboard
         """
-        self.story.hal = self.hal
-        fs_names.generate_session_id()
+        self.story.session = fs_names.generate_session_id()
+        self.hal.soundcache.new_session()
 
         while self.story.hasnext() and self.hal.lid_open:
             self.story.play_chapter()
@@ -198,36 +229,25 @@ class Statemachine:
 
     def _post_process(self):
         """
-        Post-processing
+        Queue the videos of the session for conversion in the background,
+        or convert them now if the job queue is not available
         """
-        logger.debug('Converting video...')
-        
-        for fname in self.story.videofiles:
-            if not Path(fname).exists():
-                logger.debug(f'Video file {fname} does not exist.')
-                continue
-
-            start_time = time()
-            fnew = fname.split('.')[0] + '.mov'
-            logger.debug(f'Converting {fname} to {fnew} ...')
-            # cmd = ['MP4Box', '-add', fname, fnew]
-            # ffmpeg -hide_banner -i <input.h264> -lavfi "rotate=PI[rotated];[rotated]perspective=x0=370:y0=42:x1=1581:y1=0:x2=485:y2=993:x3=1414:y3=700:interpolation=cubic" <output.mp4>
-            filter_string = f'''rotate=PI[rotated];[rotated]perspective='
-                                x0={KEYSTONE_COORDS[0][0]}:y0={KEYSTONE_COORDS[0][1]}:'
-                                x1={KEYSTONE_COORDS[1][0]}:y1={KEYSTONE_COORDS[1][1]}:'
-                                x2={KEYSTONE_COORDS[2][0]}:y2={KEYSTONE_COORDS[2][1]}:'
-                                x3={KEYSTONE_COORDS[3][0]}:y3={KEYSTONE_COORDS[3][1]}:'
-                                interpolation=cubic'''
-            cmd = ['ffmpeg', 
-                   '-hide_banner', '-y',
-                   '-framerate', '30',           # Original .h264 video has 29.97fps (according to vlc), but 30fps works better
-                   '-i', fname, 
-                   '-codec:v', 'h264_v4l2m2m',   # Uses hardware support, makes conversion faster
-                   '-b:v', '4M',                 # Reduces artefacts 
-                   '-lavfi', filter_string,
-                   fnew]
-            subprocess.run(cmd)
-            logger.debug(f'Video conversion took {time() - start_time}s')
+        profile = self.profile or self.story.storyboard.postprocess_profile or DEFAULT_PROFILE
+        if self.postprocessor is not None:
+            for capture in self.story.videofiles:
+                self.postprocessor.enqueue(video_job(**capture, profile=profile))
+        else:
+            # Without the job queue, convert the videos now, before the next session
+            converter = PostProcessor(None)
+            for capture in self.story.videofiles:
+                job = video_job(**capture, profile=profile)
+                try:
+                    if not converter.run_job(job):
+                        logger.error(f'Converting {job["input"]} failed.')
+                except Exception as e:
+                    logger.error(f'Converting {job["input"]} failed: {e}')
+        # Queued jobs are durable, don't queue the same videos again next session
+        self.story.videofiles.clear()
 
         self.hal.flush_serial()
         self._next_state()
@@ -260,6 +280,11 @@ class Statemachine:
         """
         Clean up, end execution
         """
+        if self.postprocessor is not None:
+            # Finish the queued conversions before the device powers off
+            logger.debug(f'Waiting for {len(self.postprocessor.queue)} post-processing jobs...')
+            self.postprocessor.stop(drain=True)
+            self.postprocessor = None
         del self.hal
         del self.story
         self.state = None
@@ -1,19 +1,21 @@
 import logging
-from enum import Enum, auto
-from typing import List, Any
+from enum import Enum
+from functools import partial
+from time import perf_counter
+from types import MappingProxyType
+from typing import List, Any, Callable, Iterator, Optional, Tuple
 
+from pizzactrl.fs_names import FileType
 from pizzactrl.hal_serial import Lights, Scrolls, \
+                                 AUDIO_REC_SR, AUDIO_REC_CHANNELS, AUDIO_REC_DTYPE, BURST_RATE, \
                                  do_it, play_sound, take_photo, record_video, \
                                  record_sound, wait_for_input, \
-                                 set_light, set_movement, rewind
+                                 set_light, set_movement, rewind, \
+                                 rec_subtype, ConfigurationException
 
 logger = logging.getLogger(__name__)
 
 
-class ConfigurationException(Exception):
-    pass
-
-
 class Language(Enum):
     NOT_SET = 'sound'
     DE = 'DE'
@@ -31,17 +33,37 @@ class Option(Enum):
                  'skip_flag': None}     # Jump to chapter number
     QUIT = {}                           # End playback. Will cause restart if `statemachine.loop=True`
 
+    def __reduce_ex__(self, protocol):
+        # Pickle by name, the values can't be looked up after unpickling
+        return getattr, (self.__class__, self.name)
+
+
+def _restore(cls, kind, values):
+    """
+    Unpickle a `Select` or `Do`, their values are read-only and not picklable as they are
+    """
+    return cls(kind, **values)
+
 
 class Select:
     """
     An option instance. Can override the default settings from `Option`s
     """
+    __slots__ = ('option', 'values')
+
     def __init__(self, option: Option, **kwargs):
         self.option = option
-        self.values = {}
+        values = {}
         if option is not None:
             for key, value in self.option.value.items():
-                self.values[key] = kwargs.get(key, value)
+                values[key] = kwargs.get(key, value)
+        unknown = set(kwargs) - set(values)
+        if unknown:
+            raise ConfigurationException(f'{option} has no settings {sorted(unknown)}')
+        self.values = MappingProxyType(values)
+
+    def __reduce__(self):
+        return _restore, (Select, self.option, dict(self.values))
 
 
 class Activity(Enum):
@@ -64,11 +86,19 @@ class Activity(Enum):
                       Language.TR.value: None}
     RECORD_SOUND =   {'duration': 10.0, 
                       'filename': '', 
-                      'cache': False}
+                      'cache': False,
+                      'samplerate': AUDIO_REC_SR,
+                      'channels': AUDIO_REC_CHANNELS,
+                      'dtype': AUDIO_REC_DTYPE}
     RECORD_VIDEO =   {'duration': 60.0, 
                       'filename': '',
-                      'sound': None}
-    TAKE_PHOTO =     {'filename': ''}
+                      'sound': None,
+                      'audio': True}
+    TAKE_PHOTO =     {'filename': '',
+                      'video_port': None,
+                      'keystone': True,
+                      'burst': 1,
+                      'rate': BURST_RATE}
     ADVANCE_UP =     {'steps': 1,
                       'scroll': Scrolls.VERTICAL,
                       'speed': 3}
@@ -90,16 +120,41 @@ class Activity(Enum):
     PARALLEL =       {'activities': []}
     GOTO =           {'index': 0}
 
+    def __reduce_ex__(self, protocol):
+        # Pickle by name, the values can't be looked up after unpickling
+        return getattr, (self.__class__, self.name)
+
+
+# Activities which a PARALLEL activity can run at the same time, on one DO_IT
+PARALLEL_ACTIVITIES = (Activity.LIGHT_FRONT, Activity.LIGHT_BACK, Activity.ADVANCE_UP, Activity.ADVANCE_LEFT)
+
 
 class Do:
     """
     An activity instance. Can override the default settings from `Activity`s
+
+    Immutable, so storyboards can be shared between playbacks.
     """
+    __slots__ = ('activity', 'values')
+
     def __init__(self, activity: Activity, **kwargs):
         self.activity = activity
-        self.values = {}
+        values = {}
         for key, value in self.activity.value.items():
-            self.values[key] = kwargs.get(key, value)
+            values[key] = kwargs.get(key, value)
+        unknown = set(kwargs) - set(values)
+        if unknown:
+            raise ConfigurationException(f'{activity} has no settings {sorted(unknown)}')
+        if activity is Activity.PARALLEL:
+            values['activities'] = tuple(values['activities'])
+            blocking = [act.activity.name for act in values['activities']
+                        if act.activity not in PARALLEL_ACTIVITIES]
+            if blocking:
+                raise ConfigurationException(f'{activity} can only run lights and moves, not {blocking}')
+        self.values = MappingProxyType(values)
+
+    def __reduce__(self):
+        return _restore, (Do, self.activity, dict(self.values))
 
     def __repr__(self) -> str:
         return f'{self.activity.name}({self.values})'
@@ -131,62 +186,13 @@ class Chapter:
     A logical storyboard entity, which can be replayed (rewind to start) 
     or skipped (do all movements at once).
 
-    Keeps track of advanced steps on the scrolls.
+    Chapters are immutable, the playback position is kept by `Cursor`.
     """
+    __slots__ = ('activities', 'skip_flag')
+
     def __init__(self, *activities, skip_flag: bool=False):
         self.activities = activities
         self.skip_flag = skip_flag
-        self.index = 0
-        self.h_pos = 0
-        self.v_pos = 0
-        
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.index >= len(self.activities):
-            raise StopIteration
-        
-        act = self.activities[self.index]
-        self._update_pos(act)
-        return act
-
-    def _update_pos(self, act: Do):
-        """
-        Update the positions from the activity.
-        Implicitly increments the index.
-        """
-        self.index += 1
-        h, v = act.get_steps()
-        self.h_pos += h
-        self.v_pos += v
-
-    def hasnext(self):
-        """
-        Returns True if the chapter has more activities
-        """
-        return self.index < len(self.activities)
-
-    def rewind(self, **kwargs):
-        """
-        Reset the position to zero. Return how many steps are needed to rewind the scrolls
-        """
-        self.index = 0
-        h_pos = self.h_pos
-        v_pos = self.v_pos
-        self.h_pos = 0
-        self.v_pos = 0
-        return {'h_steps': -h_pos, 'v_steps': -v_pos}
-
-    def skip(self, **kwargs):
-        """
-        Skip chapter. Returns all movements necessary to advance scrolls.
-        """
-        h_pos = self.h_pos
-        v_pos = self.v_pos
-        for act in self.activities[self.index:]:
-            self._update_pos(act)
-        return {'h_steps': self.h_pos - h_pos, 'v_steps': self.v_pos - v_pos}
 
 
 def _get_sound(language: Language, **kwargs):
@@ -204,26 +210,268 @@ def _get_sound(language: Language, **kwargs):
     return sound
 
 
+class Instruction:
+    """
+    A compiled activity: The handler is looked up, the arguments are final and
+    the scroll steps are precomputed. Instructions hold no playback state.
+    """
+    __slots__ = ('activity', 'handler', 'args', 'h_steps', 'v_steps', 'metric')
+
+    def __init__(self, activity: Activity, handler: Callable, args: dict, h_steps: int, v_steps: int):
+        self.activity = activity
+        self.handler = handler      # Called with the `Cursor` and the instruction
+        self.args = args
+        self.h_steps = h_steps
+        self.v_steps = v_steps
+        self.metric = f'activity.{activity.name}'
+
+    def __repr__(self) -> str:
+        return f'{self.activity.name}({self.args})'
+
+
+class Program:
+    """
+    A storyboard compiled for one language. The instructions of all chapters
+    are in one flat list, chapter `i` is `code[starts[i]:starts[i + 1]]`.
+
+    `h_at[k]` and `v_at[k]` are the scroll positions in steps before
+    instruction `k` (prefix sums of the steps), so the position at any
+    chapter or activity boundary is a lookup.
+    """
+    __slots__ = ('language', 'code', 'starts', 'h_at', 'v_at')
+
+    def __init__(self, language: Language, code: List[Instruction], starts: List[int]):
+        self.language = language
+        self.code = code
+        self.starts = starts
+        self.h_at = [0] * (len(code) + 1)
+        self.v_at = [0] * (len(code) + 1)
+        for k, ins in enumerate(code):
+            self.h_at[k + 1] = self.h_at[k] + ins.h_steps
+            self.v_at[k + 1] = self.v_at[k] + ins.v_steps
+
+    def position(self, chapter: int, activity: int = 0) -> Tuple[int, int]:
+        """
+        Returns the scroll positions (h, v) before `activity` of `chapter`.
+        """
+        k = self.starts[chapter] + activity
+        return self.h_at[k], self.v_at[k]
+
+
+def _option_callback(selection: Select) -> Optional[Callable]:
+    """
+    Return a callback for the appropriate option and parameters.
+    Callbacks are called with the `Cursor` and set its properties to determine
+    the next chapter.
+    """
+    _rewind = selection.values.get('rewind', None)
+    _next_chapter = selection.values.get('chapter', None)
+    _skip_flag = selection.values.get('skip_flag', None)
+
+    def _continue(cursor: 'Cursor'):
+        """
+        Continue in the Storyboard. Prepare advancing to the next chapter.
+        """
+        logger.debug('User selected continue')
+        if len(cursor.storyboard.story) > (cursor._index + 1):
+            cursor.next_chapter = cursor._index + 1
+            if _skip_flag is not None:
+                cursor.skip_flag = _skip_flag
+        else:
+            cursor.next_chapter = None
+
+    def _repeat(cursor: 'Cursor'):
+        """
+        Repeat the current chapter. Do not rewind if the selection says so.
+        """
+        logger.debug('User selected repeat')
+        cursor.next_chapter = cursor._index
+        cursor.move = _rewind
+
+    def _goto(cursor: 'Cursor'):
+        """
+        Jump to a specified chapter.
+        """
+        logger.debug(f'User selected goto {_next_chapter}')
+        cursor.next_chapter = _next_chapter
+        if _skip_flag is not None:
+            cursor.skip_flag = _skip_flag
+
+    def _quit(cursor: 'Cursor'):
+        logger.debug('User selected quit')
+        cursor.next_chapter = None
+
+    return {
+               Option.CONTINUE: _continue,
+               Option.REPEAT: _repeat,
+               Option.GOTO: _goto,
+               Option.QUIT: _quit,
+               None: None
+           }[selection.option]
+
+
 class Storyboard:
-    def __init__(self, *story: List[Chapter]) -> None:
+    """
+    The immutable story definition. It holds no playback state, so one
+    storyboard can be played by any number of `Cursor`s, see `cursor()`.
+    """
+    def __init__(self, *story: List[Chapter], postprocess_profile: str = None) -> None:
+        """
+        :param postprocess_profile: See `postprocess.PROFILES`, `None` for the default
+        """
         self.story = story
-        self.hal = None
+        self.postprocess_profile = postprocess_profile
+
+        self._programs = {}        # Compiled programs by language, see `program()`
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Programs reference closures, they are compiled again when needed
+        state['_programs'] = {}
+        return state
+
+    def cursor(self, hal=None, move: bool = True, session: str = None) -> 'Cursor':
+        """
+        Returns a new cursor to play the storyboard from the beginning.
+        """
+        return Cursor(self, hal=hal, move=move, session=session)
+
+    def sounds(self, language: Language) -> Iterator[Any]:
+        """
+        Yield every sound the storyboard can play in `language`, in story order
+        and without duplicates. Recordings are skipped, they do not exist yet.
+        """
+        seen = set()
+
+        def _walk(activities):
+            for act in activities:
+                if act.activity is Activity.PARALLEL:
+                    yield from _walk(act.values['activities'])
+                    continue
+                if act.activity in (Activity.PLAY_SOUND, Activity.WAIT_FOR_INPUT):
+                    sound = _get_sound(language, **act.values)
+                elif act.activity is Activity.RECORD_VIDEO:
+                    sound = act.values['sound']
+                else:
+                    continue
+                if (sound is None) or (getattr(sound, 'filetype', None) is FileType.REC):
+                    continue
+                if str(sound) not in seen:
+                    seen.add(str(sound))
+                    yield sound
+
+        for chapter in self.story:
+            yield from _walk(chapter.activities)
+
+    def compile(self, language: Language) -> Program:
+        """
+        Compile the storyboard for `language`.
+
+        Sounds are resolved for the language, option callbacks are created
+        and handlers are looked up once, so playing an activity only calls
+        its handler with the cursor and the prepared instruction.
+        """
+        handlers = {
+            Activity.PLAY_SOUND: Cursor._do_play_sound,
+            Activity.WAIT_FOR_INPUT: Cursor._do_wait_for_input,
+            Activity.PARALLEL: Cursor._do_parallel,
+            Activity.GOTO: Cursor._do_goto,
+            Activity.RECORD_SOUND: Cursor._do_record_sound,
+            Activity.RECORD_VIDEO: Cursor._do_record_video,
+            Activity.TAKE_PHOTO: Cursor._do_take_photo,
+            Activity.LIGHT_FRONT: Cursor._do_light,
+            Activity.LIGHT_BACK: Cursor._do_light,
+            Activity.ADVANCE_UP: Cursor._do_move,
+            Activity.ADVANCE_LEFT: Cursor._do_move,
+        }
+
+        def _compile(act: Do, do_now: bool = True) -> Instruction:
+            try:
+                handler = handlers[act.activity]
+            except KeyError as e:
+                raise ConfigurationException(f'Missing handler for {act.activity}', e)
+            values = act.values
+            if act.activity is Activity.PLAY_SOUND:
+                args = {'sound': _get_sound(language, **values)}
+            elif act.activity is Activity.WAIT_FOR_INPUT:
+                args = {'blue_cb': _option_callback(values['on_blue']),
+                        'red_cb': _option_callback(values['on_red']),
+                        'yellow_cb': _option_callback(values['on_yellow']),
+                        'green_cb': _option_callback(values['on_green']),
+                        'timeout_cb': _option_callback(values['on_timeout']),
+                        'sound': _get_sound(language, **values),
+                        'timeout': values['timeout']}
+            elif act.activity is Activity.PARALLEL:
+                args = {'activities': tuple(_compile(paract, do_now=False)
+                                            for paract in values['activities'])}
+            elif act.activity is Activity.RECORD_SOUND:
+                # Fail before the session, not when the recording starts
+                rec_subtype(values['filename'], values['dtype'])
+                args = dict(values)
+            else:
+                args = dict(values)
+                if act.activity in (Activity.LIGHT_FRONT, Activity.LIGHT_BACK,
+                                    Activity.ADVANCE_UP, Activity.ADVANCE_LEFT):
+                    args['do_now'] = do_now
+            h_steps, v_steps = act.get_steps()
+            return Instruction(act.activity, handler, args, h_steps, v_steps)
+
+        code = []
+        starts = []
+        for chapter in self.story:
+            starts.append(len(code))
+            code.extend(_compile(act) for act in chapter.activities)
+        starts.append(len(code))
+        return Program(language, code, starts)
+
+    def program(self, language: Language) -> Program:
+        """
+        The storyboard compiled for `language`. Compiled once and shared by all cursors.
+        """
+        program = self._programs.get(language)
+        if program is None:
+            program = self._programs[language] = self.compile(language)
+        return program
+
+
+class Cursor:
+    """
+    The playback state of one `Storyboard`: The current chapter and activity,
+    the scroll positions, the selected language and the videos recorded.
+
+    Recordings (`RecFile`s) are made in the directory of `session`, so
+    cursors playing the same storyboard don't overwrite each other's files.
+    """
+    CALLBACKS = ('blue_cb', 'red_cb', 'yellow_cb', 'green_cb', 'timeout_cb')
+
+    def __init__(self, storyboard: Storyboard, hal=None, move: bool = True, session: str = None) -> None:
+        """
+        :param move: Default for `self.move`, `False` to never move the scrolls
+        :param session: Session directory of the recordings, see `fs_names.new_session()`.
+                        `None` for the default session of `fs_names`
+        """
+        self.storyboard = storyboard
+        self.hal = hal
+        self._session = session
+        self._args = {}            # Instruction -> arguments for this cursor, see `_prepare()`
 
         self._index = 0            # The storyboard index of the current chapter to play
+        self._activity = 0         # Index of the next activity to play in the current chapter
+        self._h_pos = 0            # Position of the horizontal scroll in steps
+        self._v_pos = 0            # Position of the vertical scroll in steps
         self._next_chapter = 0       # The storyboard index of the next chapter to play
         self._chapter_set = False    # `True` if the next chapter has been set
 
         self.skip_flag = False     # Set `True` to skip chapters marked with skip_flag
 
-        self.MOVE = True           # self.move is reset to this value
+        self.MOVE = move           # self.move is reset to this value
         self._move = self.MOVE
 
         self._lang = Language.NOT_SET
+        self._program = None       # `storyboard` compiled for `self.language`
 
         self.videofiles = []
 
-        self.ACTIVITY_SELECTOR = None
-
     @property
     def move(self) -> bool:
         return self._move
@@ -235,6 +483,16 @@ class Storyboard:
         else:
             self._move = move
 
+    @property
+    def session(self) -> Optional[str]:
+        return self._session
+
+    @session.setter
+    def session(self, session: Optional[str]):
+        if session != self._session:
+            self._session = session
+            self._args = {}
+
     @property
     def language(self) -> Language:
         return self._lang
@@ -242,6 +500,17 @@ class Storyboard:
     @language.setter
     def language(self, language: Language):
         self._lang = language
+        self._program = None
+        self._args = {}
+
+    @property
+    def program(self) -> Program:
+        """
+        The storyboard compiled for `self.language`.
+        """
+        if self._program is None:
+            self._program = self.storyboard.program(self.language)
+        return self._program
 
     @property
     def next_chapter(self):
@@ -256,55 +525,105 @@ class Storyboard:
     def hasnext(self):
         return self._index is not None
 
-    def _option_callback(self, selection: Select):
-        """
-        Return a callback for the appropriate option and parameters.
-        Callbacks set the properties of `Statemachine` to determine it's behaviour.
-        """
-        _rewind = selection.values.get('rewind', None)
-        _next_chapter = selection.values.get('chapter', None)
-        _skip_flag = selection.values.get('skip_flag', None)
-        
-        def _continue():
-            """
-            Continue in the Storyboard. Prepare advancing to the next chapter.
-            """
-            logger.debug('User selected continue')
-            if len(self.story) > (self._index + 1):
-                self.next_chapter = self._index + 1
-                if _skip_flag is not None:
-                    self.skip_flag = _skip_flag
-            else:
-                self.next_chapter = None
-        
-        def _repeat():
-            """
-            Repeat the current chapter. Do not rewind if the selection says so.
-            """
-            logger.debug('User selected repeat')
-            self.next_chapter = self._index
-            self.move = _rewind
-        
-        def _goto():
-            """
-            Jump to a specified chapter.
-            """
-            logger.debug(f'User selected goto {_next_chapter}')
-            self.next_chapter = _next_chapter
-            if _skip_flag is not None:
-                self.skip_flag = _skip_flag
+    def next_index(self) -> Optional[int]:
+        """
+        The storyboard index of the chapter after the current one, `None` at
+        the end of the story
+        """
+        if self._chapter_set:
+            return self._next_chapter
+        if (self._index is None) or (self._index >= len(self.storyboard.story) - 1):
+            return None
+        return self._index + 1
 
-        def _quit():
-            logger.debug('User selected quit')
-            self.next_chapter = None
+    def at(self, index: int, skip_flag: bool = False, move: bool = None) -> 'Cursor':
+        """
+        Returns a new cursor at the start of chapter `index`, with the scrolls
+        where the chapter starts. It plays the same language and session and
+        records its own videos.
+        """
+        cursor = Cursor(self.storyboard, self.hal, self.MOVE, self.session)
+        cursor.language = self.language
+        cursor._index = cursor._next_chapter = index
+        cursor._h_pos, cursor._v_pos = cursor.program.position(min(index, len(self.storyboard.story)))
+        cursor.skip_flag = skip_flag
+        cursor.move = move
+        return cursor
+
+    def __copy__(self) -> 'Cursor':
+        """
+        Copies the playback state, the copy records its own videos
+        """
+        cursor = Cursor.__new__(Cursor)
+        cursor.__dict__.update(self.__dict__)
+        cursor.videofiles = list(self.videofiles)
+        cursor._args = {}
+        return cursor
+
+    def _file(self, file: Any) -> Any:
+        """
+        Returns `file`, recordings in the directory of `self.session`
+        """
+        if (self.session is None) or (getattr(file, 'filetype', None) is not FileType.REC):
+            return file
+        return file.in_session(self.session)
+
+    def _prepare(self, ins: Instruction) -> dict:
+        """
+        Returns the arguments of `ins` for this cursor: Recordings in the
+        directory of `self.session`, option callbacks bound to the cursor.
+        Prepared once per instruction and session.
+        """
+        args = self._args.get(ins)
+        if args is None:
+            args = {}
+            for name, value in ins.args.items():
+                if (name in self.CALLBACKS) and (value is not None):
+                    args[name] = partial(value, self)
+                else:
+                    args[name] = self._file(value)
+            self._args[ins] = args
+        return args
+
+    def _do_play_sound(self, ins: Instruction):
+        play_sound(self.hal, self._prepare(ins)['sound'])
+
+    def _do_wait_for_input(self, ins: Instruction):
+        wait_for_input(self.hal, **self._prepare(ins))
+
+    def _do_parallel(self, ins: Instruction):
+        for paract in ins.args['activities']:
+            paract.handler(self, paract)
+        do_it(self.hal)
+
+    def _do_move(self, ins: Instruction):
+        if not self.move:
+            return
+        args = ins.args
+        set_movement(self.hal, args['scroll'], args['steps'], args['speed'])
+        if args['do_now']:
+            do_it(self.hal)
+
+    def _do_light(self, ins: Instruction):
+        args = ins.args
+        set_light(self.hal, args['light'], args['r'], args['g'], args['b'], args['w'], args['fade'])
+        if args['do_now']:
+            do_it(self.hal)
+
+    def _do_record_sound(self, ins: Instruction):
+        record_sound(self.hal, **self._prepare(ins))
+
+    def _do_record_video(self, ins: Instruction):
+        self.videofiles.append(record_video(self.hal, **self._prepare(ins)))
 
-        return {
-                   Option.CONTINUE: _continue,
-                   Option.REPEAT: _repeat,
-                   Option.GOTO: _goto,
-                   Option.QUIT: _quit,
-                   None: None
-               }[selection.option]
+    def _do_take_photo(self, ins: Instruction):
+        take_photo(self.hal, **self._prepare(ins))
+
+    def _do_goto(self, ins: Instruction):
+        """
+        Set the next chapter
+        """
+        self.next_chapter = ins.args['index']
 
     def play_chapter(self):
         """
@@ -313,166 +632,91 @@ class Storyboard:
         logger.debug(f'playing chapter {self._index}')
 
         if self.hal is None:
-            raise ConfigurationException('Set Storyboard.hal before calling Storyboard.play_chapter()')
+            raise ConfigurationException('Set Cursor.hal before calling Cursor.play_chapter()')
 
         if self._index is None:
             # Reached end of story
             return
 
-        def _play_sound(hal, **kwargs):
-            """
-            Handle Activity.PLAY_SOUND
-            """
-            logger.debug(f'Storyboard._play_sound({kwargs})')
-            play_sound(hal, sound=_get_sound(language=self.language, **kwargs))
-
-        def _wait_for_input(hal, sound=None, **kwargs):
-            """
-            Handle Activity.WAIT_FOR_INPUT
-            """
-            logger.debug(f'Storyboard._wait_for_input({kwargs})')
-            
-            kwargs['sound'] = _get_sound(language=self.language, **kwargs)
-
-            wait_for_input(hal=hal,
-                        blue_cb = self._option_callback(kwargs['on_blue']),
-                        red_cb = self._option_callback(kwargs['on_red']),
-                        yellow_cb = self._option_callback(kwargs['on_yellow']),
-                        green_cb = self._option_callback(kwargs['on_green']),
-                        timeout_cb = self._option_callback(kwargs['on_timeout']),
-                        **kwargs)
-
-        def _parallel(hal, activities: List[Do], **kwargs):
-            """
-            Handle Activity.PARALLEL
-            """
-            logger.debug(f'Storyboard._parallel({activities})')
-            for paract in activities:
-                self.ACTIVITY_SELECTOR[paract.activity](hal, do_now=False, **paract.values)   
-            do_it(self.hal)
-
-        def _move(hal, do_now=True, **kwargs):
-            logger.debug(f'Storyboard._move({kwargs})')
-            if not self.move:
-                return
-            set_movement(hal, **kwargs)
-            if do_now:
-                do_it(hal)
-
-        def _light(hal, do_now=True, **kwargs):
-            logger.debug(f'Storyboard._light({kwargs})')
-            set_light(hal, **kwargs)
-            if do_now:
-                do_it(hal)
-
-        def _record_video(hal, filename=None, sound=None, **kwargs):
-            logger.debug(f'Storyboard._record_video(filename={filename}, sound={sound}, {kwargs})')
-            record_video(hal, filename=filename, sound=sound, **kwargs)
-            self.videofiles.append(str(filename))
-
-        def _goto(hal, index:int, **kwargs):
-            """
-            Set the next chapter
-            """
-            logger.debug(f'Storyboard._goto({kwargs})')
-            self.next_chapter = index
-
-        self.ACTIVITY_SELECTOR = {
-            Activity.PLAY_SOUND: _play_sound,
-            Activity.WAIT_FOR_INPUT: _wait_for_input,
-            Activity.PARALLEL: _parallel,
-            Activity.GOTO: _goto,
-            Activity.RECORD_SOUND: record_sound,
-            Activity.RECORD_VIDEO: _record_video,
-            Activity.TAKE_PHOTO: take_photo,
-            Activity.LIGHT_FRONT: _light,
-            Activity.LIGHT_BACK: _light,
-            Activity.ADVANCE_UP: _move,
-            Activity.ADVANCE_LEFT: _move,
-        }
-
-        if self._index < len(self.story):
-            chapter = self.story[self._index]
+        story = self.storyboard.story
+        if self._index < len(story):
+            chapter = story[self._index]
             if self.skip_flag and chapter.skip_flag:
                 # Skip all chapters marked with skip_flag
                 self.next_chapter = self._index + 1
                 self._chapter_set = True
                 return
 
-            while chapter.hasnext() and self.hal.lid_open:
-                act = next(chapter)
-                logger.debug(f'next activity {act.activity}')
-                try:
-                    self.ACTIVITY_SELECTOR[act.activity](self.hal, **act.values)
-                except KeyError as e:
-                    raise ConfigurationException(f'Missing handler for {act.activity}', e)
+            program = self.program
+            code = program.code
+            start_index = program.starts[self._index]
+            n_activities = len(chapter.activities)
+
+            hal = self.hal
+            metrics = hal.metrics
+            debug = logger.isEnabledFor(logging.DEBUG)
+            while (self._activity < n_activities) and hal.lid_open:
+                ins = code[start_index + self._activity]
+                self._activity += 1
+                if self.move:
+                    # Movements are only made with `self.move`
+                    self._h_pos += ins.h_steps
+                    self._v_pos += ins.v_steps
+                if debug:
+                    logger.debug(f'next activity {ins}')
+                start = perf_counter()
+                ins.handler(self, ins)
+                metrics.time(ins.metric, perf_counter() - start)
             
             if not self._chapter_set:
+                self._next_chapter = self.next_index()
                 self._chapter_set = True
-                if self._index < (len(self.story) - 1):
-                    self._next_chapter = self._index + 1
-                else:
-                    self._next_chapter = None
 
         else:
+            # Jumped beyond the last chapter, end the story
             self._next_chapter = None
+            self._chapter_set = True
     
     def advance_chapter(self):
         """
         Update chapters and move the scrolls.
         Update self.chapter to self.next_chapter
+
+        The scrolls are moved from their current position to the start of
+        the next chapter, which also rewinds a repeated chapter and skips
+        chapters jumped over.
         """
         if not self._chapter_set:
             return
         elif self._index is None:
             return
         elif self._next_chapter is not None:
-            diff = self._next_chapter - self._index
-            h_steps = 0
-            v_steps = 0
-            if diff < 0:
-                """
-                Rewind all chapters up to target
-                """
-                for ch in self.story[self._next_chapter:self._index]:
-                    steps = ch.rewind()
-                    h_steps += steps['h_steps']
-                    v_steps += steps['v_steps']
-            elif diff > 0:
-                """
-                Skip all chapters up to target
-                """
-                for ch in self.story[self._index:self._next_chapter]:
-                    logger.debug(f'Queueing chapter {ch} for skipping')
-                    steps = ch.skip()
-                    h_steps += steps['h_steps']
-                    v_steps += steps['v_steps']
-            else:
-                """
-                Rewind current chapter
-                """
-                steps = self.story[self._index].rewind()
-                h_steps = steps['h_steps']
-                v_steps = steps['v_steps']
-
-            logger.debug(f'storyboard.move={self.move} and h_steps={h_steps}, v_steps={v_steps}.')
-            if self.move and ((h_steps != 0) or (v_steps != 0)):
-                set_movement(self.hal, scroll=Scrolls.HORIZONTAL, steps=h_steps, speed=4)
-                set_movement(self.hal, scroll=Scrolls.VERTICAL, steps=v_steps, speed=4)
-                do_it(self.hal)
+            # Beyond the last chapter the story ends, see `play_chapter()`
+            h_target, v_target = self.program.position(min(self._next_chapter, len(self.storyboard.story)))
+            h_steps = h_target - self._h_pos
+            v_steps = v_target - self._v_pos
+
+            logger.debug(f'cursor.move={self.move} and h_steps={h_steps}, v_steps={v_steps}.')
+            if self.move:
+                if (h_steps != 0) or (v_steps != 0):
+                    set_movement(self.hal, scroll=Scrolls.HORIZONTAL, steps=h_steps, speed=4)
+                    set_movement(self.hal, scroll=Scrolls.VERTICAL, steps=v_steps, speed=4)
+                    do_it(self.hal)
+                self._h_pos = h_target
+                self._v_pos = v_target
 
         logger.debug(f'Setting chapter (cur: {self._index}) to {self._next_chapter}.')
         self._index = self._next_chapter
+        self._activity = 0
         self._chapter_set = False
 
     def rewind(self):
         if self.hal is None:
-            raise ConfigurationException('Set Storyboard.hal before calling Storyboard.rewind()')
+            raise ConfigurationException('Set Cursor.hal before calling Cursor.rewind()')
 
         if self.move:
             rewind(self.hal)
 
-        for chapter in self.story:
-            chapter.rewind()
-
+        self._h_pos = self._v_pos = 0
+        self._activity = 0
         self._index = self._next_chapter = 0
@@ -24,20 +24,26 @@ with open('pizzactrl/__init__.py', 'rb') as f:
         ],
 
         install_requires=[
+            'numpy',
             'gpiozero',
             'picamera',
             'click',
             'sounddevice',
             'soundfile',
-            'scipy',
             'pyserial',
-            'pydub'
+            'pydub',
+            'Pillow',
+            'pygame'
         ],
 
         entry_points='''
             [console_scripts]
             pizzabox=pizzactrl.main:main
             pizza-rewind=pizzactrl.main:rewind
+            pizza-sim=pizzactrl.mcu_sim:main
+            pizza-bench-postprocess=pizzactrl.postprocess:benchmark
+            pizza-storyboard=pizzactrl.sb_loader:main
+            pizza-estimate=pizzactrl.estimate:main
         ''',
 
         include_package_data=True
@@ -0,0 +1,104 @@
+import random
+import inspect
+
+from enum import Enum
+
+import pytest
+
+from pizzactrl import storyboard as sb, hal_serial
+from pizzactrl.fs_names import FileHandle
+from pizzactrl.metrics import Metrics
+
+
+def _arg(value):
+    if isinstance(value, FileHandle):
+        return f'{value.filetype.name}:{value.name}'
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
+class FakeHAL:
+    """
+    Records the calls of the storyboard to the hardware functions, and
+    answers WAIT_FOR_INPUT with random buttons.
+    """
+    lid_open = True
+
+    def __init__(self, seed: int, max_waits: int = 40):
+        self.metrics = Metrics()
+        self.trace = []
+        self.rng = random.Random(seed)
+        self.waits = 0
+        self.max_waits = max_waits
+
+
+class Stop(Exception):
+    pass
+
+
+def _record(name):
+    """
+    Records a call of `hal_serial.<name>` with the arguments by name,
+    so positional and keyword calls are recorded the same.
+    """
+    signature = inspect.signature(getattr(hal_serial, name))
+
+    def _call(hal, *args, **kwargs):
+        bound = signature.bind(hal, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = {k: _arg(v) for k, v in sorted(bound.arguments.items())
+                     if k not in ('hal', 'kwargs')}
+        hal.trace.append([name, arguments])
+    return _call
+
+
+def _wait_for_input(hal, blue_cb=None, red_cb=None, yellow_cb=None, green_cb=None, timeout_cb=None,
+                    sound=None, timeout=120, **kwargs):
+    hal.waits += 1
+    if hal.waits > hal.max_waits:
+        raise Stop()
+    callbacks = [cb for cb in (blue_cb, red_cb, yellow_cb, green_cb, timeout_cb) if cb is not None]
+    hal.trace.append(['wait_for_input', _arg(sound), timeout, len(callbacks)])
+    if callbacks:
+        choice = hal.rng.randrange(len(callbacks))
+        hal.trace.append(['choice', choice])
+        callbacks[choice]()
+
+
+def _record_video(hal, **kwargs):
+    _record('record_video')(hal, **kwargs)
+    return {'video': _arg(kwargs['filename'])}
+
+
+@pytest.fixture
+def fake_hal(monkeypatch):
+    """
+    Replace the hardware functions used by `storyboard`.
+    """
+    for name in ('play_sound', 'set_movement', 'set_light', 'do_it', 'take_photo',
+                 'record_sound', 'rewind'):
+        monkeypatch.setattr(sb, name, _record(name))
+    monkeypatch.setattr(sb, 'wait_for_input', _wait_for_input)
+    monkeypatch.setattr(sb, 'record_video', _record_video)
+    return FakeHAL
+
+
+def replay(story, hal, language: str, sessions: int = 2) -> list:
+    """
+    Play `sessions` sessions of `story` on one cursor, like the statemachine does.
+    Returns the trace of `hal`.
+    """
+    cursor = story.cursor(hal)
+    cursor.language = sb.Language[language]
+    for _ in range(sessions):
+        hal.waits = 0
+        try:
+            while cursor.hasnext() and hal.lid_open:
+                cursor.play_chapter()
+                cursor.advance_chapter()
+        except Stop:
+            hal.trace.append(['stop'])
+        cursor.skip_flag = False
+        cursor.rewind()
+    return hal.trace
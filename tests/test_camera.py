@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pizzactrl import camera
+
+SPS = 'sps_header'
+
+
+@pytest.fixture(autouse=True)
+def frame_types(monkeypatch):
+    monkeypatch.setattr(camera, 'picamera', SimpleNamespace(PiVideoFrameType=SimpleNamespace(sps_header=SPS)))
+
+
+def _stream(keyframes, n_frames=40, fps=10):
+    """
+    A buffer of `n_frames` frames, with an SPS header without timestamp before each frame in `keyframes`
+    """
+    frames = []
+    for i in range(n_frames):
+        if i in keyframes:
+            frames.append(SimpleNamespace(frame_type=SPS, timestamp=None))
+        frames.append(SimpleNamespace(frame_type='frame', timestamp=i * 1000000 // fps))
+    return SimpleNamespace(frames=frames)
+
+
+def test_preroll_starts_after_oldest_frame():
+    # The last frame is at 3.9s, the frame 1.5s older at 2.4s. The next keyframe is at 3.0s
+    stream = _stream(keyframes=(0, 15, 30))
+    assert camera._preroll_length(stream, 1.5) == pytest.approx(0.9)
+    # The header of the keyframe at 1.5s comes after the frame at 1.4s
+    assert camera._preroll_length(stream, 2.5) == pytest.approx(2.4)
+    assert camera._preroll_length(stream, 2.4) == pytest.approx(0.9)
+
+
+def test_preroll_without_keyframe():
+    stream = _stream(keyframes=(0,))
+    assert camera._preroll_length(stream, 1.5) == 0.0
+    # Less than `seconds` buffered: everything from the first keyframe
+    assert camera._preroll_length(stream, 10.0) == pytest.approx(3.9)
+    assert camera._preroll_length(SimpleNamespace(frames=[]), 1.0) == 0.0
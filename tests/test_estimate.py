@@ -0,0 +1,54 @@
+import wave
+
+import pytest
+
+from pizzactrl import storyboard as sb
+from pizzactrl.estimate import Estimator, SoundDurations
+
+INF = float('inf')
+
+
+@pytest.fixture
+def prompt(tmp_path):
+    """
+    A sound of 1 second
+    """
+    path = str(tmp_path / 'prompt.wav')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(b'\x00\x00' * 16000)
+    return path
+
+
+def test_two_chapters(prompt):
+    story = sb.Storyboard(
+        sb.Chapter(sb.Do(sb.Activity.PLAY_SOUND, sound=prompt),
+                   sb.Do(sb.Activity.ADVANCE_LEFT, steps=8, speed=4),
+                   sb.Do(sb.Activity.WAIT_FOR_INPUT, sound=prompt,
+                         on_red=sb.Select(sb.Option.CONTINUE),
+                         on_blue=sb.Select(sb.Option.REPEAT))),
+        sb.Chapter(sb.Do(sb.Activity.LIGHT_FRONT, fade=1.5)))
+    durations = SoundDurations()
+    estimate = Estimator(story, durations, step_time=1.0).estimate(sb.Language.NOT_SET)
+
+    assert not durations.missing
+    # Sound 1s, move 2s, quickest visitor 1s, fade 1.5s, rewind 2s
+    assert estimate.min == pytest.approx(7.5)
+    # Half the visitors repeat the chapter (7s with the prompt and reaction 4s) after a
+    # move back of 2s: exp = 7 + (1.5 + 2) / 2 + (2 + exp) / 2
+    assert estimate.exp == pytest.approx(19.5)
+    assert estimate.max == INF
+    assert estimate.states == 2
+
+
+def test_goto_branches_record_their_own_videos():
+    story = sb.Storyboard(sb.Chapter(sb.Do(sb.Activity.GOTO, index=0)))
+    cursor = story.cursor(None)
+    cursor.videofiles.append('first.h264')
+    branch = cursor.at(0)
+    assert branch.videofiles == []
+    assert branch.next_index() is None
+    cursor.next_chapter = 0
+    assert cursor.next_index() == 0
@@ -0,0 +1,72 @@
+import pytest
+
+from pizzactrl import hal_serial as hs
+from pizzactrl.mcu_sim import VirtualMCU, use_mock_pins, RED
+
+
+@pytest.fixture(params=[False, True], ids=['line', 'framed'])
+def board(request):
+    """
+    A `PizzaHAL` connected to a `VirtualMCU`, with the lid open.
+    """
+    pins = use_mock_pins()
+    with VirtualMCU(framed=request.param) as mcu:
+        hal = hs.PizzaHAL(serialdev=mcu.port, framed=request.param)
+        mcu.attach_pins(pins)
+        hal.init_connection()
+        yield hal, mcu
+        hal.link.stop()
+
+
+def test_moves_round_trip(board):
+    hal, mcu = board
+    hs.set_movement(hal, hs.Scrolls.HORIZONTAL, 500, 3)
+    hs.set_movement(hal, hs.Scrolls.VERTICAL, -500, 3)
+    hs.do_it(hal)
+
+    assert mcu.position == [500, -500]
+    assert not any(name.endswith('.lid_aborts') for name in hal.metrics.counters)
+    assert hal.metrics.histograms['serial.DO_IT'].count == 1
+
+
+def test_light_and_rewind(board):
+    hal, mcu = board
+    hs.set_light(hal, hs.Lights.FRONTLIGHT, 0, 0, 0, 1, 0)
+    hs.set_movement(hal, hs.Scrolls.VERTICAL, 20, 3)
+    hs.do_it(hal)
+    assert mcu.lights[hs.Lights.FRONTLIGHT.value] == 0xFF000000
+    assert mcu.position == [0, 20]
+
+    hs.rewind(hal)
+    assert mcu.position == [0, 0]
+
+
+def test_wait_for_input(board):
+    hal, mcu = board
+    pressed = []
+    mcu.press(RED, 0.01)
+    hs.wait_for_input(hal,
+                      blue_cb=lambda: pressed.append('blue'),
+                      red_cb=lambda: pressed.append('red'),
+                      timeout_cb=lambda: pressed.append('timeout'),
+                      timeout=5)
+    assert pressed == ['red']
+
+
+def test_closed_lid_aborts(board):
+    hal, mcu = board
+    mcu.close_lid()
+    hs.set_movement(hal, hs.Scrolls.HORIZONTAL, 10, 3)
+    hs.do_it(hal)
+    assert hal.metrics.counters['serial.SET_MOVEMENT.lid_aborts'] == 1
+    assert hal.metrics.counters['serial.DO_IT.lid_aborts'] == 1
+
+
+@pytest.mark.parametrize('framed', [[], ['--framed']], ids=['line', 'framed'])
+def test_benchmark(framed):
+    from click.testing import CliRunner
+    from pizzactrl.mcu_sim import main
+
+    result = CliRunner().invoke(main, ['--count', '5'] + framed)
+    assert result.exit_code == 0, result.output
+    assert 'lid_aborts' not in result.output
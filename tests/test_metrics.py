@@ -0,0 +1,46 @@
+import os
+import signal
+import threading
+
+from pizzactrl.metrics import LatencyHistogram, Metrics
+
+
+def test_histogram_percentiles():
+    hist = LatencyHistogram()
+    for ms in range(1, 1001):
+        hist.record(ms / 1000)
+    assert hist.count == 1000
+    assert abs(hist.percentile(50) - 0.5) < 0.5 * 0.016
+    assert abs(hist.percentile(99) - 0.99) < 0.99 * 0.016
+    assert hist.max == 1.0
+
+
+def test_concurrent_updates():
+    metrics = Metrics()
+
+    def _update():
+        for _ in range(10000):
+            metrics.count('n')
+            metrics.time('t', 0.001)
+
+    threads = [threading.Thread(target=_update) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert metrics.counters['n'] == 80000
+    assert metrics.histogram('t').count == 80000
+
+
+def test_dump_from_signal_handler():
+    metrics = Metrics()
+    dumps = []
+    previous = signal.signal(signal.SIGUSR1, lambda signum, frame: dumps.append(metrics.dump()))
+    try:
+        # Like a SIGUSR1 while the main thread records a duration
+        with metrics._lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            metrics.time('t', 0.001)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert dumps == ['Metrics:']
@@ -0,0 +1,19 @@
+import numpy as np
+
+from pizzactrl.photo import correct_keystone
+
+
+def _image(width, height):
+    return np.arange(width * height * 3, dtype=np.uint32).reshape(height, width, 3).astype(np.uint8)
+
+
+def test_video_port_photo_is_corrected():
+    image = _image(192, 108)
+    corrected = correct_keystone(image)
+    assert corrected.shape == image.shape
+    assert not np.array_equal(corrected, image)
+
+
+def test_still_port_photo_is_kept():
+    image = _image(2592 // 8, 1944 // 8)
+    assert correct_keystone(image) is image
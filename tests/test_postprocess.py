@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from pizzactrl import postprocess
+from pizzactrl.postprocess import JobQueue, PostProcessor, video_job
+
+
+@pytest.fixture
+def video(tmp_path, monkeypatch):
+    """
+    A raw video, converted by a command which writes its niceness instead of running ffmpeg.
+    """
+    def _command(job, output):
+        if job['params']['codec'] == 'h264_v4l2m2m':
+            # No hardware encoder here
+            return ['false']
+        return ['sh', '-c', f'nice > "{output}"']
+
+    monkeypatch.setattr(postprocess, 'video_command', _command)
+    path = tmp_path / 'city.h264'
+    path.write_bytes(b'\x00' * 64)
+    return str(path)
+
+
+def _expected_nice() -> int:
+    return min(os.nice(0) + postprocess.POSTPROCESS_NICE, 19)
+
+
+def test_run_job_without_queue(video):
+    job = video_job(video)
+    assert PostProcessor(None).run_job(job)
+    with open(job['output']) as f:
+        assert int(f.read()) == _expected_nice()
+
+
+def test_worker_falls_back_and_skips_converted(video, tmp_path):
+    processor = PostProcessor(JobQueue(str(tmp_path / 'jobs'))).start()
+    try:
+        job = video_job(video)
+        assert processor.enqueue(job)
+        assert processor.wait(10)
+        assert os.path.exists(job['output'])
+        assert not processor.queue.pending()
+
+        # The manifest knows the output is up to date
+        assert not processor.enqueue(video_job(video))
+    finally:
+        processor.stop()
+
+
+def test_video_command_filter(tmp_path):
+    video = tmp_path / 'city.h264'
+    video.write_bytes(b'\x00' * 64)
+    job = video_job(str(video))
+    job['params']['keystone'] = [[370, 42], [1581, 0], [485, 993], [1414, 700]]
+
+    cmd = postprocess.video_command(job, 'out.mov')
+    assert cmd[cmd.index('-lavfi') + 1] == ('[0:v]rotate=PI[rotated];[rotated]perspective='
+                                            'x0=370:y0=42:x1=1581:y1=0:x2=485:y2=993:x3=1414:y3=700:'
+                                            f'interpolation={job["params"]["interpolation"]}[v]')
+    assert cmd[cmd.index('-map') + 1] == '[v]'
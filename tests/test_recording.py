@@ -0,0 +1,63 @@
+import threading
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from pizzactrl import recorder
+from pizzactrl.hal_serial import rec_subtype, ConfigurationException
+from pizzactrl.fs_names import RecFile
+
+
+@pytest.mark.parametrize('ext', ['wav', 'flac'])
+@pytest.mark.parametrize('dtype', ['int16', 'int32', 'float32', 'float64'])
+def test_rec_subtype_writable(tmp_path, ext, dtype):
+    filename = tmp_path / f'rec.{ext}'
+    subtype = rec_subtype(str(filename), dtype)
+
+    data = (np.sin(np.linspace(0, 100, 4410)) * 0.5).astype('float64')
+    if dtype.startswith('int'):
+        data = (data * np.iinfo(dtype).max).astype(dtype)
+    else:
+        data = data.astype(dtype)
+    with sf.SoundFile(str(filename), mode='w', samplerate=44100, channels=1, subtype=subtype) as f:
+        f.write(data)
+    assert sf.info(str(filename)).frames == len(data)
+
+
+@pytest.mark.parametrize('filename, dtype', [('rec.flac', 'int8'),
+                                             ('rec.mp3', 'int16'),
+                                             ('rec', 'int16')])
+def test_rec_subtype_unsupported(filename, dtype):
+    with pytest.raises(ConfigurationException):
+        rec_subtype(filename, dtype)
+
+
+def test_rec_subtype_file_handle():
+    assert rec_subtype(RecFile('city.flac'), 'float32') == 'PCM_24'
+
+
+class _BrokenStream:
+    """
+    An input stream without a microphone
+    """
+    def __init__(self, **kwargs):
+        self.closed = False
+
+    def start(self):
+        raise RuntimeError('Error opening InputStream: Device unavailable')
+
+    def close(self):
+        self.closed = True
+
+
+def test_recorder_start_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, 'sd', SimpleNamespace(InputStream=_BrokenStream))
+    rec = recorder.AudioRecorder(str(tmp_path / 'rec.flac'), samplerate=44100, subtype='PCM_16')
+    with pytest.raises(RuntimeError):
+        rec.start()
+    assert rec._stream.closed
+    assert rec._file.closed
+    assert not any(thread.name == 'recorder' for thread in threading.enumerate())
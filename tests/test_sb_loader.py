@@ -0,0 +1,92 @@
+import os
+import re
+import json
+import importlib
+
+import pytest
+
+from pizzactrl import sb_loader
+from pizzactrl.sb_loader import dumps, loads, load
+from pizzactrl.storyboard import ConfigurationException, Do, Activity, Select, Option
+
+from conftest import replay
+
+STORYBOARDS = ('sb_berlin', 'sb_showcase', 'sb_linz', 'sb_dummy')
+
+
+@pytest.mark.parametrize('name', STORYBOARDS)
+def test_round_trip(fake_hal, name):
+    story = importlib.import_module(f'pizzactrl.{name}').STORYBOARD
+    text = dumps(story)
+    loaded = loads(text)
+    assert dumps(loaded) == text
+    assert replay(loaded, fake_hal(1), 'DE') == replay(story, fake_hal(1), 'DE')
+
+
+def test_cache_hit(fake_hal, tmp_path, monkeypatch):
+    filename = tmp_path / 'showcase.json'
+    filename.write_text(dumps(importlib.import_module('pizzactrl.sb_showcase').STORYBOARD))
+    cache_dir = tmp_path / 'cache'
+
+    parsed = load(str(filename), cache_dir=str(cache_dir))
+    assert len(os.listdir(cache_dir)) == 1
+
+    def _no_parsing(text):
+        raise AssertionError('parsed again')
+    monkeypatch.setattr(sb_loader, 'loads', _no_parsing)
+    cached = load(str(filename), cache_dir=str(cache_dir))
+    assert dumps(cached) == dumps(parsed)
+    assert replay(cached, fake_hal(2), 'EN') == replay(parsed, fake_hal(2), 'EN')
+
+
+def test_no_cache_without_recordings_dir(tmp_path):
+    filename = tmp_path / 'showcase.json'
+    filename.write_text(dumps(importlib.import_module('pizzactrl.sb_showcase').STORYBOARD))
+    cache_dir = tmp_path / 'missing' / '.cache'
+    load(str(filename), cache_dir=str(cache_dir))
+    assert not os.path.exists(tmp_path / 'missing')
+
+
+def _storyboard(*activities) -> str:
+    return json.dumps({'format': 1, 'chapters': [{'activities': list(activities)}, {'activities': []}]})
+
+
+@pytest.mark.parametrize('activity, where', [
+    ({'do': 'PLAY_SOUND', 'DE': '/etc/passwd'}, 'activities[0].DE'),
+    ({'do': 'PLAY_SOUND', 'DE': {'story': '../DE01'}}, 'activities[0].DE'),
+    ({'do': 'ADVANCE_UP', 'steps': 2.5}, 'activities[0].steps'),
+    ({'do': 'ADVANCE_UP', 'steps': True}, 'activities[0].steps'),
+    ({'do': 'ADVANCE_UP', 'speed': 0}, 'activities[0].speed'),
+    ({'do': 'TAKE_PHOTO', 'filename': {'rec': 'a.jpg'}, 'video_port': 'x'}, 'activities[0].video_port'),
+    ({'do': 'TAKE_PHOTO', 'filename': {'rec': 'a.jpg'}, 'burst': 1.5}, 'activities[0].burst'),
+    ({'do': 'RECORD_VIDEO', 'filename': {'rec': 'a.h264'}, 'duration': -5}, 'activities[0].duration'),
+    ({'do': 'RECORD_VIDEO'}, 'activities[0]'),
+    ({'do': 'RECORD_SOUND', 'filename': {'story': 'a.wav'}}, 'activities[0].filename'),
+    ({'do': 'RECORD_SOUND', 'filename': {'rec': 'a.flac'}, 'dtype': 'int8'}, 'activities[0]'),
+    ({'do': 'LIGHT_BACK', 'fade': -1}, 'activities[0].fade'),
+    ({'do': 'LIGHT_BACK', 'w': 2}, 'activities[0].w'),
+    ({'do': 'PARALLEL', 'activities': [{'do': 'PLAY_SOUND'}]}, 'activities[0].activities[0].do'),
+    ({'do': 'GOTO', 'index': 2}, 'activities[0].index'),
+    ({'do': 'GOTO', 'index': True}, 'activities[0].index'),
+    ({'do': 'WAIT_FOR_INPUT', 'on_red': {'option': 'GOTO', 'chapter': 1.0}}, 'activities[0].on_red.chapter'),
+])
+def test_rejected(activity, where):
+    with pytest.raises(ConfigurationException, match='^' + re.escape(f'chapters[0].{where}: ')):
+        loads(_storyboard(activity))
+
+
+def test_accepted():
+    story = loads(_storyboard({'do': 'TAKE_PHOTO', 'filename': {'rec': 'a.jpg'}, 'video_port': True, 'burst': 3},
+                              {'do': 'GOTO', 'index': 1},
+                              {'do': 'PARALLEL', 'activities': [{'do': 'LIGHT_FRONT', 'w': 1},
+                                                                {'do': 'ADVANCE_UP', 'steps': -3}]}))
+    assert story.story[0].activities[1].values['index'] == 1
+
+
+def test_unknown_settings():
+    with pytest.raises(ConfigurationException):
+        Do(Activity.GOTO, chapter=2)
+    with pytest.raises(ConfigurationException):
+        Select(Option.REPEAT, chapter=2)
+    with pytest.raises(ConfigurationException):
+        Do(Activity.PARALLEL, activities=[Do(Activity.PLAY_SOUND)])
@@ -0,0 +1,65 @@
+import threading
+
+from concurrent.futures import Future
+
+import pytest
+
+from pizzactrl import fs_names, statemachine
+from pizzactrl.statemachine import Statemachine, State
+from pizzactrl.storyboard import Storyboard, Chapter
+
+
+class SlowHAL:
+    """
+    A HAL whose backends are still initializing when POST fails.
+    """
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.mixer_ready = False
+        self.sounds = []
+
+    def init_backends(self, sounds) -> Future:
+        fut = Future()
+
+        def _init():
+            if self.fail:
+                fut.set_exception(RuntimeError('No audio device'))
+                return
+            self.mixer_ready = True
+            fut.set_result(None)
+
+        threading.Timer(0.2, _init).start()
+        return fut
+
+
+@pytest.fixture
+def machine(tmp_path, monkeypatch):
+    monkeypatch.setattr(fs_names, 'POSTPROCESS_JOBS', str(tmp_path / 'jobs'))
+    monkeypatch.setattr(fs_names, 'USB_STICK', str(tmp_path / 'no-stick'))
+
+    def _play_sound(hal, sound, **kwargs):
+        if not hal.mixer_ready:
+            raise RuntimeError('mixer not initialized')
+        hal.sounds.append(sound)
+    monkeypatch.setattr(statemachine, 'play_sound', _play_sound)
+
+    def _machine(hal):
+        return Statemachine(hal, Storyboard(Chapter()), lang_select=False)
+    return _machine
+
+
+def test_error_sound_waits_for_backends(machine):
+    hal = SlowHAL()
+    sm = machine(hal)
+    sm.run()
+    # POST failed on the missing USB stick, before the mixer was ready
+    assert hal.sounds == [fs_names.SFX_ERROR]
+    assert sm.state is None
+
+
+def test_shutdown_when_backends_fail(machine):
+    hal = SlowHAL(fail=True)
+    sm = machine(hal)
+    sm.run()
+    assert hal.sounds == []
+    assert sm.state is None
@@ -0,0 +1,142 @@
+import os
+import json
+import importlib
+
+import pytest
+
+from pizzactrl import storyboard as sb
+from pizzactrl.fs_names import RecFile
+
+from conftest import replay, Stop
+
+STORYBOARDS = ('sb_berlin', 'sb_showcase', 'sb_linz', 'sb_dummy')
+
+# Traces recorded before the storyboard was split into definition and cursor, and for
+# sb_showcase after its GOTO chapters were fixed. See `replay()`
+TRACES = os.path.join(os.path.dirname(__file__), 'data', 'traces.json')
+
+
+def _cases():
+    for name in STORYBOARDS:
+        for seed, language in ((1, 'DE'), (2, 'EN'), (3, 'TR')):
+            yield name, seed, language
+
+
+@pytest.fixture(scope='module')
+def traces():
+    with open(TRACES) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('name, seed, language', list(_cases()))
+def test_replay_matches_recorded_trace(fake_hal, traces, name, seed, language):
+    story = importlib.import_module(f'pizzactrl.{name}').STORYBOARD
+    trace = replay(story, fake_hal(seed), language)
+    assert json.loads(json.dumps(trace)) == traces[f'{name}-{seed}-{language}']
+
+
+def test_program_positions():
+    story = importlib.import_module('pizzactrl.sb_berlin').STORYBOARD
+    program = story.program(sb.Language.DE)
+    h = v = 0
+    for i, chapter in enumerate(story.story):
+        for k, act in enumerate(chapter.activities):
+            assert program.position(i, k) == (h, v)
+            dh, dv = act.get_steps()
+            h += dh
+            v += dv
+    assert program.position(len(story.story)) == (h, v)
+
+
+def test_goto_moves_to_chapter_position(fake_hal):
+    story = sb.Storyboard(
+        sb.Chapter(sb.Do(sb.Activity.ADVANCE_LEFT, steps=10),
+                   sb.Do(sb.Activity.WAIT_FOR_INPUT, on_timeout=sb.Select(sb.Option.GOTO, chapter=2))),
+        sb.Chapter(sb.Do(sb.Activity.ADVANCE_UP, steps=5)),
+        sb.Chapter(sb.Do(sb.Activity.ADVANCE_LEFT, steps=3)))
+    trace = replay(story, fake_hal(0), 'DE', sessions=1)
+    moves = [(call[1]['scroll'], call[1]['steps']) for call in trace if call[0] == 'set_movement']
+    # Chapter 1 is jumped over, the scrolls are moved to where it ends
+    assert moves == [('HORIZONTAL', 10), ('HORIZONTAL', 0), ('VERTICAL', 5), ('HORIZONTAL', 3)]
+    assert trace[-1][0] == 'rewind'
+
+
+def test_goto_beyond_last_chapter(fake_hal):
+    story = sb.Storyboard(
+        sb.Chapter(sb.Do(sb.Activity.ADVANCE_LEFT, steps=10),
+                   sb.Do(sb.Activity.WAIT_FOR_INPUT, on_timeout=sb.Select(sb.Option.GOTO, chapter=7))),
+        sb.Chapter(sb.Do(sb.Activity.ADVANCE_UP, steps=5)))
+    trace = replay(story, fake_hal(0), 'DE', sessions=1)
+    moves = [(call[1]['scroll'], call[1]['steps']) for call in trace if call[0] == 'set_movement']
+    # The scrolls are moved to the end of the story, chapter 1 is not played
+    assert moves == [('HORIZONTAL', 10), ('HORIZONTAL', 0), ('VERTICAL', 5)]
+    assert trace[-1][0] == 'rewind'
+
+
+def test_interleaved_cursors(fake_hal):
+    story = importlib.import_module('pizzactrl.sb_showcase').STORYBOARD
+    expected = [replay(story, fake_hal(seed), 'DE', sessions=1) for seed in (1, 2)]
+
+    hals = [fake_hal(1), fake_hal(2)]
+    cursors = [story.cursor(hal) for hal in hals]
+    for cursor in cursors:
+        cursor.language = sb.Language.DE
+    active = list(zip(cursors, hals))
+    while active:
+        for cursor, hal in list(active):
+            try:
+                if cursor.hasnext():
+                    cursor.play_chapter()
+                    cursor.advance_chapter()
+                    continue
+            except Stop:
+                hal.trace.append(['stop'])
+            cursor.skip_flag = False
+            cursor.rewind()
+            active.remove((cursor, hal))
+    assert [hal.trace for hal in hals] == expected
+
+
+def test_cursor_sessions(fake_hal, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(sb, 'record_sound', lambda hal, filename, **kwargs: recorded.append(str(filename)))
+    played = []
+    monkeypatch.setattr(sb, 'play_sound', lambda hal, sound, **kwargs: played.append(str(sound)))
+
+    rec = RecFile('city.flac')
+    story = sb.Storyboard(sb.Chapter(sb.Do(sb.Activity.RECORD_SOUND, filename=rec),
+                                     sb.Do(sb.Activity.PLAY_SOUND, sound=rec)))
+    for session in ('one/', 'two/'):
+        cursor = story.cursor(fake_hal(0), session=session)
+        cursor.play_chapter()
+
+    assert recorded == played
+    assert [path.rsplit('/', 2)[-2:] for path in recorded] == [['one', 'city.flac'], ['two', 'city.flac']]
+    # The definition is not changed
+    assert rec.session is None
+
+
+def test_jump_beyond_last_chapter_ends_story(fake_hal):
+    story = sb.Storyboard(sb.Chapter(sb.Do(sb.Activity.WAIT_FOR_INPUT,
+                                           on_timeout=sb.Select(sb.Option.CONTINUE, skip_flag=True))),
+                          sb.Chapter(sb.Do(sb.Activity.PLAY_SOUND, sound='skipped.wav'), skip_flag=True))
+    cursor = story.cursor(fake_hal(0))
+    for _ in range(3):
+        cursor.play_chapter()
+        cursor.advance_chapter()
+    assert not cursor.hasnext()
+
+
+def test_arguments_prepared_once_per_session(fake_hal, monkeypatch):
+    played = []
+    monkeypatch.setattr(sb, 'play_sound', lambda hal, sound, **kwargs: played.append(sound))
+
+    story = sb.Storyboard(sb.Chapter(sb.Do(sb.Activity.PLAY_SOUND, sound=RecFile('city.flac'))))
+    cursor = story.cursor(fake_hal(0), session='one/')
+    for session in ('one/', 'one/', 'two/'):
+        cursor.session = session
+        cursor.play_chapter()
+        cursor.rewind()
+
+    assert played[0] is played[1]
+    assert str(played[2]).rsplit('/', 2)[-2:] == ['two', 'city.flac']